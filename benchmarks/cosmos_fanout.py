@@ -0,0 +1,80 @@
+""" Compare the serial cross-partition Cosmos read against the per-partition fan-out
+    for a KPI container, using the app's Cosmos settings
+
+    Both paths run the same query through the Cosmos process pool, filtered to the
+    given partition key values, so they return the same rows.
+
+    Run from the repo root:
+        python -m benchmarks.cosmos_fanout --container azure_cosmos_mv_protein_kpi_container \\
+            --partition-key-path machine_id --partition-keys M-1 M-2 M-3 M-4 """
+import time
+import asyncio
+import argparse
+import statistics
+
+from settings import settings
+from utils import db as database
+
+ROUNDS = 5
+
+
+async def run(args) -> dict:
+    container = getattr(settings, args.container, args.container)
+    query = "SELECT * FROM c WHERE ARRAY_CONTAINS(@keys, c.{})".format(args.partition_key_path)
+    parameters = [{"name": "@keys", "value": args.partition_keys}]
+
+    async def serial():
+        return await database.cosmos_pool.query_cosmos_in_separate_process(
+            container=container, query_string=query, parameters=parameters, limit=args.page_size
+        )
+
+    async def fanout():
+        return await database.cosmos_pool.query_cosmos_partitions_in_separate_processes(
+            container=container, query_string=query, parameters=parameters, limit=args.page_size,
+            partition_keys=args.partition_keys, max_parallel=args.max_parallel,
+        )
+
+    results = {}
+    # one untimed call each so process start-up and client creation are not measured
+    rows = {"serial": len(await serial()), "fanout": len(await fanout())}
+    for name, fn in (("serial", serial), ("fanout", fanout)):
+        timings = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            await fn()
+            timings.append(time.perf_counter() - start)
+        results[name] = (rows[name], timings)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--container", required=True, help="settings attribute or container name")
+    parser.add_argument("--partition-key-path", required=True, help="document field holding the partition key")
+    parser.add_argument("--partition-keys", nargs="+", required=True)
+    parser.add_argument("--max-parallel", type=int, default=database.PARTITION_FANOUT_PARALLELISM)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=ROUNDS)
+    args = parser.parse_args()
+
+    database.cosmos_pool.start_cosmos_process_pool()
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        database.cosmos_pool.shutdown_cosmos_process_pool()
+
+    for name, (rows, timings) in results.items():
+        print("{:<7} rows={:<7} median {:>8.1f} ms  min {:>8.1f} ms  max {:>8.1f} ms".format(
+            name, rows, statistics.median(timings) * 1000, min(timings) * 1000, max(timings) * 1000
+        ))
+    serial_rows, serial_timings = results["serial"]
+    fanout_rows, fanout_timings = results["fanout"]
+    if serial_rows != fanout_rows:
+        print("WARNING: row counts differ, check --partition-key-path")
+    print("speedup {:.2f}x with {} partitions".format(
+        statistics.median(serial_timings) / statistics.median(fanout_timings), len(set(args.partition_keys))
+    ))
+
+
+if __name__ == "__main__":
+    main()
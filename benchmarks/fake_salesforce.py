@@ -0,0 +1,347 @@
+""" Local stand-in for the Salesforce endpoints this service calls
+
+    Covers the OAuth token exchange, SOQL queries with nextRecordsUrl paging,
+    Commerce carts / cart-items, commerce sale/order, sObject create / PATCH /
+    DELETE, composite requests and ContentVersion uploads (JSON or multipart). Every response can be
+    delayed and a share of requests can fail, to see how the service degrades.
+
+    Run standalone: python -m benchmarks.fake_salesforce --port 8765 --latency-ms 40 """
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+API_PREFIX = re.compile(r"^/services/data/v\d+\.\d+")
+
+
+class FakeSalesforceConfig:
+    """ Tunables shared by every request handled by the server """
+
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        page_size: int = 2000,
+        records_per_query: int = 25,
+        seed: int = 42,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.page_size = page_size
+        self.records_per_query = records_per_query
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # request counters per (method, route), useful to assert call counts in benchmarks
+        self.calls = {}
+
+    def delay(self) -> float:
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+        return max(self.latency_ms + jitter, 0.0) / 1000
+
+    def should_fail(self) -> bool:
+        if not self.error_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def count(self, method: str, route: str):
+        with self.lock:
+            self.calls[(method, route)] = self.calls.get((method, route), 0) + 1
+
+
+def _sf_id(prefix: str) -> str:
+    return prefix + uuid.uuid4().hex[:15].upper()
+
+
+def _fake_record(sobject: str, index: int) -> dict:
+    record = {
+        "attributes": {"type": sobject, "url": "/services/data/v53.0/sobjects/{}/{}".format(sobject, index)},
+        "Id": "{}{:015d}".format(sobject[:3].upper(), index),
+    }
+    if sobject == "Order":
+        record.update({
+            "Status": "Activated",
+            "EffectiveDate": "2022-06-01",
+            "Pricebook2Id": "01s000000000001AAA",
+            "Purchase_Order__r": {
+                "Id": "a0P{:015d}".format(index // 2),
+                "Name": "PO-{}".format(index // 2),
+                "UUID__c": str(uuid.UUID(int=index // 2)),
+                "CreatedDate": "2022-06-01T00:00:00.000+0000",
+                "Purchase_Order_Number__c": str(100000 + index // 2),
+                "Approval_Status__c": "Approved",
+                "Total__c": 1234.5,
+            },
+            "OrderItems": {"totalSize": 3, "done": True, "records": [
+                {
+                    "Id": "802{:012d}{:03d}".format(index, item),
+                    "Product2": {"Id": "01t{:015d}".format(item), "Name": "Part {}".format(item)},
+                    "UnitPrice": 10.0 * (item + 1),
+                    "Quantity": 2.0,
+                }
+                for item in range(3)
+            ]},
+        })
+    elif sobject == "CartItem":
+        record.update({
+            "CartId": "0a6000000000001AAA",
+            "Name": "Part {}".format(index),
+            "Product2": {"ProductCode": "SKU-{:05d}".format(index)},
+            "SalesPrice": 10.0 * (index + 1),
+            "Quantity": 1.0,
+        })
+    elif sobject == "PriceBookEntry" or sobject == "PricebookEntry":
+        record.update({"Pricebook2": {"Id": "01s000000000001AAA"}, "UnitPrice": 10.0})
+    elif sobject == "Network":
+        record["Id"] = "0DB000000000001AAA"
+    elif sobject == "WebStorePricebook":
+        record["Pricebook2Id"] = "01s000000000001AAA"
+    return record
+
+
+class FakeSalesforceHandler(BaseHTTPRequestHandler):
+    config: FakeSalesforceConfig = None
+    # query locator -> remaining records
+    cursors = {}
+    cursors_lock = threading.Lock()
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # keep benchmark output readable
+        return
+
+    # -- helpers -------------------------------------------------------------
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status: int, payload=None):
+        body = b"" if payload is None else json.dumps(payload).encode("utf8")
+        self.send_response(status)
+        if payload is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, method: str):
+        parsed = urllib.parse.urlsplit(self.path)
+        path = API_PREFIX.sub("", parsed.path)
+        query = urllib.parse.parse_qs(parsed.query)
+        body = self._body()
+
+        time.sleep(self.config.delay())
+        if parsed.path != "/services/oauth2/token" and self.config.should_fail():
+            self.config.count(method, "error")
+            return self._send(self.config.error_status, [{"errorCode": "SERVER_UNAVAILABLE", "message": "injected"}])
+
+        for route_method, pattern, handler in ROUTES:
+            match = re.fullmatch(pattern, path if not parsed.path.startswith("/services/oauth2") else parsed.path)
+            if route_method == method and match:
+                self.config.count(method, pattern)
+                return handler(self, match, query, body)
+        self.config.count(method, "not_found")
+        self._send(404, [{"errorCode": "NOT_FOUND", "message": "{} {}".format(method, path)}])
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    # -- routes --------------------------------------------------------------
+    def oauth_token(self, match, query, body):
+        self._send(200, {
+            "access_token": "00D!fake." + uuid.uuid4().hex,
+            "instance_url": "http://{}:{}".format(*self.server.server_address),
+            "token_type": "Bearer",
+        })
+
+    def soql_query(self, match, query, body):
+        soql = query.get("q", [""])[0]
+        sobject = re.search(r"\bFROM\s+(\w+)\s*(WHERE|ORDER|LIMIT|$)", soql, re.IGNORECASE)
+        sobject = sobject.group(1) if sobject else "Unknown"
+        records = [_fake_record(sobject, i) for i in range(self.config.records_per_query)]
+        self._send(200, self._page(records))
+
+    def soql_query_more(self, match, query, body):
+        with self.cursors_lock:
+            records = self.cursors.pop(match.group(1), None)
+        if records is None:
+            return self._send(400, [{"errorCode": "INVALID_QUERY_LOCATOR", "message": "unknown locator"}])
+        self._send(200, self._page(records))
+
+    def _page(self, records: list) -> dict:
+        page, rest = records[:self.config.page_size], records[self.config.page_size:]
+        result = {"totalSize": len(records), "done": not rest, "records": page}
+        if rest:
+            locator = "01g" + uuid.uuid4().hex[:15]
+            with self.cursors_lock:
+                self.cursors[locator] = rest
+            result["nextRecordsUrl"] = "/services/data/v53.0/query/" + locator
+        return result
+
+    def active_cart(self, match, query, body):
+        self._send(200, {
+            "cartId": "0a6000000000001AAA",
+            "name": "Cart",
+            "status": "Active",
+            "totalProductCount": "3",
+            "grandTotalAmount": "60.00",
+            "accountId": query.get("effectiveAccountId", [""])[0],
+        })
+
+    def cart_items(self, match, query, body):
+        self._send(200, {
+            "cartItems": [
+                {"cartItem": {
+                    "cartItemId": "0a9{:015d}".format(i),
+                    "productId": "01t{:015d}".format(i),
+                    "quantity": "1",
+                    "salesPrice": "{:.2f}".format(10.0 * (i + 1)),
+                    "productDetails": {"sku": "SKU-{:05d}".format(i), "name": "Part {}".format(i)},
+                }}
+                for i in range(self.config.records_per_query)
+            ],
+            "hasErrors": False,
+        })
+
+    def add_cart_item(self, match, query, body):
+        payload = json.loads(body or b"{}")
+        self._send(201, {
+            "cartId": "0a6000000000001AAA",
+            "cartItemId": _sf_id("0a9"),
+            "productId": payload.get("productId"),
+            "quantity": str(payload.get("quantity", 1)),
+            "type": "Product",
+        })
+
+    def get_order(self, match, query, body):
+        self._send(200, {"order": [_fake_record("Order", 1)]})
+
+    def create_order(self, match, query, body):
+        self._send(201, {"order": [{"id": _sf_id("801"), "status": "Draft"}]})
+
+    def create_sobject(self, match, query, body):
+        self._send(201, {"id": _sf_id("068" if match.group(1) == "ContentVersion" else "a0P"), "success": True, "errors": []})
+
+    def get_sobject(self, match, query, body):
+        self._send(200, {"Id": match.group(2), "ContentDocumentId": _sf_id("069")})
+
+    def composite(self, match, query, body):
+        # every sub-request succeeds; only the shape matters to the callers
+        sub_requests = json.loads(body or b"{}").get("compositeRequest", [])
+        self._send(200, {"compositeResponse": [
+            {
+                "referenceId": sub["referenceId"],
+                "httpStatusCode": 200 if sub["method"] == "GET" else 201,
+                "body": {"Id": _sf_id("068"), "ContentDocumentId": _sf_id("069")}
+                if sub["method"] == "GET" else {"id": _sf_id("06A"), "success": True, "errors": []},
+                "httpHeaders": {},
+            }
+            for sub in sub_requests
+        ]})
+
+    def update_sobject(self, match, query, body):
+        self._send(204)
+
+    def delete_sobject(self, match, query, body):
+        self._send(204)
+
+
+ROUTES = [
+    ("POST", r"/services/oauth2/token", FakeSalesforceHandler.oauth_token),
+    ("GET", r"/query/?", FakeSalesforceHandler.soql_query),
+    ("GET", r"/query/([\w-]+)", FakeSalesforceHandler.soql_query_more),
+    ("GET", r"/commerce/webstores/\w+/carts/active", FakeSalesforceHandler.active_cart),
+    ("GET", r"/commerce/webstores/\w+/carts/active/cart-items", FakeSalesforceHandler.cart_items),
+    ("POST", r"/commerce/webstores/\w+/carts/active/cart-items", FakeSalesforceHandler.add_cart_item),
+    ("GET", r"/commerce/sale/order/(\w+)", FakeSalesforceHandler.get_order),
+    ("POST", r"/commerce/sale/order", FakeSalesforceHandler.create_order),
+    ("POST", r"/composite", FakeSalesforceHandler.composite),
+    # simple_salesforce posts to the sObject URL with a trailing slash
+    ("POST", r"/sobjects/(\w+)/?", FakeSalesforceHandler.create_sobject),
+    ("GET", r"/sobjects/(\w+)/(\w+)", FakeSalesforceHandler.get_sobject),
+    ("PATCH", r"/sobjects/(\w+)/(\w+)", FakeSalesforceHandler.update_sobject),
+    ("DELETE", r"/sobjects/(\w+)/(\w+)", FakeSalesforceHandler.delete_sobject),
+]
+
+
+class FakeSalesforce:
+    """ Runs the stand-in server on a background thread
+
+        with FakeSalesforce(FakeSalesforceConfig(latency_ms=40)) as fake:
+            requests.get(fake.url + "/services/data/v53.0/query/?q=SELECT Id FROM Order") """
+
+    def __init__(self, config: FakeSalesforceConfig = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or FakeSalesforceConfig()
+        handler = type("Handler", (FakeSalesforceHandler,), {"config": self.config, "cursors": {}})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(*self.server.server_address)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--page-size", type=int, default=2000)
+    parser.add_argument("--records", type=int, default=25)
+    args = parser.parse_args()
+
+    config = FakeSalesforceConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        page_size=args.page_size,
+        records_per_query=args.records,
+    )
+    fake = FakeSalesforce(config, host=args.host, port=args.port)
+    print("fake salesforce listening on " + fake.url)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+""" Load test for the cart and order routes against the local Salesforce stand-in
+
+    Salesforce and Key Vault are replaced by benchmarks.fake_salesforce: user
+    credentials point at it, the admin client is a simple_salesforce session on
+    it, and the org metadata is loaded from it by the regular refresher. The
+    user token is replaced by a fixed admin user. Postgres is still used as
+    configured in settings, since the routes, utils.auth and the Idempotency-Key
+    store need it.
+
+    python -m benchmarks.load_test --requests 200 --concurrency 20 --latency-ms 40
+    python -m benchmarks.load_test --route "GET /salesforce_orders/me" --max-p95-ms 250 """
+import sys
+import time
+import uuid
+import types
+import asyncio
+import argparse
+import statistics
+
+import httpx
+from fastapi import FastAPI
+
+from benchmarks.fake_salesforce import FakeSalesforce, FakeSalesforceConfig
+
+ACCOUNT_ID = "001000000000001AAA"
+CART_ID = "0a6000000000001AAA"
+CART_ITEM_ID = "0a9000000000001AAA"
+# unique per run, so replays never hit a key stored by an earlier run
+REPLAY_KEY = "loadtest-replay-" + uuid.uuid4().hex
+
+# (name, method, path, json body, extra headers per request)
+SCENARIOS = [
+    ("GET /carts/me", "GET", "/carts/me?account_id=" + ACCOUNT_ID, None, None),
+    ("GET /carts/me/summary", "GET", "/carts/me/summary?account_id=" + ACCOUNT_ID, None, None),
+    ("GET /carts/me/products", "GET", "/carts/me/products?account_id=" + ACCOUNT_ID, None, None),
+    ("POST /carts/me/products", "POST", "/carts/me/products?account_id=" + ACCOUNT_ID,
+     {"productId": "01t000000000001AAA", "quantity": 1}, None),
+    # a new key per request measures the idempotency store on top of the write
+    ("POST /carts/me/products (new key)", "POST", "/carts/me/products?account_id=" + ACCOUNT_ID,
+     {"productId": "01t000000000001AAA", "quantity": 1}, lambda: {"Idempotency-Key": str(uuid.uuid4())}),
+    # the same key every time: one write, then replays
+    ("POST /carts/me/products (replay)", "POST", "/carts/me/products?account_id=" + ACCOUNT_ID,
+     {"productId": "01t000000000001AAA", "quantity": 1}, lambda: {"Idempotency-Key": REPLAY_KEY}),
+    ("PUT /carts/me/products/{id}", "PUT", "/carts/me/products/" + CART_ITEM_ID, {"quantity": 2}, None),
+    ("DELETE /carts/me/products/{id}", "DELETE", "/carts/me/products/" + CART_ITEM_ID, None, None),
+    ("GET /salesforce_purchase_orders/me", "GET", "/salesforce_purchase_orders/me", None, None),
+    ("GET /salesforce_orders/me", "GET", "/salesforce_orders/me", None, None),
+    ("GET /salesforce_orders/me/{id}", "GET", "/salesforce_orders/me/801000000000001AAA", None, None),
+    ("POST /salesforce_order", "POST", "/salesforce_order?account_id={}&cart_id={}".format(ACCOUNT_ID, CART_ID),
+     None, lambda: {"Idempotency-Key": str(uuid.uuid4())}),
+]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def build_app(fake_url: str) -> FastAPI:
+    """ Mount the routers with Salesforce pointed at the stand-in and the user token stubbed out """
+    import carts
+    import salesforce_orders
+    from simple_salesforce import Salesforce
+    from utils import active_carts, auth, idempotency, salesforce
+
+    def prep_request(sf_username):
+        return {
+            "instance_url": fake_url,
+            "headers": {
+                "Authorization": "Bearer fake",
+                "Content-Type": "application/json",
+                "Accept": "*/*",
+            },
+        }
+    # module attributes, so the routes, SalesforceContext and the helpers all pick them up
+    salesforce.prep_request = prep_request
+    # a session id skips the SOAP login the stand-in does not serve
+    salesforce.sf_client = lambda: Salesforce(instance_url=fake_url, session_id="fake", session=salesforce.http)
+
+    active_carts.create_tables()
+    idempotency.create_tables()
+
+    user = types.SimpleNamespace(
+        sub="loadtest@example.com",
+        organizations=["*"],
+        plants=["*"],
+        machines=[],
+        details=types.SimpleNamespace(
+            email="loadtest@example.com",
+            sf_username="loadtest@example.com.sandbox",
+            sf_user_id="005000000000001AAA",
+            disabled=False,
+        ),
+    )
+
+    app = FastAPI()
+    app.include_router(carts.router)
+    app.include_router(salesforce_orders.router)
+    app.dependency_overrides[auth.get_secure_token_and_user] = lambda: user
+    return app
+
+
+async def run_scenario(client: httpx.AsyncClient, scenario, total: int, concurrency: int) -> dict:
+    name, method, path, body, headers = scenario
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body, headers=headers() if headers else None)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {
+        "route": name,
+        "requests": total,
+        "errors": errors,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": statistics.fmean(latencies) if latencies else float("nan"),
+        "rps": total / elapsed if elapsed else float("nan"),
+    }
+
+
+async def run(args) -> list:
+    config = FakeSalesforceConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        records_per_query=args.records,
+    )
+    scenarios = [s for s in SCENARIOS if not args.route or s[0] in args.route]
+    with FakeSalesforce(config) as fake:
+        app = build_app(fake.url)
+        from utils.sf_metadata import sf_metadata
+
+        # routes only read the metadata, it is loaded the way the app's lifespan does
+        await sf_metadata.start_metadata_refresh()
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=60) as client:
+                # one untimed request per route to warm imports and connection pools
+                for _, method, path, body, headers in scenarios:
+                    await client.request(method, path, json=body, headers=headers() if headers else None)
+                return [await run_scenario(client, s, args.requests, args.concurrency) for s in scenarios]
+        finally:
+            await sf_metadata.shutdown_metadata_refresh()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=40.0, help="simulated Salesforce latency")
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--records", type=int, default=25, help="records returned per SOQL query")
+    parser.add_argument("--route", action="append", help="only run these routes, e.g. 'GET /carts/me'")
+    parser.add_argument("--max-p95-ms", type=float, help="exit non-zero if any route's p95 is above this")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    print("{:<40} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9}".format("route", "reqs", "errors", "p50 ms", "p95 ms", "p99 ms", "req/s"))
+    for r in results:
+        print("{route:<40} {requests:>6} {errors:>6} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {rps:>9.1f}".format(**r))
+
+    if args.max_p95_ms is not None:
+        slow = [r["route"] for r in results if r["p95"] > args.max_p95_ms]
+        if slow:
+            print("p95 above {} ms: {}".format(args.max_p95_ms, ", ".join(slow)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+""" Compare the default FastAPI encoding path against utils.responses for a typical
+    1k-order Salesforce payload
+
+    Run from the repo root: python -m benchmarks.serialization """
+import json
+import time
+import random
+import statistics
+
+from fastapi.encoders import jsonable_encoder
+
+from utils import responses
+
+ORDER_COUNT = 1000
+ITEMS_PER_ORDER = 8
+ROUNDS = 20
+
+
+def build_orders_payload(order_count: int = ORDER_COUNT) -> dict:
+    """ Shape matches the SOQL query behind GET /salesforce_orders/me """
+    records = []
+    for i in range(order_count):
+        items = [
+            {
+                "attributes": {"type": "OrderItem", "url": "/services/data/v53.0/sobjects/OrderItem/802%015d" % (i * 100 + j)},
+                "Id": "802%015d" % (i * 100 + j),
+                "Product2": {
+                    "attributes": {"type": "Product2"},
+                    "Id": "01t%015d" % random.randint(0, 5000),
+                    "Name": "Replacement part %d" % random.randint(0, 5000),
+                },
+                "UnitPrice": round(random.uniform(1, 5000), 2),
+                "Quantity": float(random.randint(1, 20)),
+            }
+            for j in range(ITEMS_PER_ORDER)
+        ]
+        records.append({
+            "attributes": {"type": "Order", "url": "/services/data/v53.0/sobjects/Order/801%015d" % i},
+            "Id": "801%015d" % i,
+            "Status": random.choice(["Draft", "Activated", "Closed"]),
+            "EffectiveDate": "2022-%02d-%02d" % (random.randint(1, 12), random.randint(1, 28)),
+            "Pricebook2Id": "01s000000000001AAA",
+            "OrderItems": {"totalSize": len(items), "done": True, "records": items},
+        })
+    return {"totalSize": len(records), "done": True, "records": records}
+
+
+def default_path(payload) -> bytes:
+    # what FastAPI does for a plain dict return value
+    return json.dumps(jsonable_encoder(payload), ensure_ascii=False, allow_nan=False).encode("utf8")
+
+
+def fast_path(payload) -> bytes:
+    return responses.dumps(payload)
+
+
+def timeit(fn, payload) -> list:
+    timings = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        fn(payload)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    random.seed(42)
+    payload = build_orders_payload()
+    for name, fn in [("default (jsonable_encoder + json)", default_path), ("fast (utils.responses)", fast_path)]:
+        timings = timeit(fn, payload)
+        print("{:<36} median {:8.2f} ms   min {:8.2f} ms".format(name, statistics.median(timings), min(timings)))
+
+    body = fast_path(payload)
+    for encoding in ["gzip", "br"]:
+        start = time.perf_counter()
+        compressed, used = responses.compress(body, encoding)
+        elapsed = (time.perf_counter() - start) * 1000
+        if used is None:
+            print("{:<36} not available".format(encoding))
+            continue
+        print("{:<36} {:>9} -> {:>9} bytes in {:.2f} ms".format(used, len(body), len(compressed), elapsed))
+
+
+if __name__ == "__main__":
+    main()
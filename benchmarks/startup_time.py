@@ -0,0 +1,101 @@
+""" Measure worker cold start: module import time in fresh interpreters, and the
+    lifespan warm-up stage
+
+    Each round imports the given modules in a new `python` process, the way a
+    freshly spawned worker does. Needs the same environment as the app
+    (settings, Postgres); the warm-up also needs Cosmos, Key Vault and Salesforce.
+
+    Run from the repo root:
+        python -m benchmarks.startup_time
+        python -m benchmarks.startup_time --importtime 15   # slowest imports
+        python -m benchmarks.startup_time --warmup """
+import os
+import sys
+import asyncio
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# every router plus what they pull in, i.e. what a worker imports before serving
+MODULES = [
+    "carts",
+    "salesforce_orders",
+    "salesforce_account",
+    "salesforce_machines",
+    "jobs",
+    "metrics",
+    "products",
+    "profiles",
+]
+
+IMPORT_SCRIPT = """
+import time, importlib
+start = time.perf_counter()
+for name in {modules!r}:
+    importlib.import_module(name)
+print(time.perf_counter() - start)
+"""
+
+
+def measure_import(modules: list, rounds: int) -> list:
+    """ Seconds to import the modules, one fresh interpreter per round """
+    timings = []
+    script = IMPORT_SCRIPT.format(modules=modules)
+    for _ in range(rounds):
+        output = subprocess.run(
+            [sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True
+        )
+        timings.append(float(output.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def slowest_imports(modules: list, top: int) -> list:
+    """ (cumulative microseconds, module) from `python -X importtime`, slowest first """
+    script = "import importlib\nfor name in {!r}:\n    importlib.import_module(name)".format(modules)
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # only imports made directly by the script, nested ones are in their cumulative time
+        if not name[1:].startswith(" "):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def measure_warmup() -> dict:
+    from utils import warmup
+
+    return asyncio.run(warmup.warm_up())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--modules", nargs="*", default=MODULES)
+    parser.add_argument("--importtime", type=int, default=0, metavar="N", help="list the N slowest imports")
+    parser.add_argument("--warmup", action="store_true", help="also time the lifespan warm-up steps")
+    args = parser.parse_args()
+
+    timings = measure_import(args.modules, args.rounds)
+    print("import {} modules: median {:.0f} ms, min {:.0f} ms, max {:.0f} ms over {} rounds".format(
+        len(args.modules), statistics.median(timings) * 1000, min(timings) * 1000, max(timings) * 1000, args.rounds
+    ))
+
+    if args.importtime:
+        print("\nslowest imports (cumulative):")
+        for cumulative, name in slowest_imports(args.modules, args.importtime):
+            print("  {:>8.1f} ms  {}".format(cumulative / 1000, name))
+
+    if args.warmup:
+        print("\nwarm-up (ms, None = failed or timed out):")
+        for name, elapsed_ms in measure_warmup().items():
+            print("  {:<12} {}".format(name, elapsed_ms))
+
+
+if __name__ == "__main__":
+    main()
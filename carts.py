@@ -1,149 +1,251 @@
 import json
+import typing
 import schemas
-import requests
 import fastapi as fapi
 from fastapi import APIRouter
-from settings import settings
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from enums import SecurityScope
 
 from utils import (
     auth,
     salesforce,
+    responses,
+    account_index,
+    active_carts,
+    cache,
+    cart_reconciliation,
+    idempotency,
+    soql,
     db
 )
+from utils.cache import response_cache
+from utils.sf_metadata import sf_metadata
+from utils.catalog import catalog
+from utils.order_cache import make_etag, etag_matches
 from models import SfCarts as sf_carts_model
 from sqlalchemy.dialects.postgresql import insert
 
 router = APIRouter()
 
+# active carts change under other sessions too, keep shared copies short-lived
+CART_CACHE_SECONDS = 30
+
 
 @router.get("/carts/me", tags=["carts"], response_model=schemas.Cart
 )
 async def get_cart(
-    account_id: str,
+    request: fapi.Request,
+    account_id: typing.Optional[str] = None,
     token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+    db: Session = fapi.Depends(db.get_db),
 ):
     """Get cart details"""
-    # TODO: map logged in user's org to Salesforce Account ID
-    # currently requires you to pass the Account ID as a query parameter
+    # the Account ID is resolved from the user's organization unless it is passed explicitly
+    account_id = account_index.resolve_account_id(account_id, token, db)
     sf_username = token.details.sf_username
 
-    # get the credentials and set initial headers
-    sf = salesforce.prep_request(sf_username)
-    instance_url = sf["instance_url"]
-    headers = sf["headers"]
-
-    url = (
-        instance_url
-        + "/services/data/v53.0/commerce/webstores/"
-        + settings.webstore_id
-        + "/carts/active?effectiveAccountId="
-        + account_id
-    )
-
-    response = requests.get(url, headers=headers)
-    if response.ok is not True:
-        raise fapi.HTTPException(
-            status_code=response.status_code, detail=response.json()
+    async def load():
+        # credentials are only resolved on a cache miss
+        sf = salesforce.prep_request(sf_username)
+        instance_url = sf["instance_url"]
+        headers = sf["headers"]
+
+        url = (
+            instance_url
+            + "/services/data/v53.0/commerce/webstores/"
+            + sf_metadata.webstore_id
+            + "/carts/active?effectiveAccountId="
+            + account_id
         )
+        response = salesforce.http.get(url, headers=headers)
+        if response.ok is not True:
+            raise fapi.HTTPException(
+                status_code=response.status_code, detail=response.json()
+            )
+        body = response.json()
+        if body.get("cartId"):
+            active_carts.remember(db, sf_username, account_id, body["cartId"])
+        return body
+
+    # shared across workers, invalidated by the cart write routes and checkout
+    body = await response_cache.get_or_set(
+        cache.make_key("cart", sf_username, account_id),
+        load,
+        CART_CACHE_SECONDS,
+        tags=[cache.cart_account_tag(account_id), cache.cart_user_tag(sf_username)],
+    )
 
     # return the metadata received from Salesforce
-    return response.json()
+    return responses.fast_response(request, body)
+
+
+@router.get("/carts/me/summary", tags=["carts"])
+async def get_cart_summary(
+    request: fapi.Request,
+    account_id: typing.Optional[str] = None,
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+    db: Session = fapi.Depends(db.get_db),
+):
+    """Get line count, quantity and total of your active cart from the Postgres mirror"""
+    account_id = account_index.resolve_account_id(account_id, token, db)
+    # only the caller's own cart; Salesforce is asked once if we have not seen it yet
+    cart_id = await run_in_threadpool(active_carts.cart_id_for, db, token.details.sf_username, account_id)
+
+    # computed from the sf_carts mirror and the synced catalog prices
+    items = db.query(sf_carts_model).filter_by(sf_account_id=account_id, sf_cart_id=cart_id).all() if cart_id else []
+    index = catalog.index
+    preferred_pricebook_ids = sf_metadata.pricebook_ids
+    total = 0.0
+    unpriced = 0
+    for item in items:
+        product = index.products_by_id.get(item.sf_product_id)
+        prices = index.prices(product["product_code"]) if product else []
+        price = next((p for p in prices if p["pricebook_id"] in preferred_pricebook_ids), None)
+        price = price or (prices[0] if prices else None)
+        if price is None:
+            unpriced += 1
+            continue
+        total += price["unit_price"] * item.quantity
+
+    summary = {
+        "account_id": account_id,
+        "cart_ids": sorted({item.sf_cart_id for item in items}),
+        "line_count": len(items),
+        "quantity": sum(item.quantity for item in items),
+        "total": round(total, 2),
+        # lines whose price is not in the catalog yet, the total excludes them
+        "unpriced_line_count": unpriced,
+    }
+
+    # clients revalidate with If-None-Match and get a 304 while nothing changed
+    etag = make_etag(summary)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        # the same headers as the 200, so caches keep them
+        return fapi.Response(status_code=304, headers={**headers, "Vary": "Accept-Encoding"})
+    return responses.fast_response(request, summary, headers=headers)
 
 
 @router.get(
     "/carts/me/products", tags=["carts"]
 )
 async def get_cart_products(
-    account_id: str,
+    request: fapi.Request,
+    account_id: typing.Optional[str] = None,
     token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+    db: Session = fapi.Depends(db.get_db),
 ):
     """Get product details from a cart with corresponding SFCC IDs"""
-    # TODO: map logged in user's plant to Salesforce Account ID, dynamically fetch "active" Carts for user via CartId
-    # currently requires you to pass the Account ID as a query parameter
+    # the Account ID is resolved from the user's organization unless it is passed explicitly
+    account_id = account_index.resolve_account_id(account_id, token, db)
     # TODO: create request Schema for Out ->
     sf_username = token.details.sf_username
 
-    # get the credentials and set initial headers
-    sf = salesforce.prep_request(sf_username)
-    instance_url = sf["instance_url"]
-    headers = sf["headers"]
-
-    url = (
-        instance_url
-        + "/services/data/v53.0/commerce/webstores/"
-        + settings.webstore_id
-        + "/carts/active/cart-items?effectiveAccountId"
-        + account_id
-    )
-
-    response = requests.get(url, headers=headers)
-    if response.ok is not True:
-        raise fapi.HTTPException(
-            status_code=response.status_code, detail=response.json()
+    async def load():
+        # credentials are only resolved on a cache miss
+        sf = salesforce.prep_request(sf_username)
+        instance_url = sf["instance_url"]
+        headers = sf["headers"]
+
+        url = (
+            instance_url
+            + "/services/data/v53.0/commerce/webstores/"
+            + sf_metadata.webstore_id
+            + "/carts/active/cart-items?effectiveAccountId"
+            + account_id
         )
+        response = salesforce.http.get(url, headers=headers)
+        if response.ok is not True:
+            raise fapi.HTTPException(
+                status_code=response.status_code, detail=response.json()
+            )
+        return response.json()
+
+    body = await response_cache.get_or_set(
+        cache.make_key("cart-items", sf_username, account_id),
+        load,
+        CART_CACHE_SECONDS,
+        tags=[cache.cart_account_tag(account_id), cache.cart_user_tag(sf_username)],
+    )
 
     # return the metadata received from Salesforce
-    return response.json()
+    return responses.fast_response(request, body)
 
 
 @router.post("/carts/me/products", tags=["carts"])
 async def add_product_to_cart(
-    account_id: str,
     request: schemas.CartProductIn,
+    http_response: fapi.Response,
+    account_id: typing.Optional[str] = None,
+    idempotency_key: typing.Optional[str] = fapi.Header(None, alias=idempotency.HEADER, max_length=255),
     token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=[SecurityScope.write]),
     db: Session = fapi.Depends(db.get_db),
 ):
-    """Add a product to a cart (create the cart if none exists)"""
-    # TODO: map logged in user's org to Salesforce Account ID
-    # currently requires you to pass the Account ID as a query parameter
+    """Add a product to a cart (create the cart if none exists), once per Idempotency-Key"""
+    # the Account ID is resolved from the user's organization unless it is passed explicitly
+    account_id = account_index.resolve_account_id(account_id, token, db)
     sf_username = token.details.sf_username
 
-    # get the credentials and set initial headers
-    sf = salesforce.prep_request(sf_username)
-    instance_url = sf["instance_url"]
-    headers = sf["headers"]
-
-    # add item to cart, create one if none exists
-    url = (
-        instance_url
-        + "/services/data/v53.0/commerce/webstores/"
-        + settings.webstore_id
-        + "/carts/active/cart-items?effectiveAccountId="
-        + account_id
+    # a retried add would otherwise add the quantity again, in Salesforce and in the mirror
+    request_fingerprint = idempotency.fingerprint(
+        account_id=account_id, product_id=request.productId, quantity=request.quantity
     )
+    async with idempotency.once(
+        idempotency_key, token.details.email, "cart_product", request_fingerprint, http_response
+    ) as run:
+        if run.replayed:
+            return run.result
+
+        # get the credentials and set initial headers
+        sf = salesforce.prep_request(sf_username)
+        instance_url = sf["instance_url"]
+        headers = sf["headers"]
+
+        # add item to cart, create one if none exists
+        url = (
+            instance_url
+            + "/services/data/v53.0/commerce/webstores/"
+            + sf_metadata.webstore_id
+            + "/carts/active/cart-items?effectiveAccountId="
+            + account_id
+        )
 
-    payload = {
-        "productId": request.productId,
-        "quantity": request.quantity,
-        "type": "product",
-    }
-
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
-    if response.ok is not True:
-        raise fapi.HTTPException(
-            status_code=response.status_code, detail=response.json()
+        payload = {
+            "productId": request.productId,
+            "quantity": request.quantity,
+            "type": "product",
+        }
+
+        # from here a failure must not be retried blindly, Salesforce may have added the item
+        run.mark_written()
+        response = salesforce.http.post(url, headers=headers, data=json.dumps(payload))
+        if response.ok is not True:
+            raise fapi.HTTPException(
+                status_code=response.status_code, detail=response.json()
+            )
+        output = response.json()
+
+        # write to postgres
+        insert_stmt = insert(sf_carts_model).values(
+            sf_cart_id=output['cartId'],
+            sf_cart_item_id=output["cartItemId"],
+            sf_account_id=account_id,
+            sf_product_id=output["productId"],
+            quantity=request.quantity
         )
-    output = response.json()
-
-    # write to postgres
-    insert_stmt = insert(sf_carts_model).values(
-        sf_cart_id=output['cartId'],
-        sf_cart_item_id=output["cartItemId"],
-        sf_account_id=account_id,
-        sf_product_id=output["productId"],
-        quantity=request.quantity
-    )
-    do_update_stmt = insert_stmt.on_conflict_do_update(
-        index_elements=['sf_cart_id', 'sf_cart_item_id'],
-        set_=dict(quantity=insert_stmt.excluded.quantity+sf_carts_model.quantity)
-    )
-    db.execute(do_update_stmt)
-    db.commit()
+        do_update_stmt = insert_stmt.on_conflict_do_update(
+            index_elements=['sf_cart_id', 'sf_cart_item_id'],
+            set_=dict(quantity=insert_stmt.excluded.quantity+sf_carts_model.quantity)
+        )
+        db.execute(do_update_stmt)
+        db.commit()
+        active_carts.remember(db, sf_username, account_id, output['cartId'])
+        await response_cache.ainvalidate(cache.cart_account_tag(account_id), cache.cart_user_tag(sf_username))
+        await soql.ainvalidate("CartItem")
 
-    # return the metadata received from Salesforce
-    return output
+        # return the metadata received from Salesforce
+        return run.store(output)
 
 
 @router.put("/carts/me/products/{cart_item_id}", tags=["carts"], status_code=204)
@@ -171,7 +273,7 @@ async def update_cart_product(
         "quantity": request.quantity,
     }
 
-    response = requests.patch(url, headers=headers, data=json.dumps(payload))
+    response = salesforce.http.patch(url, headers=headers, data=json.dumps(payload))
     if response.ok is not True:
         raise fapi.HTTPException(
             status_code=response.status_code, detail=response.json()
@@ -182,6 +284,8 @@ async def update_cart_product(
         .filter_by(sf_cart_item_id=cart_item_id)\
         .update({"quantity": request.quantity}, synchronize_session=False,)
     db.commit()
+    await response_cache.ainvalidate(cache.cart_user_tag(sf_username))
+    await soql.ainvalidate("CartItem")
 
     # return the metadata received from Salesforce (none)
     return response.text
@@ -209,7 +313,7 @@ async def delete_cart_product(
         instance_url + "/services/data/v53.0/sobjects/CartItem/" + cart_item_id
     )
 
-    response = requests.delete(url, headers=headers)
+    response = salesforce.http.delete(url, headers=headers)
     if response.ok is not True:
         raise fapi.HTTPException(
             status_code=response.status_code, detail=response.json()
@@ -218,6 +322,20 @@ async def delete_cart_product(
     # remove from postgres
     db.query(sf_carts_model).filter_by(sf_cart_item_id=cart_item_id).delete()
     db.commit()
+    await response_cache.ainvalidate(cache.cart_user_tag(sf_username))
+    await soql.ainvalidate("CartItem")
 
     # return the metadata received from Salesforce (none)
     return response.text
+
+
+@router.post("/carts/reconcile", tags=["carts"], status_code=202)
+async def reconcile_carts(
+    dry_run: bool = False,
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=[SecurityScope.admin]),
+):
+    """Queue a bulk repair of the cart mirror from Salesforce, poll /jobs/{job_id} for counts and timings"""
+    job_id = await run_in_threadpool(
+        cart_reconciliation.enqueue_reconcile_carts, token.details.email, dry_run
+    )
+    return {"job_id": job_id}
@@ -0,0 +1,30 @@
+import fastapi as fapi
+from fastapi import APIRouter
+import schemas
+from enums import SecurityScope
+
+from utils import (
+    auth,
+    jobs,
+)
+
+router = APIRouter()
+
+
+@router.get(
+    "/jobs/{job_id}",
+    tags=["jobs"],
+)
+async def get_job_status(
+    job_id: int,
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+):
+    """Get the status of a background job (PDF attachment, PO approval, cart reconciliation)"""
+    job = jobs.get_job(job_id)
+
+    # only the user who queued the job can see it
+    if job is None or job["owner"] != token.details.email:
+        raise fapi.HTTPException(status_code=404, detail="Job not found")
+
+    del job["owner"]
+    return job
@@ -0,0 +1,272 @@
+import re
+import math
+import itertools
+import typing
+import datetime
+import fastapi as fapi
+from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+import schemas
+from enums import SecurityScope
+
+from utils import (
+    auth,
+    responses,
+    kpi_aggregation,
+    kpi_export,
+)
+from utils.db import cosmos_pool, get_cosmos_container_client
+from settings import settings
+
+router = APIRouter()
+
+# KPI name in the URL -> settings attribute holding the Cosmos container name
+KPI_CONTAINERS = {
+    "protein": "azure_cosmos_protein_container",
+    "protein_computed": "azure_cosmos_protein_computed_container",
+    "mv_protein": "azure_cosmos_mv_protein_kpi_container",
+    "aseptic": "azure_cosmos_aseptic_kpi_container",
+}
+# KPI documents carry the machine id and an ISO-8601 UTC timestamp
+TIME_FIELD = "timestamp"
+MACHINE_FIELD = "machine_id"
+QUERY_PAGE_SIZE = 1000
+MAX_POINTS = 10000
+# machines per multi-machine read, each one is a partition query
+MAX_MACHINES = 50
+
+_FIELD_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def kpi_container(kpi: str) -> str:
+    if kpi not in KPI_CONTAINERS:
+        raise fapi.HTTPException(status_code=404, detail="Unknown KPI '{}'".format(kpi))
+    return getattr(settings, KPI_CONTAINERS[kpi])
+
+
+def check_machine_access(token: schemas.AuthorizedUser, machine_id: str):
+    if "*" not in token.organizations and machine_id not in {str(machine) for machine in token.machines}:
+        raise fapi.HTTPException(status_code=404, detail="Machine not found")
+
+
+def kpi_query(
+    fields: typing.Optional[typing.List[str]],
+    machine_ids: typing.Sequence[str],
+    start: datetime.datetime,
+    end: datetime.datetime
+) -> typing.Tuple[str, list]:
+    """ Cosmos SQL for the machines' documents in [start, end), projecting `fields` when given """
+    if fields:
+        for field in fields:
+            if not _FIELD_NAME.match(field):
+                raise fapi.HTTPException(status_code=422, detail="Invalid field name '{}'".format(field))
+        projection = ", ".join("c.{}".format(field) for field in dict.fromkeys([TIME_FIELD, MACHINE_FIELD, *fields]))
+    else:
+        projection = "*"
+    query = "SELECT {} FROM c WHERE ARRAY_CONTAINS(@machine_ids, c.{}) AND c.{} >= @start AND c.{} < @end".format(
+        projection, MACHINE_FIELD, TIME_FIELD, TIME_FIELD
+    )
+    parameters = [
+        {"name": "@machine_ids", "value": list(machine_ids)},
+        # ISO strings compare in time order
+        {"name": "@start", "value": start.strftime("%Y-%m-%dT%H:%M:%S")},
+        {"name": "@end", "value": end.strftime("%Y-%m-%dT%H:%M:%S")},
+    ]
+    return query, parameters
+
+
+def as_utc(value: datetime.datetime) -> datetime.datetime:
+    """ Naive query parameters are taken as UTC """
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+
+def time_range(start: datetime.datetime, end: datetime.datetime) -> typing.Tuple[datetime.datetime, datetime.datetime]:
+    start, end = as_utc(start), as_utc(end)
+    if end <= start:
+        raise fapi.HTTPException(status_code=422, detail="end must be after start")
+    return start, end
+
+
+async def _fetch(kpi: str, machine_ids: typing.Sequence[str], field: typing.List[str], start, end) -> list:
+    query, parameters = kpi_query(field, machine_ids, start, end)
+    container = kpi_container(kpi)
+    try:
+        # KPI containers are partitioned by machine id, so this is one concurrent read per machine
+        return await cosmos_pool.query_cosmos_partitions_in_separate_processes(
+            container=container, query_string=query, parameters=parameters, limit=QUERY_PAGE_SIZE,
+            partition_keys=machine_ids,
+        )
+    except Exception:
+        # an outage must not look like a machine without data
+        raise fapi.HTTPException(
+            status_code=503, detail="KPI data is unavailable, try again later", headers={"Retry-After": "30"}
+        )
+
+
+def _aggregate(documents: list, field: typing.List[str], bucket: float, start: datetime.datetime) -> dict:
+    times, values = kpi_aggregation.to_arrays(documents, TIME_FIELD, field)
+    result = kpi_aggregation.bucket_aggregate(times, values, bucket, origin=start.timestamp())
+    return {
+        "bucket_seconds": bucket,
+        "source_points": int(times.size),
+        "time": kpi_aggregation.to_epoch_ms(result["time"]),
+        "fields": {
+            name: {agg: kpi_aggregation.to_json_list(array) for agg, array in aggregates.items()}
+            for name, aggregates in result["fields"].items()
+        },
+    }
+
+
+@router.get(
+    "/kpi/{kpi}/aggregate",
+    tags=["kpi"],
+)
+async def aggregate_machines_kpi(
+    kpi: str,
+    request: fapi.Request,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    field: typing.List[str] = fapi.Query(...),
+    machine_id: typing.Optional[typing.List[str]] = fapi.Query(None),
+    points: int = fapi.Query(500, ge=1, le=MAX_POINTS),
+    bucket_seconds: typing.Optional[float] = fapi.Query(None, gt=0),
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+):
+    """Get the aggregate route's buckets for several machines at once, all of the user's machines by default"""
+    if machine_id:
+        machine_ids = list(dict.fromkeys(machine_id))
+        for machine in machine_ids:
+            check_machine_access(token, machine)
+    elif "*" in token.organizations:
+        raise fapi.HTTPException(status_code=422, detail="machine_id is required for users of every organization")
+    else:
+        machine_ids = [str(machine) for machine in token.machines]
+    if len(machine_ids) > MAX_MACHINES:
+        raise fapi.HTTPException(status_code=422, detail="At most {} machines per request".format(MAX_MACHINES))
+    start, end = time_range(start, end)
+    documents = await _fetch(kpi, machine_ids, field, start, end)
+
+    bucket = bucket_seconds or math.ceil((end - start).total_seconds() / points)
+
+    def aggregate():
+        by_machine = {machine: [] for machine in machine_ids}
+        for document in documents:
+            by_machine.get(str(document.get(MACHINE_FIELD)), []).append(document)
+        return {
+            "bucket_seconds": bucket,
+            "machines": {
+                machine: _aggregate(machine_documents, field, bucket, start)
+                for machine, machine_documents in by_machine.items()
+            },
+        }
+
+    return responses.fast_response(request, await run_in_threadpool(aggregate))
+
+
+@router.get(
+    "/kpi/{kpi}/machines/{machine_id}/aggregate",
+    tags=["kpi"],
+)
+async def aggregate_kpi(
+    kpi: str,
+    machine_id: str,
+    request: fapi.Request,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    field: typing.List[str] = fapi.Query(...),
+    points: int = fapi.Query(500, ge=1, le=MAX_POINTS),
+    bucket_seconds: typing.Optional[float] = fapi.Query(None, gt=0),
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+):
+    """Get mean/min/max/last of KPI fields per time bucket, sized to `points` buckets unless `bucket_seconds` is given"""
+    check_machine_access(token, machine_id)
+    start, end = time_range(start, end)
+    documents = await _fetch(kpi, [machine_id], field, start, end)
+
+    bucket = bucket_seconds or math.ceil((end - start).total_seconds() / points)
+
+    # numpy work stays off the event loop
+    return responses.fast_response(request, await run_in_threadpool(_aggregate, documents, field, bucket, start))
+
+
+@router.get(
+    "/kpi/{kpi}/machines/{machine_id}/downsample",
+    tags=["kpi"],
+)
+async def downsample_kpi(
+    kpi: str,
+    machine_id: str,
+    request: fapi.Request,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    field: typing.List[str] = fapi.Query(...),
+    points: int = fapi.Query(1000, ge=3, le=MAX_POINTS),
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+):
+    """Get at most `points` points per KPI field, picked with LTTB so the chart keeps its shape"""
+    check_machine_access(token, machine_id)
+    start, end = time_range(start, end)
+    documents = await _fetch(kpi, [machine_id], field, start, end)
+
+    def downsample():
+        times, values = kpi_aggregation.to_arrays(documents, TIME_FIELD, field)
+        fields = {}
+        for name, column in values.items():
+            keep = kpi_aggregation.lttb(times, column, points)
+            fields[name] = {
+                "time": kpi_aggregation.to_epoch_ms(times[keep]),
+                "value": kpi_aggregation.to_json_list(column[keep]),
+            }
+        return {"source_points": int(times.size), "fields": fields}
+
+    return responses.fast_response(request, await run_in_threadpool(downsample))
+
+
+@router.get(
+    "/kpi/{kpi}/machines/{machine_id}/export",
+    tags=["kpi"],
+)
+async def export_kpi(
+    kpi: str,
+    machine_id: str,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    file_format: str = fapi.Query("arrow", alias="format", regex="^(arrow|parquet)$"),
+    field: typing.List[str] = fapi.Query([]),
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+):
+    """Export raw KPI documents as an Arrow IPC stream or a Parquet file, streamed page by page"""
+    if kpi_export.pa is None:
+        raise fapi.HTTPException(status_code=501, detail="pyarrow is not installed")
+    check_machine_access(token, machine_id)
+    start, end = time_range(start, end)
+    query, parameters = kpi_query(field, [machine_id], start, end)
+
+    container = kpi_container(kpi)
+    try:
+        # by_page follows the Cosmos continuation token, one page in memory at a time
+        pages = get_cosmos_container_client(container).query_items(
+            query=query,
+            parameters=parameters,
+            max_item_count=kpi_export.EXPORT_PAGE_SIZE,
+            partition_key=machine_id,
+        ).by_page()
+        chunks = kpi_export.iter_export(pages, file_format)
+
+        # the first page is read before responding, so query errors are still error responses
+        first = await run_in_threadpool(next, chunks, b"")
+    except Exception:
+        raise fapi.HTTPException(
+            status_code=503, detail="KPI data is unavailable, try again later", headers={"Retry-After": "30"}
+        )
+    filename = "{}_{}_{:%Y%m%dT%H%M%S}_{:%Y%m%dT%H%M%S}.{}".format(
+        kpi, machine_id, start, end, file_format
+    )
+    return StreamingResponse(
+        itertools.chain([first], chunks),
+        media_type=kpi_export.MEDIA_TYPES[file_format],
+        headers={"Content-Disposition": 'attachment; filename="{}"'.format(filename)},
+    )
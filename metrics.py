@@ -0,0 +1,19 @@
+import fastapi as fapi
+from fastapi import APIRouter
+
+from utils import metrics
+
+router = APIRouter()
+
+
+@router.get(
+    "/metrics",
+    tags=["metrics"],
+    include_in_schema=False,
+)
+async def get_metrics():
+    """Prometheus metrics: request phase timings, Salesforce calls, token cache and DB pool waits"""
+    body, content_type = metrics.render_latest()
+    if not body:
+        raise fapi.HTTPException(status_code=501, detail="prometheus_client is not installed")
+    return fapi.Response(content=body, media_type=content_type)
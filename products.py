@@ -0,0 +1,68 @@
+import typing
+import fastapi as fapi
+from fastapi import APIRouter
+import schemas
+from enums import SecurityScope
+
+from utils import (
+    auth,
+)
+from utils.catalog import catalog
+
+router = APIRouter()
+
+
+def _parse_attributes(attribute: typing.List[str]) -> dict:
+    attributes = {}
+    for item in attribute:
+        key, sep, value = item.partition(":")
+        if not sep:
+            raise fapi.HTTPException(status_code=422, detail="attribute filters must look like 'Family:Spares'")
+        attributes[key] = value
+    return attributes
+
+
+@router.get(
+    "/products",
+    tags=["products"],
+)
+async def search_products(
+    q: str = "",
+    family: typing.Optional[str] = None,
+    attribute: typing.List[str] = fapi.Query([]),
+    pricebook_id: typing.Optional[str] = None,
+    limit: int = fapi.Query(50, ge=1, le=500),
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+):
+    """Search the product catalog by code or name prefix, with attribute filters"""
+    attributes = _parse_attributes(attribute)
+    if family is not None:
+        attributes["Family"] = family
+
+    index = catalog.index
+    products = index.search(prefix=q, attributes=attributes, limit=limit)
+    return {
+        "synced_at": index.synced_at,
+        "records": [
+            {**product, "prices": index.prices(product["product_code"], pricebook_id)}
+            for product in products
+        ],
+    }
+
+
+@router.get(
+    "/products/{product_code}",
+    tags=["products"],
+)
+async def get_product(
+    product_code: str,
+    pricebook_id: typing.Optional[str] = None,
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+):
+    """Get a product and its pricebook entries by ProductCode"""
+    index = catalog.index
+    product = index.products_by_code.get(product_code)
+    if product is None:
+        raise fapi.HTTPException(status_code=404, detail="Product not found")
+
+    return {**product, "prices": index.prices(product_code, pricebook_id)}
@@ -0,0 +1,29 @@
+import os
+import fastapi as fapi
+from fastapi import APIRouter
+from fastapi.responses import FileResponse
+import schemas
+from enums import SecurityScope
+
+from utils import (
+    auth,
+    profiling,
+)
+
+router = APIRouter()
+
+
+@router.get(
+    "/profiles/{profile_id}",
+    tags=["profiles"],
+)
+async def get_profile(
+    profile_id: str,
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=[SecurityScope.admin]),
+):
+    """Download a request profile (speedscope format) recorded with the X-Profile header"""
+    path = profiling.profile_path(profile_id)
+    if path is None or not os.path.exists(path):
+        raise fapi.HTTPException(status_code=404, detail="Profile not found")
+
+    return FileResponse(path, media_type="application/json", filename=profile_id + ".speedscope.json")
@@ -1,21 +1,23 @@
 import fastapi as fapi
 from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
 import schemas
 from enums import SecurityScope
 
 
 from utils import (
     auth,
+    db,
 )
 
-from crud import salesforce_account
+from utils.account_index import account_index, can_see_organization, organization_names
 
 
 
 router = APIRouter()
 
 
-
 @router.get(
     "/salesforce_account/{org_name}",
     tags=["salesforce account"],
@@ -23,10 +25,30 @@ router = APIRouter()
 
 async def get_salesforce_account(
     org_name: str,
+    prefix: bool = False,
     token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+    db: Session = fapi.Depends(db.get_db),
 ):
     """Gets account associated to Organization Name"""
     
-    accounts = salesforce_account.get_salesforce_accounts(token=token, org_name=org_name)
+    # served from the synced org name -> Account index, prefix=true matches names starting with org_name.
+    # the index holds every Account, so users only see those of their own organizations
+    org_names = organization_names(token, db)
+    if prefix:
+        return account_index.prefix(org_name, org_names=org_names)
+    if not can_see_organization(token, org_name, db):
+        raise fapi.HTTPException(status_code=404, detail="Organization not found")
     #will return all of the results found
-    return accounts
+    return account_index.get(org_name)
+
+
+@router.delete(
+    "/salesforce_account/cache",
+    tags=["salesforce account"],
+    status_code=204,
+)
+async def invalidate_salesforce_account_cache(
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=[SecurityScope.admin]),
+):
+    """Resyncs the Organization Name -> Account index on every worker within a minute"""
+    await run_in_threadpool(account_index.request_sync)
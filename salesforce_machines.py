@@ -13,10 +13,17 @@ from utils import (
 )
 from settings import settings
 from exceptions.data_exception import DataException
-from crud import salesforce_machines
+from fastapi.concurrency import run_in_threadpool
+from utils import (
+    cache,
+    machine_sync,
+)
+from utils.cache import response_cache
 
 router = APIRouter()
 
+MACHINES_CACHE_SECONDS = 5 * 60
+
 
 
 @router.get(
@@ -27,9 +34,26 @@ async def get_salesforce_machines_by_org_id(
     org_id: str,
     token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
 ):
-    """Gets Machines (Assets) that belong to an Org ID"""   
-    
-    machines = salesforce_machines.get_salesforce_machines(token, org_id)
+    """Gets Machines (Assets) that belong to an Org ID"""
+    # the synced table holds every organization's Assets, so access is checked here
+    if not auth.has_organization(token, org_id):
+        raise fapi.HTTPException(status_code=404, detail="Organization not found")
+
+    # served from the background Asset sync; the same rows for every user allowed to see the org
+    async def load():
+        machines = await run_in_threadpool(machine_sync.get_machines, org_id)
+        if machines is None:
+            raise fapi.HTTPException(
+                status_code=503,
+                detail="The machine list is still being synced from Salesforce",
+                headers={"Retry-After": str(machine_sync.SYNC_INTERVAL_SECONDS)},
+            )
+        return machines
+
+    # invalidated whenever the Asset sync applies changes
+    machines = await response_cache.get_or_set(
+        cache.make_key("machines", org_id), load, MACHINES_CACHE_SECONDS, tags=[cache.MACHINES_TAG]
+    )
 
     # will return all of the results found 
     return machines
@@ -2,10 +2,10 @@ import typing
 
 
 import json
-import requests
 import collections
 import fastapi as fapi
 from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
 from datetime import datetime
 import schemas
 from schemas.sf_purchase_order import SFPurchaseOrder
@@ -13,130 +13,199 @@ from schemas.sf_purchase_order import SFPurchaseOrder
 from enums import SecurityScope
 
 from utils import (
+    admission,
     auth,
     salesforce,
-    salesforce_orders
+    salesforce_orders,
+    responses,
+    bulk_export,
+    cache,
+    idempotency,
+    soql
 )
+from utils.order_cache import order_cache, etag_matches
+from utils.cache import response_cache
 from settings import settings
 
 router = APIRouter()
 
+# order history only changes through our own checkout, which invalidates it
+ORDERS_CACHE_SECONDS = 60
+
 @router.get(
     "/salesforce_purchase_orders/me",
     tags=["salesforce order"],
     response_model=typing.List[SFPurchaseOrder]
 )
 async def get_salesforce_purchase_orders(
+    request: fapi.Request,
     token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
 ):
     """Get Orders by User"""
     sf_username = token.details.sf_username
     sf_user_id = token.details.sf_user_id
 
-    # get the credentials and set initial headers
-    sf = salesforce.prep_request(sf_username)
-    instance_url = sf["instance_url"]
-    headers = sf["headers"]
-
     # fetch purchase orders and corresponding order and order_items
     # TODO: do we want to add additional filters? such as only active orders?
-    query = (
-        "SELECT Id, Purchase_Order__r.Id, Purchase_Order__r.Name, Purchase_Order__r.UUID__c, Purchase_Order__r.CreatedDate, Purchase_Order__r.Purchase_Order_Number__c, Purchase_Order__r.Approval_Status__c, Purchase_Order__r.Total__c, (SELECT Id, UnitPrice, Quantity FROM OrderItems) FROM Order WHERE Purchase_Order__c != null AND OwnerId ="
-        + "'"
-        + sf_user_id
-        + "'"
+    query = soql.select(
+        "Order",
+        [
+            "Id", "Purchase_Order__r.Id", "Purchase_Order__r.Name", "Purchase_Order__r.UUID__c",
+            "Purchase_Order__r.CreatedDate", "Purchase_Order__r.Purchase_Order_Number__c",
+            "Purchase_Order__r.Approval_Status__c", "Purchase_Order__r.Total__c",
+            soql.select("OrderItems", ["Id", "UnitPrice", "Quantity"], depends_on=["OrderItem"]),
+        ],
+        where=[("Purchase_Order__c", "!=", None), ("OwnerId", "=", sf_user_id)],
+        depends_on=["Purchase_Order__c"],
     )
-    url = instance_url + "/services/data/v53.0/query/?q=" + query
-
-    purchase_orders_response = requests.get(url, headers=headers)
-    if purchase_orders_response.ok is not True:
-        raise fapi.HTTPException(
-            status_code=purchase_orders_response.status_code, detail=purchase_orders_response.json()
-        )
-    po_response = purchase_orders_response.json()
-    purchase_order_list: typing.Dict[str, SFPurchaseOrder] = {}
-    # iterate through list of POs and query for Order Items
-    for po in po_response["records"]:
-        po_obj = po["Purchase_Order__r"]
-        order_items_obj = po["OrderItems"]["records"]
-        sf_po = SFPurchaseOrder(
-            id=po_obj["Id"],
-            name=po_obj["Name"],
-            order_quote_id=po_obj["UUID__c"],
-            created_date=po_obj["CreatedDate"],
-            po_number=po_obj["Purchase_Order_Number__c"],
-            status=po_obj["Approval_Status__c"],
-            total=0.00 if po_obj["Total__c"] is None else float(po_obj["Total__c"])
-        )
-        if ( po_obj["Id"] not in purchase_order_list):
-            sf_po.quantity = sum(order_item["Quantity"] for order_item in order_items_obj)
-            purchase_order_list[po_obj["Id"]] = sf_po
-        else:
-            sf_po = purchase_order_list.get(po_obj["Id"])
-            sf_po.quantity += sum(order_item["Quantity"] for order_item in order_items_obj)
-    return list(purchase_order_list.values())
+
+    async def load():
+        async with admission.order_history.admit(sf_username):
+            # credentials are only resolved on a cache miss
+            sf = await run_in_threadpool(salesforce.prep_request, sf_username)
+            po_response = await run_in_threadpool(soql.run, sf["instance_url"], sf["headers"], query, sf_username)
+        purchase_order_list: typing.Dict[str, SFPurchaseOrder] = {}
+        # iterate through list of POs and query for Order Items
+        for po in po_response["records"]:
+            po_obj = po["Purchase_Order__r"]
+            order_items_obj = po["OrderItems"]["records"]
+            sf_po = SFPurchaseOrder(
+                id=po_obj["Id"],
+                name=po_obj["Name"],
+                order_quote_id=po_obj["UUID__c"],
+                created_date=po_obj["CreatedDate"],
+                po_number=po_obj["Purchase_Order_Number__c"],
+                status=po_obj["Approval_Status__c"],
+                total=0.00 if po_obj["Total__c"] is None else float(po_obj["Total__c"])
+            )
+            if ( po_obj["Id"] not in purchase_order_list):
+                sf_po.quantity = sum(order_item["Quantity"] for order_item in order_items_obj)
+                purchase_order_list[po_obj["Id"]] = sf_po
+            else:
+                sf_po = purchase_order_list.get(po_obj["Id"])
+                sf_po.quantity += sum(order_item["Quantity"] for order_item in order_items_obj)
+        return [po.dict() for po in purchase_order_list.values()]
+
+    body = await response_cache.get_or_set(
+        cache.make_key("purchase-orders", sf_username), load, ORDERS_CACHE_SECONDS, tags=[cache.orders_tag(sf_username)]
+    )
+    # the POs were validated when they were built, so skip the response_model pass
+    return responses.fast_response(request, body)
 
 @router.get(
     "/salesforce_orders/me",
     tags=["salesforce order"],
 )
 async def get_salesforce_orders(
+    request: fapi.Request,
     token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
 ):
     """Get Orders by User"""
     sf_username = token.details.sf_username
     sf_user_id = token.details.sf_user_id
 
-    # get the credentials and set initial headers
-    sf = salesforce.prep_request(sf_username)
-    instance_url = sf["instance_url"]
-    headers = sf["headers"]
-
     # fetch historical Orders and Order Items for a user
     # TODO: do we want to add additional filters? such as only active orders?
-    query = (
-        "SELECT Id, Status, EffectiveDate, PriceBook2Id, (SELECT Id, Product2.Id, Product2.Name, UnitPrice, Quantity FROM OrderItems) FROM Order WHERE OwnerId = "
-        + "'"
-        + sf_user_id
-        + "'"
+    query = soql.select(
+        "Order",
+        [
+            "Id", "Status", "EffectiveDate", "PriceBook2Id",
+            soql.select(
+                "OrderItems", ["Id", "Product2.Id", "Product2.Name", "UnitPrice", "Quantity"],
+                depends_on=["OrderItem"],
+            ),
+        ],
+        where=[("OwnerId", "=", sf_user_id)],
     )
-    url = instance_url + "/services/data/v53.0/query/?q=" + query
 
-    orders_response = requests.get(url, headers=headers)
-    if orders_response.ok is not True:
-        raise fapi.HTTPException(
-            status_code=orders_response.status_code, detail=orders_response.json()
-        )
+    async def load():
+        async with admission.order_history.admit(sf_username):
+            # credentials are only resolved on a cache miss
+            sf = await run_in_threadpool(salesforce.prep_request, sf_username)
+            return await run_in_threadpool(soql.run, sf["instance_url"], sf["headers"], query, sf_username)
+
+    body = await response_cache.get_or_set(
+        cache.make_key("orders", sf_username), load, ORDERS_CACHE_SECONDS, tags=[cache.orders_tag(sf_username)]
+    )
+    return responses.fast_response(request, body)
 
-    return orders_response.json()
+
+@router.get(
+    "/salesforce_purchase_orders/me/export",
+    tags=["salesforce order"],
+)
+async def export_salesforce_purchase_orders(
+    request: fapi.Request,
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+    sf: salesforce.SalesforceContext = fapi.Security(salesforce.get_salesforce_context, scopes=SecurityScope.default()),
+):
+    """Export the user's full Purchase Order history as CSV (one row per Order Item) via Bulk API 2.0"""
+    query = bulk_export.purchase_order_history_query(token.details.sf_user_id)
+    return await bulk_export.run_export(
+        sf, query, "purchase_orders.csv", limiter=admission.bulk_export, request=request
+    )
+
+
+@router.get(
+    "/salesforce_orders/me/export",
+    tags=["salesforce order"],
+)
+async def export_salesforce_orders(
+    request: fapi.Request,
+    token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
+    sf: salesforce.SalesforceContext = fapi.Security(salesforce.get_salesforce_context, scopes=SecurityScope.default()),
+):
+    """Export the user's full Order history as CSV (one row per Order Item) via Bulk API 2.0"""
+    query = bulk_export.order_history_query(token.details.sf_user_id)
+    return await bulk_export.run_export(sf, query, "orders.csv", limiter=admission.bulk_export, request=request)
 
 
 @router.get(
     "/salesforce_orders/me/{order_id}",
     tags=["salesforce order"],
 )
-async def get_salesforce_orders(
+async def get_salesforce_order(
     order_id: str,
+    request: fapi.Request,
     token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=SecurityScope.default()),
 ):
-    """Get Orders by User"""
+    """Get a specific Order, revalidating a cached copy with Salesforce when possible"""
     sf_username = token.details.sf_username
+    if_none_match = request.headers.get("if-none-match")
+
+    # recently validated orders are served without going back to Salesforce
+    cached = order_cache.get(sf_username, order_id)
+    if cached is None or not order_cache.is_fresh(cached):
+        # get the credentials and set initial headers
+        sf = salesforce.prep_request(sf_username)
+        instance_url = sf["instance_url"]
+        headers = {**sf["headers"], **order_cache.conditional_headers(cached)}
+
+        # fetch a specific order
+        url = instance_url + "/services/data/v30.0/commerce/sale/order/" + order_id
+
+        order_response = salesforce.http.get(url, headers=headers)
+        if order_response.status_code == 304 and cached is not None:
+            cached = order_cache.touch(cached)
+        elif order_response.ok is not True:
+            raise fapi.HTTPException(
+                status_code=order_response.status_code, detail=order_response.json()
+            )
+        else:
+            cached = order_cache.put(
+                sf_username,
+                order_id,
+                order_response.json(),
+                sf_etag=order_response.headers.get("ETag"),
+                last_modified=order_response.headers.get("Last-Modified"),
+            )
 
-    # get the credentials and set initial headers
-    sf = salesforce.prep_request(sf_username)
-    instance_url = sf["instance_url"]
-    headers = sf["headers"]
-
-    # fetch a specific order
-    url = instance_url + "/services/data/v30.0/commerce/sale/order/" + order_id
-
-    order_response = requests.get(url, headers=headers)
-    if order_response.ok is not True:
-        raise fapi.HTTPException(
-            status_code=order_response.status_code, detail=order_response.json()
-        )
+    # per user and revalidated on every use; the 304 repeats the 200's headers so caches keep them
+    headers = {"ETag": cached["etag"], "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, cached["etag"]):
+        return fapi.Response(status_code=304, headers={**headers, "Vary": "Accept-Encoding"})
 
-    return order_response.json()
+    return responses.fast_response(request, cached["body"], headers=headers)
 
 
 @router.post(
@@ -148,121 +217,115 @@ async def get_salesforce_orders(
 async def create_salesforce_order(
     account_id: str,
     cart_id: str,
+    http_response: fapi.Response,
+    idempotency_key: typing.Optional[str] = fapi.Header(None, alias=idempotency.HEADER, max_length=255),
     token: schemas.AuthorizedUser = fapi.Security(auth.get_secure_token_and_user, scopes=[SecurityScope.write]),
 ):
-    """Create an Order (quote) in Salesforce with 'Draft' status"""
+    """Create an Order (quote) in Salesforce with 'Draft' status, once per Idempotency-Key"""
     # TODO: map logged in user's plant to Salesforce Account ID, fetching plant/product/pricing data dynamically
     # currently requires you to pass the Account ID and Cart ID as a query parameter
     sf_username = token.details.sf_username
 
-    # get the credentials and set initial headers
-    sf = salesforce.prep_request(sf_username)
-    instance_url = sf["instance_url"]
-    headers = sf["headers"]
-
-    # fetch products in active cart
-    query = (
-        "SELECT Id, CartId, Name, Product2.ProductCode, SalesPrice, Quantity FROM CartItem WHERE CartId = "
-        + "'"
-        + cart_id
-        + "'"
-    )
-    url = instance_url + "/services/data/v53.0/query/?q=" + query
-
-    cart_items_query_response = requests.get(url, headers=headers)
-    if cart_items_query_response.ok is not True:
-        raise fapi.HTTPException(
-            status_code=cart_items_query_response.status_code, detail=cart_items_query_response.json()
-        )
-
-    cart_products = cart_items_query_response.json()
-    pricebook_map = collections.defaultdict(list)  # strucutre is {PB.id:[records]}
-    order_responses = {"results": []}
-
-    # iterate through list of products and query for PriceBookEntry IDs
-    for product in cart_products["records"]:
-        cart_item_id = product["Id"]
-        cart_item_name = product["Name"]
-        sku = product["Product2"]["ProductCode"]
-        price = product["SalesPrice"]
-        qty = product["Quantity"]
-
-        # TODO: refactor this to read from database, since PBEs should be stored
-        # TODO: re-think a more "unique" query to only return 1 item
-        query = (
-            "SELECT Id, PriceBook2.Id FROM PriceBookEntry WHERE UnitPrice = {0}".format(float(price))
-            + " AND Product2.ProductCode = "
-            + "'"
-            + sku
-            + "'"
-        )
-        url = instance_url + "/services/data/v53.0/query/?q=" + query
-
-        pb_query_response = requests.get(url, headers=headers)
-        if pb_query_response.ok is not True:
-            raise fapi.HTTPException(
-                status_code=pb_query_response.status_code,
-                detail=pb_query_response.json(),
-            )
-
-        body = pb_query_response.json()
-
-        pb_entry_id = body["records"][0]["Id"]
-        pricebook_id = body["records"][0]["Pricebook2"]["Id"]
-
-        record = {
-            "attributes": {"type": "OrderItem"},
-            "PricebookEntryId": pb_entry_id,
-            "quantity": qty,
-            "UnitPrice": price,
-        }
-        pricebook_map[pricebook_id].append(record)
-
-    # create an Order with products in Cart
-    url = instance_url + "/services/data/v53.0/commerce/sale/order"
-
-    for pricebook in pricebook_map:
-        payload = {
-            "order": [
-                {
-                    "attributes": {"type": "Order"},
-                    "EffectiveDate": datetime.today().strftime("%Y-%m-%d"),
-                    "Status": "Draft",
-                    # TODO: dynamic query of Plant to fetch billing city?
-                    "billingCity": "Chicago",
-                    "accountId": account_id,
-                    # TODO: dynamic query of PB
-                    "Pricebook2Id": pricebook,
-                    "OrderItems": {"records": pricebook_map[pricebook]},
-                }
-            ]
-        }
-
-        order_response = requests.post(
-            url, headers=headers, data=json.dumps(payload)
-        )
-        if order_response.ok is not True:
-            raise fapi.HTTPException(
-                status_code=order_response.status_code,
-                detail=order_response.json(),
-            )
-        else:
-            order_responses["results"].append(order_response.json())
-            # TODO: store order metadata in postgres
-
-    # if Order creation is a success, close the Cart
-    url = instance_url + "/services/data/v53.0/sobjects/WebCart/" + cart_id
-
-    payload = {"Status": "Closed"}
-
-    cart_update_response = requests.patch(
-        url, headers=headers, data=json.dumps(payload)
-    )
-    if cart_update_response.ok is not True:
-        raise fapi.HTTPException(
-            status_code=cart_update_response.status_code,
-            detail=cart_update_response.json(),
-        )
-
-    # return the metadata received from Salesforce
-    return order_responses
+    # a retry after a timeout gets the first attempt's orders instead of new ones
+    async with idempotency.once(
+        idempotency_key, token.details.email, "salesforce_order",
+        idempotency.fingerprint(account_id=account_id, cart_id=cart_id), http_response
+    ) as run:
+        if run.replayed:
+            return run.result
+
+        # one order creation at a time per user, and a bounded number per worker
+        async with admission.order_creation.admit(sf_username):
+            # the Salesforce calls are blocking, so they run in the threadpool while the slot is held;
+            # run inline they would finish before a second click could even be admitted
+            def create_orders() -> dict:
+                # get the credentials and set initial headers
+                sf = salesforce.prep_request(sf_username)
+                instance_url = sf["instance_url"]
+                headers = sf["headers"]
+
+                # fetch products in active cart
+                cart_products = {"records": salesforce_orders.get_cart_items(instance_url, headers, cart_id)}
+                pricebook_map = collections.defaultdict(list)  # strucutre is {PB.id:[records]}
+                order_responses = {"results": []}
+
+                # iterate through list of products and query for PriceBookEntry IDs
+                for product in cart_products["records"]:
+                    cart_item_id = product["Id"]
+                    cart_item_name = product["Name"]
+                    sku = product["Product2"]["ProductCode"]
+                    price = product["SalesPrice"]
+                    qty = product["Quantity"]
+
+                    # TODO: refactor this to read from database, since PBEs should be stored
+                    # TODO: re-think a more "unique" query to only return 1 item
+                    entry = salesforce_orders.find_pricebook_entry(instance_url, headers, sku, price, sf_username)
+
+                    pb_entry_id = entry["Id"]
+                    pricebook_id = entry["Pricebook2"]["Id"]
+
+                    record = {
+                        "attributes": {"type": "OrderItem"},
+                        "PricebookEntryId": pb_entry_id,
+                        "quantity": qty,
+                        "UnitPrice": price,
+                    }
+                    pricebook_map[pricebook_id].append(record)
+
+                # create an Order with products in Cart
+                url = instance_url + "/services/data/v53.0/commerce/sale/order"
+
+                # orders created before a later step fails are reported back, and never created twice
+                run.mark_written()
+                run.progress(order_responses)
+                for pricebook in pricebook_map:
+                    payload = {
+                        "order": [
+                            {
+                                "attributes": {"type": "Order"},
+                                "EffectiveDate": datetime.today().strftime("%Y-%m-%d"),
+                                "Status": "Draft",
+                                # TODO: dynamic query of Plant to fetch billing city?
+                                "billingCity": "Chicago",
+                                "accountId": account_id,
+                                # TODO: dynamic query of PB
+                                "Pricebook2Id": pricebook,
+                                "OrderItems": {"records": pricebook_map[pricebook]},
+                            }
+                        ]
+                    }
+
+                    order_response = salesforce.http.post(
+                        url, headers=headers, data=json.dumps(payload)
+                    )
+                    if order_response.ok is not True:
+                        raise fapi.HTTPException(
+                            status_code=order_response.status_code,
+                            detail=order_response.json(),
+                        )
+                    else:
+                        order_responses["results"].append(order_response.json())
+                        # TODO: store order metadata in postgres
+                soql.invalidate("Order", "OrderItem")
+
+                # if Order creation is a success, close the Cart
+                url = instance_url + "/services/data/v53.0/sobjects/WebCart/" + cart_id
+
+                payload = {"Status": "Closed"}
+
+                cart_update_response = salesforce.http.patch(
+                    url, headers=headers, data=json.dumps(payload)
+                )
+                if cart_update_response.ok is not True:
+                    raise fapi.HTTPException(
+                        status_code=cart_update_response.status_code,
+                        detail=cart_update_response.json(),
+                    )
+                soql.invalidate("WebCart", "CartItem")
+                salesforce_orders.remove_cart_from_mirror(cart_id)
+                response_cache.invalidate(cache.orders_tag(sf_username))
+
+                return order_responses
+
+            # return the metadata received from Salesforce
+            return run.store(await run_in_threadpool(create_orders))
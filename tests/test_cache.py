@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from utils import cache
+
+
+def memory_backend():
+    return cache.InMemoryCache()
+
+
+def redis_backend():
+    # a local stand-in for Redis, speaking redis-py's client API
+    fakeredis = pytest.importorskip("fakeredis")
+    return cache.RedisCache(client=fakeredis.FakeRedis())
+
+
+@pytest.fixture(params=[memory_backend, redis_backend], ids=["memory", "redis"])
+def backend(request):
+    return request.param()
+
+
+def test_set_get_and_delete(backend):
+    backend.set("a", b"1", ttl=60)
+    assert backend.get("a") == b"1"
+    backend.delete("a")
+    assert backend.get("a") is None
+
+
+def test_invalidate_tags_only_drops_tagged_keys(backend):
+    backend.set("cart:1", b"1", ttl=60, tags=["cart-user:alice"])
+    backend.set("cart:2", b"2", ttl=60, tags=["cart-user:bob"])
+    backend.invalidate_tags("cart-user:alice")
+    assert backend.get("cart:1") is None
+    assert backend.get("cart:2") == b"2"
+
+
+def test_lock_is_exclusive_until_released(backend):
+    assert backend.acquire_lock("k")
+    assert not backend.acquire_lock("k")
+    backend.release_lock("k")
+    assert backend.acquire_lock("k")
+
+
+def test_memory_backend_forgets_tags_of_removed_keys():
+    backend = cache.InMemoryCache()
+    backend.set("a", b"1", ttl=60, tags=["t"])
+    backend.set("b", b"2", ttl=-1, tags=["t", "u"])
+    backend.delete("a")
+    assert backend.get("b") is None
+    assert backend._tags == {} and backend._key_tags == {}
+
+
+def test_memory_backend_sweeps_and_bounds_entries():
+    backend = cache.InMemoryCache(max_entries=3)
+    backend.set("expired", b"0", ttl=-1, tags=["t"])
+    backend.acquire_lock("stale", ttl=-1)
+    backend._next_sweep = 0
+    backend.set("a", b"1", ttl=60)
+    assert "expired" not in backend._values and backend._tags == {} and backend._locks == {}
+
+    for key in ("b", "c", "d"):
+        backend.set(key, b"1", ttl=60)
+    assert backend.get("a") is None
+    assert [backend.get(key) for key in ("b", "c", "d")] == [b"1"] * 3
+
+
+def test_get_or_set_loads_once_under_concurrency(backend):
+    response_cache = cache.ResponseCache(backend)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"value": 42}
+
+    async def main():
+        return await asyncio.gather(*[
+            response_cache.get_or_set("popular", loader, ttl=60, tags=["t"]) for _ in range(5)
+        ])
+
+    assert asyncio.run(main()) == [{"value": 42}] * 5
+    assert len(calls) == 1
+
+    asyncio.run(response_cache.ainvalidate("t"))
+    assert response_cache.get("popular") is None
+
+
+def test_backend_errors_are_not_raised():
+    class Broken(cache.InMemoryCache):
+        def get(self, key):
+            raise ConnectionError("down")
+
+    assert cache.ResponseCache(Broken()).get("k") is None
@@ -0,0 +1,31 @@
+from utils import cart_reconciliation
+
+MIRROR = {
+    ("cart-1", "item-1"): ("acc-1", "prod-1", 1.0),
+    ("cart-1", "item-2"): ("acc-1", "prod-2", 2.0),
+    ("cart-2", "item-3"): ("acc-2", "prod-3", 1.0),
+}
+
+
+def test_diff_rows():
+    actual = {
+        ("cart-1", "item-1"): ("acc-1", "prod-1", 1.0),
+        # quantity changed in Salesforce
+        ("cart-1", "item-2"): ("acc-1", "prod-2", 5.0),
+        # added in Salesforce, e.g. by a buyer in the storefront
+        ("cart-3", "item-4"): ("acc-3", "prod-4", 1.0),
+    }
+    missing, stale, changed = cart_reconciliation.diff_rows(MIRROR, actual)
+    assert missing == {("cart-3", "item-4")}
+    assert stale == {("cart-2", "item-3")}
+    assert changed == {("cart-1", "item-2")}
+
+
+def test_diff_rows_in_sync():
+    assert cart_reconciliation.diff_rows(MIRROR, dict(MIRROR)) == (set(), set(), set())
+
+
+def test_diff_rows_empty_salesforce_marks_everything_stale():
+    missing, stale, changed = cart_reconciliation.diff_rows(MIRROR, {})
+    assert missing == changed == set()
+    assert stale == set(MIRROR)
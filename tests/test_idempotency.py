@@ -0,0 +1,104 @@
+import uuid
+import asyncio
+from datetime import datetime, timedelta
+
+import fastapi as fapi
+import pytest
+
+from utils import idempotency
+
+FINGERPRINT = idempotency.fingerprint(account_id="001", cart_id="0a6")
+NOW = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def record(status, age_seconds=0, fingerprint=FINGERPRINT):
+    at = NOW - timedelta(seconds=age_seconds)
+    return {"fingerprint": fingerprint, "status": status, "status_code": None, "response": None,
+            "created_at": at, "updated_at": at}
+
+
+@pytest.mark.parametrize("stored, expected", [
+    (None, "run"),
+    (record(idempotency.RUNNING), "busy"),
+    (record(idempotency.WRITING), "busy"),
+    (record(idempotency.RUNNING, idempotency.STALE_RUNNING_SECONDS + 1), "run"),
+    (record(idempotency.WRITING, idempotency.STALE_RUNNING_SECONDS + 1), "interrupted"),
+    (record(idempotency.SUCCEEDED), "replay"),
+    (record(idempotency.FAILED), "replay"),
+    (record(idempotency.SUCCEEDED, idempotency.KEY_TTL_SECONDS + 1), "run"),
+])
+def test_resolve(stored, expected):
+    assert idempotency.resolve(stored, FINGERPRINT, NOW) == expected
+
+
+def test_resolve_rejects_reused_key():
+    with pytest.raises(fapi.HTTPException) as error:
+        idempotency.resolve(record(idempotency.SUCCEEDED, fingerprint="other"), FINGERPRINT, NOW)
+    assert error.value.status_code == 422
+
+
+def test_fingerprint_ignores_argument_order():
+    assert idempotency.fingerprint(a=1, b="x") == idempotency.fingerprint(b="x", a=1)
+    assert idempotency.fingerprint(a=1) != idempotency.fingerprint(a=2)
+
+
+class Counter:
+    def __init__(self):
+        self.calls = 0
+
+
+async def attempt(store, key, counter, fail_before_write=False, fail_after_write=False, partial=None):
+    async with idempotency.once(key, "user@example.com", "test", FINGERPRINT, store=store) as run:
+        if run.replayed:
+            return run.result
+        if fail_before_write:
+            raise fapi.HTTPException(status_code=503, detail="salesforce unavailable")
+        run.mark_written()
+        counter.calls += 1
+        if partial is not None:
+            run.progress(partial)
+        if fail_after_write:
+            raise fapi.HTTPException(status_code=502, detail="second order failed")
+        return run.store({"call": counter.calls})
+
+
+def test_success_is_replayed_without_running_again():
+    store, counter, key = idempotency.InMemoryIdempotencyStore(), Counter(), str(uuid.uuid4())
+    first = asyncio.run(attempt(store, key, counter))
+    second = asyncio.run(attempt(store, key, counter))
+    assert first == second == {"call": 1}
+    assert counter.calls == 1
+
+
+def test_failure_before_write_releases_the_key():
+    store, counter, key = idempotency.InMemoryIdempotencyStore(), Counter(), str(uuid.uuid4())
+    with pytest.raises(fapi.HTTPException):
+        asyncio.run(attempt(store, key, counter, fail_before_write=True))
+    assert asyncio.run(attempt(store, key, counter)) == {"call": 1}
+
+
+def test_failure_after_write_is_replayed_with_partial_result():
+    store, counter, key = idempotency.InMemoryIdempotencyStore(), Counter(), str(uuid.uuid4())
+    with pytest.raises(fapi.HTTPException) as first:
+        asyncio.run(attempt(store, key, counter, fail_after_write=True, partial={"results": ["order 1"]}))
+    with pytest.raises(fapi.HTTPException) as retry:
+        asyncio.run(attempt(store, key, counter))
+    assert counter.calls == 1
+    assert first.value.status_code == retry.value.status_code == 502
+    assert retry.value.detail == {"error": "second order failed", "partial_result": {"results": ["order 1"]}}
+    assert retry.value.headers == {idempotency.REPLAYED_HEADER: "true"}
+
+
+def test_concurrent_attempt_is_busy():
+    store = idempotency.InMemoryIdempotencyStore()
+    store.claim("user@example.com", "test", "key", FINGERPRINT)
+    with pytest.raises(fapi.HTTPException) as error:
+        store.claim("user@example.com", "test", "key", FINGERPRINT)
+    assert error.value.status_code == 409
+
+
+def test_without_key_always_runs():
+    store, counter = idempotency.InMemoryIdempotencyStore(), Counter()
+    asyncio.run(attempt(store, None, counter))
+    asyncio.run(attempt(store, None, counter))
+    assert counter.calls == 2
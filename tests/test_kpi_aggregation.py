@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from utils import kpi_aggregation
+
+
+def test_to_arrays_sorts_and_fills_missing_values():
+    documents = [
+        {"timestamp": "2024-01-01T00:00:10Z", "speed": 2},
+        {"timestamp": "2024-01-01T00:00:00Z", "speed": 1, "temp": 20.5},
+        {"speed": 3},
+    ]
+    times, values = kpi_aggregation.to_arrays(documents, "timestamp", ["speed", "temp"])
+    assert times.tolist() == [1704067200.0, 1704067210.0]
+    assert values["speed"].tolist() == [1.0, 2.0]
+    assert values["temp"][0] == 20.5 and np.isnan(values["temp"][1])
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ([1704067200, 1704067210], [1704067200.0, 1704067210.0]),
+    ([1704067200000, 1704067210000], [1704067200.0, 1704067210.0]),
+    (["2024-01-01T00:00:00", "2024-01-01T01:00:00+01:00"], [1704067200.0, 1704067200.0]),
+    ([1704067200, "2024-01-01T00:00:10Z"], [1704067200.0, 1704067210.0]),
+    ([1704067200000, "2024-01-01T00:00:10"], [1704067200.0, 1704067210.0]),
+])
+def test_epoch_seconds(raw, expected):
+    assert kpi_aggregation._epoch_seconds(raw).tolist() == expected
+
+
+def test_unreadable_timestamps_are_dropped():
+    documents = [{"timestamp": "yesterday", "v": 1}, {"timestamp": 1704067200, "v": 2}]
+    times, values = kpi_aggregation.to_arrays(documents, "timestamp", ["v"])
+    assert times.tolist() == [1704067200.0]
+    assert values["v"].tolist() == [2.0]
+
+
+def test_bucket_aggregate():
+    times = np.array([0.0, 1.0, 2.0, 10.0, 11.0, 25.0])
+    values = {"v": np.array([1.0, np.nan, 3.0, 4.0, 6.0, np.nan])}
+    result = kpi_aggregation.bucket_aggregate(times, values, bucket_seconds=10, origin=0.0)
+
+    # [20, 30) holds only NaN values, so it is kept with NaN aggregates
+    assert result["time"].tolist() == [0.0, 10.0, 20.0]
+    field = result["fields"]["v"]
+    assert field["mean"].tolist()[:2] == [2.0, 5.0]
+    assert field["min"].tolist()[:2] == [1.0, 4.0]
+    assert field["max"].tolist()[:2] == [3.0, 6.0]
+    assert field["last"].tolist()[:2] == [3.0, 6.0]
+    assert all(np.isnan(field[agg][2]) for agg in ("mean", "min", "max", "last"))
+
+
+def test_bucket_aggregate_empty():
+    result = kpi_aggregation.bucket_aggregate(np.empty(0), {"v": np.empty(0)}, bucket_seconds=60)
+    assert result["time"].size == 0
+    assert result["fields"] == {"v": {}}
+
+
+def test_lttb_keeps_endpoints_and_peaks():
+    times = np.arange(100, dtype=np.float64)
+    column = np.zeros(100)
+    column[37] = 50.0
+    column[71] = -50.0
+    keep = kpi_aggregation.lttb(times, column, 10)
+
+    assert keep.size == 10
+    assert keep[0] == 0 and keep[-1] == 99
+    assert np.all(np.diff(keep) > 0)
+    assert 37 in keep and 71 in keep
+
+
+def test_lttb_drops_nan_and_returns_all_under_threshold():
+    column = np.array([1.0, np.nan, 3.0, 4.0])
+    assert kpi_aggregation.lttb(np.arange(4.0), column, 10).tolist() == [0, 2, 3]
+
+
+def test_json_helpers():
+    assert kpi_aggregation.to_json_list(np.array([1.5, np.nan])) == [1.5, None]
+    assert kpi_aggregation.to_epoch_ms(np.array([1.2346])) == [1235]
@@ -0,0 +1,63 @@
+import datetime
+import decimal
+
+import pytest
+
+from utils import soql
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, "null"),
+    (True, "true"),
+    (False, "false"),
+    (3, "3"),
+    (2.5, "2.5"),
+    (decimal.Decimal("10.00"), "10.00"),
+    ("abc", "'abc'"),
+    ("O'Brien", "'O\\'Brien'"),
+    ('say "hi"', "'say \\\"hi\\\"'"),
+    ("back\\slash", "'back\\\\slash'"),
+    ("a\\'b", "'a\\\\\\'b'"),
+    ("line\nbreak\r\ttab", "'line\\nbreak\\r\\ttab'"),
+    ("x' OR Name != '", "'x\\' OR Name != \\''"),
+    (["a", "b'c"], "('a', 'b\\'c')"),
+    (datetime.date(2024, 3, 5), "2024-03-05"),
+])
+def test_literal(value, expected):
+    assert soql.literal(value) == expected
+
+
+def test_literal_datetimes():
+    naive = datetime.datetime(2024, 3, 5, 6, 7, 8, 123456)
+    assert soql.literal(naive) == "2024-03-05T06:07:08Z"
+
+    utc = naive.replace(tzinfo=datetime.timezone.utc)
+    assert soql.literal(utc) == "2024-03-05T06:07:08+00:00"
+
+    offset = naive.replace(tzinfo=datetime.timezone(-datetime.timedelta(hours=5, minutes=30)))
+    assert soql.literal(offset) == "2024-03-05T06:07:08-05:30"
+
+
+def test_select_renders_conditions():
+    query = soql.select(
+        "Account",
+        ["Id", "Name", "Id"],
+        where=[("Name", "=", "O'Brien"), ("Industry", "in", ["A", "B"])],
+        order_by=["Name desc"],
+        limit=10,
+    )
+    assert query.text == (
+        "SELECT Id, Name FROM Account WHERE Name = 'O\\'Brien' AND Industry IN ('A', 'B') "
+        "ORDER BY Name DESC LIMIT 10"
+    )
+    assert query.sobjects == {"Account"}
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"fields": ["Id; DELETE"]},
+    {"fields": ["Id"], "where": [("Name", "= 'x' OR", "y")]},
+    {"fields": ["Id"], "order_by": ["Name DESC NULLS"]},
+])
+def test_select_rejects_injection(kwargs):
+    with pytest.raises(ValueError):
+        soql.select("Account", **kwargs)
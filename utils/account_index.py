@@ -0,0 +1,194 @@
+import time
+import uuid
+import bisect
+import asyncio
+import logging
+import threading
+import typing
+
+import fastapi as fapi
+from sqlalchemy.orm import Session
+
+import schemas
+from models import Organization as OrganizationModel
+from utils import salesforce
+from utils.cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+# the full sync runs on this period
+TTL_SECONDS = 60 * 60
+# until the first sync succeeds, it is retried this often
+RETRY_INTERVAL_SECONDS = 30
+# how often each worker checks whether a resync was requested
+CHECK_INTERVAL_SECONDS = 30
+# shared cache key bumped by `request_sync`, every worker resyncs when it changes
+GENERATION_KEY = "account-index:generation"
+GENERATION_TTL_SECONDS = 7 * 24 * 60 * 60
+ACCOUNT_FIELDS = ["Id", "Name", "AccountNumber", "ParentId", "BillingCity"]
+
+
+def _key(org_name: str) -> str:
+    return " ".join(org_name.lower().split())
+
+
+class AccountIndex:
+    """ Organization name -> Salesforce Account records, with exact and prefix lookup
+
+        Filled by a periodic sync of all Accounts with the admin client, so
+        every entry is the same whoever asked. Requests only read the last
+        sync and never log in to Salesforce; before the first sync lookups
+        fail fast with a 503. Callers restrict lookups to the user's
+        organizations (see `organization_names`) """
+
+    def __init__(self, ttl: int = TTL_SECONDS):
+        self.ttl = ttl
+        self._entries = None  # key -> records, None until the first sync
+        self._sorted_keys = []
+        self._lock = threading.Lock()
+        self._generation = None
+        self._synced_at = None
+        self.task = None
+
+    def _synced_entries(self) -> dict:
+        entries = self._entries
+        if entries is None:
+            raise fapi.HTTPException(
+                status_code=503,
+                detail="Salesforce accounts are not loaded yet",
+                headers={"Retry-After": str(RETRY_INTERVAL_SECONDS)},
+            )
+        return entries
+
+    @property
+    def loaded(self) -> bool:
+        return self._entries is not None
+
+    def get(self, org_name: str) -> list:
+        """ Accounts for an exact organization name, [] when the last sync has none """
+        return self._synced_entries().get(_key(org_name), [])
+
+    def prefix(
+        self,
+        org_name_prefix: str,
+        limit: int = 50,
+        org_names: typing.Optional[typing.Iterable[str]] = None
+    ) -> list:
+        """ Accounts of every indexed organization whose name starts with the prefix,
+            only among `org_names` when given """
+        with self._lock:
+            entries, sorted_keys = self._synced_entries(), self._sorted_keys
+        prefix = _key(org_name_prefix)
+        allowed = None if org_names is None else {_key(name) for name in org_names}
+        records = []
+        start = bisect.bisect_left(sorted_keys, prefix)
+        for key in sorted_keys[start:]:
+            if not key.startswith(prefix) or len(records) >= limit:
+                break
+            if allowed is None or key in allowed:
+                records.extend(entries[key])
+        return records[:limit]
+
+    def request_sync(self):
+        """ Make every worker resync within CHECK_INTERVAL_SECONDS
+
+            Goes through the shared response cache, so it reaches other workers
+            only when that cache is Redis """
+        response_cache.set(GENERATION_KEY, uuid.uuid4().hex, GENERATION_TTL_SECONDS)
+
+    def _sync_due(self) -> bool:
+        generation = response_cache.get(GENERATION_KEY)
+        due = (
+            self._entries is None
+            or generation != self._generation
+            or time.monotonic() - self._synced_at >= self.ttl
+        )
+        if due:
+            # read before syncing, so a request made during the sync triggers another one
+            self._generation = generation
+        return due
+
+    def sync(self):
+        """ Rebuild the index from every Account in Salesforce """
+        sf = salesforce.sf_client()
+        accounts = sf.query_all("SELECT {} FROM Account".format(", ".join(ACCOUNT_FIELDS)))["records"]
+        entries = {}
+        for account in accounts:
+            account.pop("attributes", None)
+            entries.setdefault(_key(account["Name"]), []).append(account)
+        with self._lock:
+            self._entries = entries
+            self._sorted_keys = sorted(entries)
+        self._synced_at = time.monotonic()
+        logger.info("Salesforce account index synced: {} accounts".format(len(accounts)))
+
+    async def start_account_sync(self):
+        self.task = asyncio.get_running_loop().create_task(self._sync_forever())
+
+    async def shutdown_account_sync(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _sync_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                # every TTL_SECONDS, when another worker requested it, and until the first sync succeeds
+                if await loop.run_in_executor(None, self._sync_due):
+                    await loop.run_in_executor(None, self.sync)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Salesforce account index sync failed: {}".format(e))
+            await asyncio.sleep(RETRY_INTERVAL_SECONDS if self._entries is None else CHECK_INTERVAL_SECONDS)
+
+
+# singleton
+account_index = AccountIndex()
+
+
+def organization_names(token: schemas.AuthorizedUser, db: Session) -> typing.Optional[typing.List[str]]:
+    """ Names of the user's organizations, None for "*" (all of them) """
+    if "*" in token.organizations:
+        return None
+    rows = db.query(OrganizationModel.name).filter(OrganizationModel.id.in_(token.organizations)).all()
+    return [row[0] for row in rows]
+
+
+def can_see_organization(token: schemas.AuthorizedUser, org_name: str, db: Session) -> bool:
+    names = organization_names(token, db)
+    return names is None or _key(org_name) in {_key(name) for name in names}
+
+
+def resolve_account_id(
+    account_id: typing.Optional[str],
+    token: schemas.AuthorizedUser,
+    db: Session
+) -> str:
+    """ Use the given Account ID if it maps to one of the user's organizations, or
+        map the user's organization to its Salesforce Account """
+    org_names = organization_names(token, db)
+    if org_names is None:
+        if account_id:
+            return account_id
+        # every organization maps to its own Account, so an admin has to pick one
+        raise fapi.HTTPException(status_code=422, detail="Pass the account_id to use")
+
+    account_ids = {
+        record["Id"]
+        for org_name in org_names
+        for record in account_index.get(org_name)
+    }
+    if account_id:
+        # routes read the Postgres mirror by account, without Salesforce's sharing checks
+        if account_id not in account_ids:
+            raise fapi.HTTPException(status_code=404, detail="Account not found")
+        return account_id
+    if len(account_ids) != 1:
+        raise fapi.HTTPException(
+            status_code=422,
+            detail="Could not map your organization to a single Salesforce Account, pass account_id",
+        )
+    return account_ids.pop()
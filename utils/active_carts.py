@@ -0,0 +1,71 @@
+import typing
+from datetime import datetime
+
+import fastapi as fapi
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+
+from utils import (
+    db as database,
+    salesforce,
+)
+from utils.sf_metadata import sf_metadata
+
+metadata = sa.MetaData()
+
+# the sf_carts mirror has no owner column, this records whose cart each active cart is
+sf_active_carts = sa.Table(
+    "sf_active_carts",
+    metadata,
+    sa.Column("sf_username", sa.String(255), primary_key=True),
+    sa.Column("sf_account_id", sa.String(18), primary_key=True),
+    sa.Column("sf_cart_id", sa.String(18), nullable=False, index=True),
+    sa.Column("updated_at", sa.DateTime, nullable=False, default=datetime.utcnow),
+)
+
+
+def create_tables():
+    sf_active_carts.create(database.engine, checkfirst=True)
+
+
+def remember(db, sf_username: str, account_id: str, cart_id: str):
+    """ Record the user's active cart for an account, as seen in a Salesforce response """
+    stmt = insert(sf_active_carts).values(
+        sf_username=sf_username, sf_account_id=account_id, sf_cart_id=cart_id, updated_at=datetime.utcnow()
+    )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["sf_username", "sf_account_id"],
+        set_={"sf_cart_id": stmt.excluded.sf_cart_id, "updated_at": stmt.excluded.updated_at},
+    ))
+    db.commit()
+
+
+def forget(db, cart_id: str):
+    """ Drop a closed cart """
+    db.execute(sf_active_carts.delete().where(sf_active_carts.c.sf_cart_id == cart_id))
+
+
+def cart_id_for(db, sf_username: str, account_id: str) -> typing.Optional[str]:
+    """ The user's active cart for an account, from Postgres; asks Salesforce once when unknown """
+    cart_id = db.execute(
+        sa.select(sf_active_carts.c.sf_cart_id)
+        .where(sf_active_carts.c.sf_username == sf_username)
+        .where(sf_active_carts.c.sf_account_id == account_id)
+    ).scalar()
+    if cart_id is not None:
+        return cart_id
+
+    sf = salesforce.prep_request(sf_username)
+    response = salesforce.http.get(
+        sf["instance_url"] + "/services/data/v53.0/commerce/webstores/" + sf_metadata.webstore_id
+        + "/carts/active?effectiveAccountId=" + account_id,
+        headers=sf["headers"],
+    )
+    if response.status_code == 404:
+        # no active cart yet
+        return None
+    if response.ok is not True:
+        raise fapi.HTTPException(status_code=response.status_code, detail=response.json())
+    cart_id = response.json()["cartId"]
+    remember(db, sf_username, account_id, cart_id)
+    return cart_id
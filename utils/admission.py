@@ -0,0 +1,105 @@
+import time
+import asyncio
+import logging
+import contextlib
+import typing
+
+import fastapi as fapi
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# order creation / checkout: dozens of Salesforce calls each, one at a time per user
+ORDER_CREATION_PER_USER = 1
+ORDER_CREATION_GLOBAL = 8
+ORDER_CREATION_QUEUE_SECONDS = 10
+# order history: one or two large SOQL queries or a bulk job each
+ORDER_HISTORY_PER_USER = 2
+ORDER_HISTORY_GLOBAL = 16
+ORDER_HISTORY_QUEUE_SECONDS = 5
+# bulk exports: held while Salesforce runs the job, which can take minutes
+BULK_EXPORT_PER_USER = 1
+BULK_EXPORT_GLOBAL = 8
+BULK_EXPORT_QUEUE_SECONDS = 5
+# waiters beyond global * this factor are shed immediately instead of queueing
+MAX_QUEUE_FACTOR = 4
+
+
+class AdmissionLimiter:
+    """ Bounds concurrent runs of an expensive operation, per user and per worker
+
+        A user already at their limit gets a 429 straight away, which is what a
+        repeated "place order" click needs. Otherwise the request queues for a
+        global slot for up to `queue_timeout` seconds and gets a 503 if none
+        frees up, so a saturated worker sheds load instead of piling up latency.
+        Both carry a Retry-After header. Limits apply per worker process """
+
+    def __init__(
+        self,
+        name: str,
+        per_user: int,
+        global_limit: int,
+        queue_timeout: float,
+        max_queue: typing.Optional[int] = None
+    ):
+        self.name = name
+        self.per_user = per_user
+        self.global_limit = global_limit
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue if max_queue is not None else global_limit * MAX_QUEUE_FACTOR
+        self._active = {}  # user key -> admitted or queued requests
+        self._waiting = 0
+        # created on first use so it binds to the running event loop
+        self._slots = None
+
+    def _reject(self, status_code: int, reason: str, retry_after: float):
+        metrics.admission_rejections.labels(self.name, reason).inc()
+        raise fapi.HTTPException(
+            status_code=status_code,
+            detail="Too many concurrent {} requests, retry later".format(self.name),
+            headers={"Retry-After": str(max(1, int(retry_after)))},
+        )
+
+    @contextlib.asynccontextmanager
+    async def admit(self, user_key: str):
+        """ Hold a slot for the duration of the block, or raise 429/503 """
+        if self._active.get(user_key, 0) >= self.per_user:
+            self._reject(429, "per_user", self.queue_timeout)
+        if self._waiting >= self.max_queue:
+            self._reject(503, "queue_full", self.queue_timeout)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.global_limit)
+
+        # counted while queued too, so duplicate clicks are rejected rather than queued
+        self._active[user_key] = self._active.get(user_key, 0) + 1
+        try:
+            start = time.perf_counter()
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._reject(503, "queue_timeout", self.queue_timeout)
+            finally:
+                self._waiting -= 1
+            metrics.record("admission_wait", time.perf_counter() - start)
+
+            try:
+                yield
+            finally:
+                self._slots.release()
+        finally:
+            self._active[user_key] -= 1
+            if not self._active[user_key]:
+                del self._active[user_key]
+
+
+order_creation = AdmissionLimiter(
+    "order_creation", ORDER_CREATION_PER_USER, ORDER_CREATION_GLOBAL, ORDER_CREATION_QUEUE_SECONDS
+)
+order_history = AdmissionLimiter(
+    "order_history", ORDER_HISTORY_PER_USER, ORDER_HISTORY_GLOBAL, ORDER_HISTORY_QUEUE_SECONDS
+)
+bulk_export = AdmissionLimiter(
+    "bulk_export", BULK_EXPORT_PER_USER, BULK_EXPORT_GLOBAL, BULK_EXPORT_QUEUE_SECONDS
+)
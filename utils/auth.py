@@ -14,7 +14,7 @@ except ImportError:
     from typing_extensions import Literal
 # 3rd party libraries
 import jwt
-import passlib.context
+import functools
 import fastapi as fapi
 import fastapi.security as fapis
 from cryptography.hazmat.primitives import serialization
@@ -43,19 +43,32 @@ from enums import SecurityScope
 
 # Utils
 import utils.db as db
+from utils import metrics
 
 # Settings
 from settings import settings
 
-from Crypto.Cipher import AES
 import base64
-from Cryptodome.Random import get_random_bytes
 
-pwd_context = passlib.context.CryptContext(
-    schemes=[settings.password_hashing_algorithm],
-    default=settings.password_hashing_algorithm,
-    deprecated="auto",
-)
+
+# passlib and the Crypto packages are only needed by the password login and the
+# Salesforce token encryption, so they are imported on first use
+@functools.lru_cache(maxsize=1)
+def get_pwd_context():
+    import passlib.context
+
+    return passlib.context.CryptContext(
+        schemes=[settings.password_hashing_algorithm],
+        default=settings.password_hashing_algorithm,
+        deprecated="auto",
+    )
+
+
+def __getattr__(name: str):
+    # `auth.pwd_context` is still available to existing callers
+    if name == "pwd_context":
+        return get_pwd_context()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 security_scopes = next(db.get_db()).query(SecurityScopeModel).all()
 scope_map = {}
@@ -149,11 +162,11 @@ class NotEnoughPermissionsException(Exception):
 
 
 def verify_password(plain_password: str, password: str):
-    return pwd_context.verify(plain_password, password)
+    return get_pwd_context().verify(plain_password, password)
 
 
 def get_password_hash(password: str):
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 
 def get_user(db: Session, email: str):
@@ -196,6 +209,9 @@ __key__ = b'\x1d7(\xfd\x86\xd8\xeaa\x8c_/\x96\x98\x87#\xa5\xfaj:\xb3\xa0C\x8e\x0
 
 
 def encrypt(raw):
+    from Crypto.Cipher import AES
+    from Cryptodome.Random import get_random_bytes
+
     BS = AES.block_size
     def pad(s): return s + (BS - len(s) % BS) * chr(BS - len(s) % BS)
     raw = base64.b64encode(pad(raw).encode('utf8'))
@@ -205,6 +221,8 @@ def encrypt(raw):
 
 
 def decrypt(enc):
+    from Crypto.Cipher import AES
+
     def unpad(s): return s[:-ord(s[-1:])]
     enc = base64.b64decode(enc)
     iv = enc[:AES.block_size]
@@ -324,11 +342,12 @@ async def get_secure_token_and_user(
         token: str = fapi.Depends(oauth2_scheme),
         db: Session = fapi.Depends(db.get_db),
 ) -> schemas.AuthorizedUser:
-    secured_token = await get_secured_token(security_scopes=security_scopes, token=token)
+    with metrics.phase("auth"):
+        secured_token = await get_secured_token(security_scopes=security_scopes, token=token)
+        user_model = get_user(db, secured_token.sub)
     credentials_exception = AuthException(
         detail="Could not validate credentials"
     )
-    user_model = get_user(db, secured_token.sub)
     if user_model is None:
         raise credentials_exception
     if user_model.disabled:
@@ -344,6 +363,11 @@ async def get_secure_token_and_user(
     return authorized_user
 
 
+def has_organization(token: schemas.AuthorizedUser, org_id) -> bool:
+    """ Whether the token grants access to an organization, "*" grants all of them """
+    return "*" in token.organizations or str(org_id) in {str(org) for org in token.organizations}
+
+
 async def get_user_resources(
     user: UserInDB, db: Session = fapi.Depends(db.get_db)
 ):
@@ -0,0 +1,200 @@
+import time
+import json
+import asyncio
+import logging
+import contextlib
+import typing
+
+import fastapi as fapi
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from utils import (
+    admission,
+    salesforce,
+    soql,
+)
+
+logger = logging.getLogger(__name__)
+
+BULK_API_VERSION = "v53.0"
+# records per results page; each page is streamed through before the next is requested
+RESULTS_PAGE_SIZE = 50000
+STREAM_CHUNK_SIZE = 64 * 1024
+POLL_INITIAL_SECONDS = 0.5
+POLL_MAX_SECONDS = 10
+JOB_TIMEOUT_SECONDS = 30 * 60
+
+# Bulk API 2.0 has no parent-to-child subqueries, so the exports are flat OrderItem rows
+# with their Order (and Purchase Order) fields
+def order_history_query(owner_id: str) -> str:
+    return soql.select(
+        "OrderItem",
+        [
+            "Id", "OrderId", "Order.Status", "Order.EffectiveDate", "Order.Pricebook2Id",
+            "Product2Id", "Product2.Name", "UnitPrice", "Quantity",
+        ],
+        where=[("Order.OwnerId", "=", owner_id)],
+    ).text
+
+
+def purchase_order_history_query(owner_id: str) -> str:
+    return soql.select(
+        "OrderItem",
+        [
+            "Id", "OrderId", "Order.Purchase_Order__r.Id", "Order.Purchase_Order__r.Name",
+            "Order.Purchase_Order__r.UUID__c", "Order.Purchase_Order__r.CreatedDate",
+            "Order.Purchase_Order__r.Purchase_Order_Number__c", "Order.Purchase_Order__r.Approval_Status__c",
+            "Order.Purchase_Order__r.Total__c", "UnitPrice", "Quantity",
+        ],
+        where=[("Order.Purchase_Order__c", "!=", None), ("Order.OwnerId", "=", owner_id)],
+    ).text
+
+
+def _jobs_url(sf: salesforce.SalesforceContext) -> str:
+    return sf.instance_url + "/services/data/" + BULK_API_VERSION + "/jobs/query"
+
+
+def _raise_for_status(response):
+    if response.ok is not True:
+        raise fapi.HTTPException(status_code=response.status_code, detail=response.json())
+
+
+def create_query_job(sf: salesforce.SalesforceContext, query: str) -> str:
+    """ Start a Bulk API 2.0 query job, returns the job id """
+    response = salesforce.http.post(
+        _jobs_url(sf),
+        headers=sf.headers,
+        data=json.dumps({
+            "operation": "query",
+            "query": query,
+            "contentType": "CSV",
+            "columnDelimiter": "COMMA",
+            "lineEnding": "LF",
+        }),
+    )
+    _raise_for_status(response)
+    return response.json()["id"]
+
+
+def get_job(sf: salesforce.SalesforceContext, job_id: str) -> dict:
+    response = salesforce.http.get(_jobs_url(sf) + "/" + job_id, headers=sf.headers)
+    _raise_for_status(response)
+    return response.json()
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def wait_for_job(
+    sf: salesforce.SalesforceContext,
+    job_id: str,
+    request: typing.Optional[fapi.Request] = None
+) -> dict:
+    """ Poll the job with backoff until Salesforce has finished it
+
+        Only the status calls use the threadpool, the waits in between are on
+        the event loop. Raises ClientDisconnected once `request`'s client is gone """
+    delay = POLL_INITIAL_SECONDS
+    deadline = time.monotonic() + JOB_TIMEOUT_SECONDS
+    while True:
+        job = await run_in_threadpool(get_job, sf, job_id)
+        if job["state"] == "JobComplete":
+            return job
+        if job["state"] in ("Failed", "Aborted"):
+            raise fapi.HTTPException(
+                status_code=502, detail="Bulk query job {} {}: {}".format(job_id, job["state"], job.get("errorMessage"))
+            )
+        if time.monotonic() > deadline:
+            raise fapi.HTTPException(status_code=504, detail="Bulk query job {} timed out".format(job_id))
+        await asyncio.sleep(delay)
+        if request is not None and await request.is_disconnected():
+            raise ClientDisconnected(job_id)
+        delay = min(delay * 2, POLL_MAX_SECONDS)
+
+
+def iter_results(sf: salesforce.SalesforceContext, job_id: str) -> typing.Iterator[bytes]:
+    """ Stream the CSV results of a completed job page by page, with a single header row """
+    locator = None
+    first_page = True
+    while True:
+        params = {"maxRecords": RESULTS_PAGE_SIZE}
+        if locator:
+            params["locator"] = locator
+        response = salesforce.http.get(
+            _jobs_url(sf) + "/" + job_id + "/results",
+            headers={**sf.headers, "Accept": "text/csv"},
+            params=params,
+            stream=True,
+        )
+        _raise_for_status(response)
+        try:
+            # every page repeats the header row, only pass it through once
+            skip_header = not first_page
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                if skip_header:
+                    newline = chunk.find(b"\n")
+                    if newline == -1:
+                        continue
+                    chunk = chunk[newline + 1:]
+                    skip_header = False
+                if chunk:
+                    yield chunk
+        finally:
+            response.close()
+        first_page = False
+
+        locator = response.headers.get("Sforce-Locator")
+        if not locator or locator == "null":
+            return
+
+
+def delete_job(sf: salesforce.SalesforceContext, job_id: str):
+    """ Results stay on Salesforce for 7 days otherwise """
+    try:
+        salesforce.http.delete(_jobs_url(sf) + "/" + job_id, headers=sf.headers)
+    except Exception as e:
+        logger.warning("Failure to delete bulk query job {}: {}".format(job_id, e))
+
+
+def stream_results(sf: salesforce.SalesforceContext, job_id: str) -> typing.Iterator[bytes]:
+    """ Stream the CSV of a completed job, deleting the job once the client has it """
+    try:
+        yield from iter_results(sf, job_id)
+    finally:
+        delete_job(sf, job_id)
+
+
+async def run_export(
+    sf: salesforce.SalesforceContext,
+    query: str,
+    filename: str,
+    limiter: typing.Optional[admission.AdmissionLimiter] = None,
+    request: typing.Optional[fapi.Request] = None
+) -> fapi.Response:
+    """ Run a query through Bulk API 2.0 and stream the CSV straight to the client
+
+        The job is created and awaited before the response starts, so failures
+        still surface as error responses rather than truncated downloads. An
+        admission `limiter` is held until the job has finished, bounding the
+        jobs each worker has outstanding. The job is deleted when it fails or
+        the client of `request` goes away before it finishes """
+    async with (limiter.admit(sf.sf_username) if limiter is not None else contextlib.nullcontext()):
+        job_id = await run_in_threadpool(create_query_job, sf, query)
+        try:
+            await wait_for_job(sf, job_id, request)
+        except ClientDisconnected:
+            await run_in_threadpool(delete_job, sf, job_id)
+            logger.info("Client left before bulk query job {} finished, job deleted".format(job_id))
+            # nobody reads this, it only ends the request
+            return fapi.Response(status_code=499)
+        except BaseException:
+            # also when the request is cancelled
+            await run_in_threadpool(delete_job, sf, job_id)
+            raise
+    return StreamingResponse(
+        stream_results(sf, job_id),
+        media_type="text/csv",
+        headers={"Content-Disposition": 'attachment; filename="{}"'.format(filename)},
+    )
@@ -0,0 +1,299 @@
+import abc
+import json
+import collections
+import time
+import asyncio
+import logging
+import threading
+import typing
+
+from settings import settings
+from utils import responses
+
+# redis is optional, the in-memory backend is used without it
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "sfcache:"
+# how long a loader may hold the stampede lock before others load anyway
+LOCK_TTL_SECONDS = 30
+LOCK_POLL_SECONDS = 0.05
+TAG_TTL_SECONDS = 24 * 60 * 60
+# the in-memory backend drops its oldest writes beyond this many keys
+MEMORY_MAX_ENTRIES = 10000
+# and clears out expired keys and locks at most this often, on a write
+MEMORY_SWEEP_SECONDS = 60
+
+
+class CacheBackend(abc.ABC):
+    """ Byte-value cache with TTLs, tag-based invalidation and a best-effort lock """
+
+    # whether calls wait on the network, in which case async callers run them in a thread
+    blocking = False
+
+    @abc.abstractmethod
+    def get(self, key: str) -> typing.Optional[bytes]:
+        pass
+
+    @abc.abstractmethod
+    def set(self, key: str, value: bytes, ttl: int, tags: typing.Iterable[str] = ()):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abc.abstractmethod
+    def invalidate_tags(self, *tags: str):
+        pass
+
+    @abc.abstractmethod
+    def acquire_lock(self, key: str, ttl: int = LOCK_TTL_SECONDS) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def release_lock(self, key: str):
+        pass
+
+
+class InMemoryCache(CacheBackend):
+    """ Process-local backend, for a single worker or when Redis is not configured
+
+        Bounded to `max_entries` keys, evicting the oldest writes first """
+
+    def __init__(self, max_entries: int = MEMORY_MAX_ENTRIES):
+        self._values = collections.OrderedDict()  # key -> (value, expires_at), oldest write first
+        self._tags = {}  # tag -> set of keys
+        self._key_tags = {}  # key -> set of tags
+        self._locks = {}  # key -> expires_at
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self._next_sweep = time.monotonic() + MEMORY_SWEEP_SECONDS
+
+    def _remove(self, key):
+        # callers hold self._lock
+        self._values.pop(key, None)
+        for tag in self._key_tags.pop(key, ()):
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def _sweep(self, now):
+        for key in [key for key, (_, expires_at) in self._values.items() if expires_at < now]:
+            self._remove(key)
+        for key in [key for key, expires_at in self._locks.items() if expires_at < now]:
+            del self._locks[key]
+        self._next_sweep = now + MEMORY_SWEEP_SECONDS
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                self._remove(key)
+                return None
+            return entry[0]
+
+    def set(self, key, value, ttl, tags=()):
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            # the previous value's tags no longer apply
+            self._remove(key)
+            self._values[key] = (value, now + ttl)
+            if tags:
+                self._key_tags[key] = set(tags)
+                for tag in tags:
+                    self._tags.setdefault(tag, set()).add(key)
+            while len(self._values) > self.max_entries:
+                self._remove(next(iter(self._values)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_tags(self, *tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+
+    def acquire_lock(self, key, ttl=LOCK_TTL_SECONDS):
+        now = time.monotonic()
+        with self._lock:
+            if self._locks.get(key, 0) > now:
+                return False
+            self._locks[key] = now + ttl
+            return True
+
+    def release_lock(self, key):
+        with self._lock:
+            self._locks.pop(key, None)
+
+
+class RedisCache(CacheBackend):
+    """ Backend shared by every worker, speaks the Redis protocol through redis-py
+
+        Tags are Redis sets of keys, kept for TAG_TTL_SECONDS after their last write
+        so they always outlive their keys; members that already expired are harmless """
+
+    blocking = True
+
+    def __init__(self, url: str = None, client=None):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("redis is not installed, `pip install redis` to use RedisCache")
+            client = redis.Redis.from_url(url)
+        # any redis-py compatible client, e.g. fakeredis in tests
+        self.client = client
+
+    def get(self, key):
+        return self.client.get(KEY_PREFIX + key)
+
+    def set(self, key, value, ttl, tags=()):
+        pipe = self.client.pipeline()
+        pipe.set(KEY_PREFIX + key, value, ex=ttl)
+        for tag in tags:
+            pipe.sadd(KEY_PREFIX + "tag:" + tag, key)
+            pipe.expire(KEY_PREFIX + "tag:" + tag, max(ttl, TAG_TTL_SECONDS))
+        pipe.execute()
+
+    def delete(self, key):
+        self.client.delete(KEY_PREFIX + key)
+
+    def invalidate_tags(self, *tags):
+        for tag in tags:
+            tag_key = KEY_PREFIX + "tag:" + tag
+            keys = self.client.smembers(tag_key)
+            pipe = self.client.pipeline()
+            for key in keys:
+                pipe.delete(KEY_PREFIX + key.decode("utf8"))
+            pipe.delete(tag_key)
+            pipe.execute()
+
+    def acquire_lock(self, key, ttl=LOCK_TTL_SECONDS):
+        return bool(self.client.set(KEY_PREFIX + "lock:" + key, b"1", nx=True, ex=ttl))
+
+    def release_lock(self, key):
+        self.client.delete(KEY_PREFIX + "lock:" + key)
+
+
+def make_key(*parts) -> str:
+    return ":".join(str(part) for part in parts)
+
+
+# tags shared by the GET routes and the write paths that invalidate them
+MACHINES_TAG = "machines"
+
+
+def cart_account_tag(account_id: str) -> str:
+    return make_key("cart", account_id)
+
+
+def cart_user_tag(sf_username: str) -> str:
+    return make_key("cart-user", sf_username)
+
+
+def orders_tag(sf_username: str) -> str:
+    return make_key("orders", sf_username)
+
+
+class ResponseCache:
+    """ JSON value cache for GET routes on top of a CacheBackend
+
+        `get_or_set` lets one caller per key (across workers) run the loader
+        while the others wait for its result, so an expired popular key does
+        not send a burst of identical calls to Salesforce """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+
+    def get(self, key: str):
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            # a cache outage must not take the routes down
+            logger.warning("Cache read failed for {}: {}".format(key, e))
+            return None
+        return None if value is None else json.loads(value)
+
+    def set(self, key: str, value, ttl: int, tags: typing.Iterable[str] = ()):
+        try:
+            self.backend.set(key, responses.dumps(value), ttl, tags)
+        except Exception as e:
+            logger.warning("Cache write failed for {}: {}".format(key, e))
+
+    async def _run(self, fn, *args):
+        # a network backend must not stall the event loop
+        if self.backend.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def get_or_set(
+        self,
+        key: str,
+        loader: typing.Callable[[], typing.Awaitable],
+        ttl: int,
+        tags: typing.Iterable[str] = ()
+    ):
+        value = await self._run(self.get, key)
+        if value is not None:
+            return value
+
+        deadline = time.monotonic() + LOCK_TTL_SECONDS
+        while not await self._run(self._try_lock, key):
+            await asyncio.sleep(LOCK_POLL_SECONDS)
+            value = await self._run(self.get, key)
+            if value is not None:
+                return value
+            if time.monotonic() > deadline:
+                # the lock holder is stuck, load without it
+                return await loader()
+
+        try:
+            value = await loader()
+            await self._run(self.set, key, value, ttl, tags)
+            return value
+        finally:
+            await self._run(self._release_lock, key)
+
+    def _try_lock(self, key: str) -> bool:
+        try:
+            return self.backend.acquire_lock(key)
+        except Exception:
+            return True
+
+    def _release_lock(self, key: str):
+        try:
+            self.backend.release_lock(key)
+        except Exception:
+            pass
+
+    def invalidate(self, *tags: str):
+        try:
+            self.backend.invalidate_tags(*tags)
+        except Exception as e:
+            logger.warning("Cache invalidation failed for {}: {}".format(tags, e))
+
+    async def ainvalidate(self, *tags: str):
+        """ `invalidate` for async routes, off the event loop when the backend is blocking """
+        await self._run(self.invalidate, *tags)
+
+
+def _default_backend() -> CacheBackend:
+    redis_url = getattr(settings, "redis_url", None)
+    if redis_url:
+        return RedisCache(redis_url)
+    return InMemoryCache()
+
+
+# singleton
+response_cache = ResponseCache(_default_backend())
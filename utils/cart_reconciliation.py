@@ -0,0 +1,186 @@
+import time
+import asyncio
+import logging
+import typing
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+
+from models import SfCarts
+from utils import (
+    cache,
+    db as database,
+    jobs,
+    salesforce,
+    soql,
+)
+from utils.cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL_SECONDS = 60 * 60
+WRITE_BATCH_SIZE = 1000
+
+ACTIVE_CART_ITEMS = soql.select(
+    "CartItem",
+    ["Id", "CartId", "Cart.AccountId", "Product2Id", "Quantity"],
+    # the mirror only holds product lines of open carts
+    where=[("Cart.Status", "=", "Active"), ("Type", "=", "Product")],
+)
+
+
+class _Timer:
+    def __init__(self):
+        self.timings = {}
+
+    def lap(self, name: str, start: float) -> float:
+        now = time.perf_counter()
+        self.timings[name] = round((now - start) * 1000, 1)
+        return now
+
+
+def _mirror_rows(db) -> typing.Dict[typing.Tuple[str, str], tuple]:
+    """ (cart id, cart item id) -> (account id, product id, quantity) for every mirrored row """
+    rows = db.query(
+        SfCarts.sf_cart_id, SfCarts.sf_cart_item_id, SfCarts.sf_account_id, SfCarts.sf_product_id, SfCarts.quantity
+    ).all()
+    return {(cart_id, item_id): (account_id, product_id, float(quantity))
+            for cart_id, item_id, account_id, product_id, quantity in rows}
+
+
+def _salesforce_rows() -> typing.Dict[typing.Tuple[str, str], tuple]:
+    """ Same shape as _mirror_rows, for every active CartItem in Salesforce, read page by page """
+    sf = salesforce.sf_client()
+    rows = {}
+    for record in sf.query_all_iter(ACTIVE_CART_ITEMS.text):
+        rows[(record["CartId"], record["Id"])] = (
+            (record.get("Cart") or {}).get("AccountId"), record["Product2Id"], float(record["Quantity"])
+        )
+    return rows
+
+
+def diff_rows(mirror: dict, actual: dict) -> typing.Tuple[set, set, set]:
+    """ (missing, stale, changed) keys of the mirror compared to Salesforce
+
+        missing are only in Salesforce, stale only in the mirror, changed in
+        both with a different account, product or quantity """
+    mirror_keys, actual_keys = mirror.keys(), actual.keys()
+    missing = actual_keys - mirror_keys
+    stale = mirror_keys - actual_keys
+    changed = {key for key in actual_keys & mirror_keys if actual[key] != mirror[key]}
+    return missing, stale, changed
+
+
+def reconcile_carts(dry_run: bool = False) -> dict:
+    """ Bring sf_carts in line with the active CartItems in Salesforce, returns counts and timings
+
+        The mirror is read before Salesforce, so rows the cart routes add while
+        this runs are never mistaken for stale ones """
+    timer = _Timer()
+    start = time.perf_counter()
+    db = next(database.get_db())
+    try:
+        mirror = _mirror_rows(db)
+        start = timer.lap("read_mirror", start)
+        actual = _salesforce_rows()
+        start = timer.lap("read_salesforce", start)
+
+        missing, stale, changed = diff_rows(mirror, actual)
+        start = timer.lap("diff", start)
+
+        if not dry_run:
+            upserts = [
+                {
+                    "sf_cart_id": cart_id,
+                    "sf_cart_item_id": item_id,
+                    "sf_account_id": actual[(cart_id, item_id)][0],
+                    "sf_product_id": actual[(cart_id, item_id)][1],
+                    "quantity": actual[(cart_id, item_id)][2],
+                }
+                for cart_id, item_id in missing | changed
+            ]
+            for offset in range(0, len(upserts), WRITE_BATCH_SIZE):
+                stmt = insert(SfCarts).values(upserts[offset:offset + WRITE_BATCH_SIZE])
+                # Salesforce is the source of truth, so quantities are set rather than added
+                db.execute(stmt.on_conflict_do_update(
+                    index_elements=["sf_cart_id", "sf_cart_item_id"],
+                    set_={
+                        "sf_account_id": stmt.excluded.sf_account_id,
+                        "sf_product_id": stmt.excluded.sf_product_id,
+                        "quantity": stmt.excluded.quantity,
+                    },
+                ))
+            stale_keys = list(stale)
+            for offset in range(0, len(stale_keys), WRITE_BATCH_SIZE):
+                db.query(SfCarts).filter(
+                    sa.tuple_(SfCarts.sf_cart_id, SfCarts.sf_cart_item_id).in_(stale_keys[offset:offset + WRITE_BATCH_SIZE])
+                ).delete(synchronize_session=False)
+            db.commit()
+            timer.lap("apply", start)
+
+            # cart summaries and cached carts of every touched account are out of date
+            accounts = {actual[key][0] for key in missing | changed} | {mirror[key][0] for key in stale | changed}
+            response_cache.invalidate(*[cache.cart_account_tag(account_id) for account_id in accounts if account_id])
+    finally:
+        db.close()
+
+    result = {
+        "salesforce_rows": len(actual),
+        "mirror_rows": len(mirror),
+        "inserted": len(missing),
+        "updated": len(changed),
+        "deleted": len(stale),
+        "dry_run": dry_run,
+        "timings": timer.timings,
+    }
+    logger.info("Cart mirror reconciled: {}".format(result))
+    return result
+
+
+def enqueue_reconcile_carts(owner: typing.Optional[str] = None, dry_run: bool = False) -> int:
+    """ Queue a reconciliation on the job workers; requests within the same minute share one job """
+    return jobs.enqueue(
+        "reconcile_carts",
+        {"dry_run": dry_run},
+        idempotency_key="reconcile_carts:{}:{:%Y%m%dT%H%M}".format("dry" if dry_run else "apply", datetime.utcnow()),
+        owner=owner,
+        max_attempts=1,
+    )
+
+
+class CartReconciler:
+    """ Queues a reconciliation every interval; the job key makes workers agree on one run """
+
+    def __init__(self, interval: int = RECONCILE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.task = None
+
+    async def start_cart_reconciliation(self):
+        self.task = asyncio.get_running_loop().create_task(self._enqueue_forever())
+
+    async def shutdown_cart_reconciliation(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _enqueue_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # one job per interval window, however many app workers run this loop
+                window = int(time.time() // self.interval)
+                await loop.run_in_executor(
+                    None, jobs.enqueue, "reconcile_carts", {"dry_run": False},
+                    "reconcile_carts:scheduled:{}".format(window), None, 1,
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Failure to queue cart reconciliation: {}".format(e))
+
+
+# singleton
+cart_reconciler = CartReconciler()
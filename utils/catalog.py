@@ -0,0 +1,296 @@
+import bisect
+import asyncio
+import logging
+import typing
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB, insert
+
+from utils import (
+    db as database,
+    salesforce,
+)
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL_SECONDS = 15 * 60
+UPSERT_BATCH_SIZE = 1000
+# Product2 fields exposed as filterable attributes
+PRODUCT_ATTRIBUTE_FIELDS = ["Family", "QuantityUnitOfMeasure", "StockKeepingUnit"]
+
+metadata = sa.MetaData()
+
+catalog_products = sa.Table(
+    "catalog_products",
+    metadata,
+    sa.Column("id", sa.String(18), primary_key=True),
+    sa.Column("product_code", sa.String(255), nullable=True, index=True),
+    sa.Column("name", sa.String(255), nullable=False),
+    sa.Column("description", sa.Text, nullable=True),
+    sa.Column("is_active", sa.Boolean, nullable=False),
+    sa.Column("attributes", JSONB, nullable=False, default=dict),
+    sa.Column("last_modified", sa.DateTime, nullable=True),    # start of the sync that last saw the record in Salesforce
+    sa.Column("synced_at", sa.DateTime, nullable=True, index=True),
+)
+
+catalog_pricebook_entries = sa.Table(
+    "catalog_pricebook_entries",
+    metadata,
+    sa.Column("id", sa.String(18), primary_key=True),
+    sa.Column("pricebook_id", sa.String(18), nullable=False, index=True),
+    sa.Column("product_id", sa.String(18), nullable=False),
+    sa.Column("product_code", sa.String(255), nullable=True, index=True),
+    sa.Column("unit_price", sa.Numeric(18, 2), nullable=False),
+    sa.Column("is_active", sa.Boolean, nullable=False),
+    sa.Column("last_modified", sa.DateTime, nullable=True),    # start of the sync that last saw the record in Salesforce
+    sa.Column("synced_at", sa.DateTime, nullable=True, index=True),
+)
+
+
+def _cents(price) -> int:
+    return int(round(float(price) * 100))
+
+
+def _parse_sf_datetime(value: typing.Optional[str]) -> typing.Optional[datetime]:
+    if not value:
+        return None
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+class CatalogIndex:
+    """ Immutable in-memory view of Product2 and PricebookEntry
+
+        Built once per sync and swapped in whole, so readers never see a half
+        updated index and lookups need no locking """
+
+    def __init__(self, products: typing.List[dict], entries: typing.List[dict]):
+        self.products_by_id = {p["id"]: p for p in products}
+        self.products_by_code = {p["product_code"]: p for p in products if p["product_code"]}
+        # sorted (lowercased key, product id) pairs for prefix search on code and name
+        self.prefix_keys = sorted(
+            [(p["product_code"].lower(), p["id"]) for p in products if p["product_code"]]
+            + [(p["name"].lower(), p["id"]) for p in products]
+        )
+        self.entries_by_code = {}
+        self.entries_by_price = {}
+        for entry in entries:
+            if not entry["is_active"]:
+                continue
+            self.entries_by_code.setdefault(entry["product_code"], []).append(entry)
+            self.entries_by_price.setdefault((entry["product_code"], _cents(entry["unit_price"])), []).append(entry)
+        self.synced_at = datetime.utcnow()
+
+    def __len__(self):
+        return len(self.products_by_id)
+
+    def search(
+        self,
+        prefix: str = "",
+        attributes: typing.Optional[dict] = None,
+        active_only: bool = True,
+        limit: int = 50
+    ) -> typing.List[dict]:
+        """ Products whose code or name starts with `prefix`, matching every attribute filter """
+        prefix = prefix.lower()
+        attributes = attributes or {}
+        results, seen = [], set()
+        start = bisect.bisect_left(self.prefix_keys, (prefix, ""))
+        for key, product_id in self.prefix_keys[start:]:
+            if not key.startswith(prefix) or len(results) >= limit:
+                break
+            if product_id in seen:
+                continue
+            seen.add(product_id)
+            product = self.products_by_id[product_id]
+            if active_only and not product["is_active"]:
+                continue
+            if any(product["attributes"].get(k) != v for k, v in attributes.items()):
+                continue
+            results.append(product)
+        return results
+
+    def prices(self, product_code: str, pricebook_id: typing.Optional[str] = None) -> typing.List[dict]:
+        entries = self.entries_by_code.get(product_code, [])
+        if pricebook_id is not None:
+            entries = [e for e in entries if e["pricebook_id"] == pricebook_id]
+        return entries
+
+    def find_entry(
+        self,
+        product_code: str,
+        unit_price,
+        preferred_pricebook_ids: typing.Sequence[str] = ()
+    ) -> typing.Optional[dict]:
+        """ PricebookEntry for a SKU at a given price, as checkout resolves cart items
+
+            Entries in `preferred_pricebook_ids` (the webstore's pricebooks) win when
+            the same SKU and price exist in several pricebooks """
+        entries = self.entries_by_price.get((product_code, _cents(unit_price)))
+        if not entries:
+            return None
+        for entry in entries:
+            if entry["pricebook_id"] in preferred_pricebook_ids:
+                return entry
+        return entries[0]
+
+
+def _product_row(record: dict) -> dict:
+    return {
+        "id": record["Id"],
+        "product_code": record.get("ProductCode"),
+        "name": record["Name"],
+        "description": record.get("Description"),
+        "is_active": bool(record.get("IsActive")),
+        "attributes": {field: record.get(field) for field in PRODUCT_ATTRIBUTE_FIELDS if record.get(field) is not None},
+        "last_modified": _parse_sf_datetime(record.get("LastModifiedDate")),
+    }
+
+
+def _entry_row(record: dict) -> dict:
+    return {
+        "id": record["Id"],
+        "pricebook_id": record["Pricebook2Id"],
+        "product_id": record["Product2Id"],
+        "product_code": record.get("ProductCode"),
+        "unit_price": record["UnitPrice"],
+        "is_active": bool(record.get("IsActive")),
+        "last_modified": _parse_sf_datetime(record.get("LastModifiedDate")),
+    }
+
+
+def _upsert(db, table: sa.Table, rows: typing.List[dict]):
+    for offset in range(0, len(rows), UPSERT_BATCH_SIZE):
+        stmt = insert(table).values(rows[offset:offset + UPSERT_BATCH_SIZE])
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={c.name: stmt.excluded[c.name] for c in table.columns if c.name != "id"},
+        ))
+
+
+def _serialize(row) -> dict:
+    row = dict(row)
+    if "unit_price" in row:
+        row["unit_price"] = float(row["unit_price"])
+    return row
+
+
+def create_tables():
+    metadata.create_all(database.engine, checkfirst=True)
+    # copies created before synced_at existed
+    with database.engine.begin() as connection:
+        for table in (catalog_products, catalog_pricebook_entries):
+            connection.execute(sa.text("ALTER TABLE {} ADD COLUMN IF NOT EXISTS synced_at TIMESTAMP".format(table.name)))
+            connection.execute(sa.text(
+                "CREATE INDEX IF NOT EXISTS ix_{0}_synced_at ON {0} (synced_at)".format(table.name)
+            ))
+
+
+def load_index() -> CatalogIndex:
+    """ Build the index from the Postgres copy """
+    db = next(database.get_db())
+    try:
+        products = [_serialize(r) for r in db.execute(sa.select(catalog_products)).mappings()]
+        entries = [_serialize(r) for r in db.execute(sa.select(catalog_pricebook_entries)).mappings()]
+        return CatalogIndex(products, entries)
+    finally:
+        db.close()
+
+
+def _complete(result: dict) -> bool:
+    """ Whether a query_all result holds every matching record """
+    return bool(result["records"]) and len(result["records"]) == result["totalSize"]
+
+
+def _delete_unseen(db, table: sa.Table, synced_at: datetime):
+    # records deleted in Salesforce were not stamped by this sync
+    db.execute(table.delete().where(sa.or_(table.c.synced_at < synced_at, table.c.synced_at.is_(None))))
+
+
+def sync_from_salesforce() -> CatalogIndex:
+    """ Pull Product2 and PricebookEntry from Salesforce into Postgres, return the new index
+
+        Rows are stamped with the sync's start time and only older rows are
+        deleted, and only when Salesforce returned a complete, non-empty
+        result, so a failed or truncated read never empties the copy """
+    synced_at = datetime.utcnow()
+    sf = salesforce.sf_client()
+    products = sf.query_all(
+        "SELECT Id, ProductCode, Name, Description, IsActive, LastModifiedDate, "
+        + ", ".join(PRODUCT_ATTRIBUTE_FIELDS)
+        + " FROM Product2"
+    )
+    entries = sf.query_all(
+        "SELECT Id, Pricebook2Id, Product2Id, ProductCode, UnitPrice, IsActive, LastModifiedDate FROM PricebookEntry"
+    )
+    if not _complete(products):
+        raise RuntimeError("Salesforce returned {} of {} products, keeping the current catalog".format(
+            len(products["records"]), products["totalSize"]
+        ))
+
+    product_rows = [{**_product_row(r), "synced_at": synced_at} for r in products["records"]]
+    entry_rows = [{**_entry_row(r), "synced_at": synced_at} for r in entries["records"]]
+
+    db = next(database.get_db())
+    try:
+        _upsert(db, catalog_products, product_rows)
+        _upsert(db, catalog_pricebook_entries, entry_rows)
+        _delete_unseen(db, catalog_products, synced_at)
+        if _complete(entries):
+            _delete_unseen(db, catalog_pricebook_entries, synced_at)
+        else:
+            logger.warning("Salesforce returned {} of {} pricebook entries, none deleted".format(
+                len(entries["records"]), entries["totalSize"]
+            ))
+        db.commit()
+    finally:
+        db.close()
+
+    if not _complete(entries):
+        # the copy still holds the entries this sync did not see
+        return load_index()
+    return CatalogIndex(
+        product_rows,
+        [{**row, "unit_price": float(row["unit_price"])} for row in entry_rows],
+    )
+
+
+class Catalog:
+    """ Holds the current CatalogIndex and keeps it in sync in the background """
+
+    def __init__(self, interval: int = SYNC_INTERVAL_SECONDS):
+        self.interval = interval
+        self.index = CatalogIndex([], [])
+        self.task = None
+
+    def refresh(self):
+        self.index = sync_from_salesforce()
+        logger.info("Product catalog synced: {} products".format(len(self.index)))
+
+    async def start_catalog_sync(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, create_tables)
+        # serve the last persisted copy right away, Salesforce catches up in the background
+        self.index = await loop.run_in_executor(None, load_index)
+        self.task = loop.create_task(self._sync_forever())
+
+    async def shutdown_catalog_sync(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _sync_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Product catalog sync failed: {}".format(e))
+            await asyncio.sleep(self.interval)
+
+
+# singleton
+catalog = Catalog()
@@ -0,0 +1,240 @@
+import time
+import asyncio
+import logging
+import typing
+import contextlib
+from datetime import datetime, timedelta
+
+import fastapi as fapi
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB, insert
+
+import schemas
+from schemas import order_quote
+from utils import (
+    admission,
+    cache,
+    db as database,
+    salesforce,
+    salesforce_orders,
+)
+from utils.cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+# a run still marked "running" after this long is assumed dead and may be retried
+STALE_RUNNING_SECONDS = 300
+
+metadata = sa.MetaData()
+
+# one row per (user, client idempotency key); `state` holds the output of every
+# completed step so a retry resumes where the previous attempt stopped
+checkout_runs = sa.Table(
+    "checkout_runs",
+    metadata,
+    sa.Column("owner", sa.String(255), primary_key=True),
+    sa.Column("idempotency_key", sa.String(255), primary_key=True),
+    sa.Column("status", sa.String(16), nullable=False),
+    sa.Column("state", JSONB, nullable=False, default=dict),
+    sa.Column("timings", JSONB, nullable=False, default=dict),
+    sa.Column("last_error", sa.Text, nullable=True),
+    sa.Column("created_at", sa.DateTime, nullable=False, default=datetime.utcnow),
+    sa.Column("updated_at", sa.DateTime, nullable=False, default=datetime.utcnow),
+)
+
+
+def create_tables():
+    checkout_runs.create(database.engine, checkfirst=True)
+
+
+def _claim_run(owner: str, idempotency_key: str) -> typing.Optional[dict]:
+    """ Mark the run as running and return its saved state, or None if another
+        attempt with the same key is still in flight """
+    db = next(database.get_db())
+    try:
+        now = datetime.utcnow()
+        db.execute(
+            insert(checkout_runs).values(
+                owner=owner,
+                idempotency_key=idempotency_key,
+                status="new",
+                state={},
+                timings={},
+            ).on_conflict_do_nothing()
+        )
+        row = db.execute(
+            checkout_runs.update()
+            .where(checkout_runs.c.owner == owner)
+            .where(checkout_runs.c.idempotency_key == idempotency_key)
+            .where(sa.or_(
+                checkout_runs.c.status != "running",
+                checkout_runs.c.updated_at < now - timedelta(seconds=STALE_RUNNING_SECONDS),
+            ))
+            .values(
+                # completed runs stay completed, they are only read back
+                status=sa.case((checkout_runs.c.status == "succeeded", "succeeded"), else_="running"),
+                updated_at=now,
+            )
+            .returning(checkout_runs.c.status, checkout_runs.c.state, checkout_runs.c.timings)
+        ).mappings().first()
+        db.commit()
+        return dict(row) if row is not None else None
+    finally:
+        db.close()
+
+
+def _save_run(owner: str, idempotency_key: str, **values):
+    db = next(database.get_db())
+    try:
+        db.execute(
+            checkout_runs.update()
+            .where(checkout_runs.c.owner == owner)
+            .where(checkout_runs.c.idempotency_key == idempotency_key)
+            .values(updated_at=datetime.utcnow(), **values)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+class _StepTimer:
+    """ Records wall-clock milliseconds per checkout step """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+
+async def run_checkout(
+        idempotency_key: str,
+        current_user: schemas.UserInDB,
+        account_id: str,
+        cart_id: str,
+        purchase_data: order_quote.OrderInput,
+        po_uuid: str,
+        owner_id: str,
+        approver_email: str,
+        approver_decision_date: datetime.date,
+        purchase_order_number: str,
+        pdf_byte_string: str,
+        is_urgent: bool
+) -> dict:
+    """ Run the order flow for a cart, keyed by a client-supplied idempotency key
+
+        The PO is created while the cart items and their pricebook entries are
+        resolved. Orders are then created and the cart closed; the PDF
+        attachment and PO approval are queued as background jobs. Each completed
+        step is saved, so retrying with the same key never repeats a step """
+    # one checkout at a time per user, and a bounded number per worker
+    async with admission.order_creation.admit(current_user.sf_username):
+        owner = current_user.email
+        run = await asyncio.to_thread(_claim_run, owner, idempotency_key)
+        if run is None:
+            raise fapi.HTTPException(
+                status_code=409, detail="A checkout with this idempotency key is already in progress"
+            )
+        state = run["state"]
+        if run["status"] == "succeeded":
+            return {**state["result"], "timings": run["timings"], "replayed": True}
+
+        timer = _StepTimer()
+        # one credential resolution and one admin login for the whole checkout
+        sf_context = salesforce.SalesforceContext(current_user.sf_username)
+
+        async def timed(name: str, fn, *args):
+            with timer.step(name):
+                return await asyncio.to_thread(fn, *args)
+
+        async def po_step() -> str:
+            if "sf_po_id" in state:
+                return state["sf_po_id"]
+            sf_po_id = await timed(
+                "create_sf_po", salesforce_orders.create_sf_po,
+                po_uuid, owner_id, account_id, approver_email, approver_decision_date, purchase_order_number,
+                sf_context
+            )
+            if sf_po_id is None:
+                raise fapi.HTTPException(status_code=502, detail="Failed to create the Salesforce purchase order")
+            state["sf_po_id"] = sf_po_id
+            # save right away, a crash before the orders step must not create a second PO on retry;
+            # a snapshot, since the pricing step may still be filling in `state`
+            await asyncio.to_thread(_save_run, owner, idempotency_key, state=dict(state))
+            return sf_po_id
+
+        async def pricing_step() -> typing.Tuple[dict, dict]:
+            # credentials are resolved once and shared by the remaining steps
+            sf = await timed("prep_request", lambda: sf_context.creds)
+            if "pricebook_map" in state:
+                return sf, state["pricebook_map"]
+            cart_items = await timed(
+                "get_cart_items", salesforce_orders.get_cart_items, sf["instance_url"], sf["headers"], cart_id
+            )
+            pricebook_map = await timed(
+                "resolve_pricebook_entries", salesforce_orders.resolve_pricebook_entries,
+                sf["instance_url"], sf["headers"], cart_items, current_user.sf_username
+            )
+            state["pricebook_map"] = pricebook_map
+            return sf, pricebook_map
+
+        try:
+            with timer.step("total"):
+                # let both branches finish so a completed PO is saved even if pricing fails
+                po_result, pricing_result = await asyncio.gather(po_step(), pricing_step(), return_exceptions=True)
+                for result in (po_result, pricing_result):
+                    if isinstance(result, BaseException):
+                        raise result
+                sf_po_id, (sf, pricebook_map) = po_result, pricing_result
+
+                if "orders" not in state:
+                    def save_orders_progress(orders: dict):
+                        # called from create_orders' thread after every order, a retry skips the saved ones
+                        state["orders_progress"] = orders
+                        _save_run(owner, idempotency_key, state=state)
+
+                    state["orders"] = await timed(
+                        "create_orders", salesforce_orders.create_orders,
+                        sf["instance_url"], sf["headers"], account_id, pricebook_map,
+                        purchase_data, sf_po_id, is_urgent, state.get("orders_progress"), save_orders_progress
+                    )
+                    state.pop("orders_progress", None)
+                    # save immediately, orders are the expensive step to repeat
+                    await asyncio.to_thread(_save_run, owner, idempotency_key, state=state)
+
+                    await response_cache.ainvalidate(cache.orders_tag(current_user.sf_username))
+
+                if not state.get("cart_closed"):
+                    await timed("close_cart", salesforce_orders.close_cart, sf["instance_url"], sf["headers"], cart_id)
+                    state["cart_closed"] = True
+
+                # post-checkout steps run on the job workers; their own keys dedupe retries
+                attach_job_id = await timed(
+                    "enqueue_attach_pdf", salesforce_orders.enqueue_attach_pdf_to_sf,
+                    sf_po_id, pdf_byte_string, po_uuid, current_user, owner_id
+                )
+                flip_job_id = await timed(
+                    "enqueue_flip_po", salesforce_orders.enqueue_flip_sf_po, sf_po_id, current_user
+                )
+        except Exception as e:
+            logger.warning("Checkout {} for {} failed: {}".format(idempotency_key, owner, e))
+            await asyncio.to_thread(
+                _save_run, owner, idempotency_key,
+                status="failed", state=state, timings=timer.timings, last_error=str(getattr(e, "detail", e))
+            )
+            raise
+
+        state["result"] = {
+            "sf_po_id": sf_po_id,
+            "results": state["orders"]["results"],
+            "jobs": {"attach_pdf": attach_job_id, "flip_po": flip_job_id},
+        }
+        await asyncio.to_thread(
+            _save_run, owner, idempotency_key, status="succeeded", state=state, timings=timer.timings
+        )
+        return {**state["result"], "timings": timer.timings, "replayed": False}
@@ -3,15 +3,18 @@ import functools
 import concurrent.futures
 import logging
 import multiprocessing as mp
+import time
+import typing
 
 # 3rd party libraries
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
-from azure.cosmos import CosmosClient
 
 # Settings
 from settings import settings
 
+from utils import metrics
+
 logger = logging.getLogger(__name__)
 
 # psql connection string
@@ -19,32 +22,66 @@ connection_string = settings.psql_connection_string.get_secret_value()
 engine = create_engine(connection_string, max_overflow=-1)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# cosmos connection
-azure_cosmos_client = CosmosClient(
-    settings.azure_cosmos_endpoint, settings.azure_cosmos_key
-)
-azure_cosmos_db_client = azure_cosmos_client.get_database_client(
-    settings.azure_cosmos_database
-)
-azure_cosmos_container = azure_cosmos_db_client.get_container_client(
-    settings.azure_cosmos_container
-)
-azure_cosmos_protein_container = azure_cosmos_db_client.get_container_client(
-    settings.azure_cosmos_protein_container
-)
-azure_cosmos_protein_computed_container = azure_cosmos_db_client.get_container_client(
-    settings.azure_cosmos_protein_computed_container
-)
-azure_cosmos_mv_protein_kpi_container = azure_cosmos_db_client.get_container_client(
-    settings.azure_cosmos_mv_protein_kpi_container
-)
-azure_cosmos_aseptic_kpi_container = azure_cosmos_db_client.get_container_client(
-    settings.azure_cosmos_aseptic_kpi_container
+# per-partition queries in flight at once for a single partitioned query
+PARTITION_FANOUT_PARALLELISM = 8
+
+# cosmos connection: azure.cosmos is slow to import and each client opens its own
+# connections, so the client and containers are built on first use (or by the warm-up)
+cosmos_container_settings = (
+    "azure_cosmos_container",
+    "azure_cosmos_protein_container",
+    "azure_cosmos_protein_computed_container",
+    "azure_cosmos_mv_protein_kpi_container",
+    "azure_cosmos_aseptic_kpi_container",
 )
 
+
+@functools.lru_cache(maxsize=1)
+def get_cosmos_database_client():
+    from azure.cosmos import CosmosClient
+
+    azure_cosmos_client = CosmosClient(
+        settings.azure_cosmos_endpoint, settings.azure_cosmos_key
+    )
+    return azure_cosmos_client.get_database_client(settings.azure_cosmos_database)
+
+
+@functools.lru_cache(maxsize=None)
+def get_cosmos_container_client(container: str):
+    """ Container client by container name, shared for the life of the worker """
+    return get_cosmos_database_client().get_container_client(container)
+
+
+def __getattr__(name: str):
+    # keeps `db.azure_cosmos_container` and friends working without building them at import
+    if name in cosmos_container_settings:
+        return get_cosmos_container_client(getattr(settings, name))
+    if name == "azure_cosmos_db_client":
+        return get_cosmos_database_client()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+@event.listens_for(SessionLocal, "before_commit")
+def _before_commit(session):
+    session.info["commit_started"] = time.perf_counter()
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _after_commit(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        metrics.record("db_commit", time.perf_counter() - started)
+
+
 def get_db():
     db = SessionLocal()
     try:
+        # check out the connection up front so time spent waiting on the pool is measured
+        start = time.perf_counter()
+        db.connection()
+        waited = time.perf_counter() - start
+        metrics.record("db_pool", waited)
+        metrics.db_pool_wait_seconds.observe(waited)
         yield db
     finally:
         db.close()
@@ -52,34 +89,34 @@ def get_db():
 
 def get_cosmos_container():
     try:
-        yield azure_cosmos_container
+        yield get_cosmos_container_client(settings.azure_cosmos_container)
     finally:
         return
 
 
 def get_cosmos_protein_container():
     try:
-        yield azure_cosmos_protein_container
+        yield get_cosmos_container_client(settings.azure_cosmos_protein_container)
     finally:
         return
 
 
 def get_cosmos_protein_computed_container():
     try:
-        yield azure_cosmos_protein_computed_container
+        yield get_cosmos_container_client(settings.azure_cosmos_protein_computed_container)
     finally:
         return
 
 
 def get_cosmos_mv_protein_kpi_container():
     try:
-        yield azure_cosmos_mv_protein_kpi_container
+        yield get_cosmos_container_client(settings.azure_cosmos_mv_protein_kpi_container)
     finally:
         return
 
 def get_cosmos_aseptic_kpi_container():
     try:
-        yield azure_cosmos_aseptic_kpi_container
+        yield get_cosmos_container_client(settings.azure_cosmos_aseptic_kpi_container)
     finally:
         return
 
@@ -91,15 +128,8 @@ def _cosmos_query(
     limit: int
 ) -> list:
     try:
-        azure_cosmos_client = CosmosClient(
-            settings.azure_cosmos_endpoint, settings.azure_cosmos_key
-        )
-        azure_cosmos_db_client = azure_cosmos_client.get_database_client(
-            settings.azure_cosmos_database
-        )
-        azure_cosmos_container = azure_cosmos_db_client.get_container_client(
-            container
-        )
+        # cached per pool process, so only the first query in a process pays for the client
+        azure_cosmos_container = get_cosmos_container_client(container)
         events = azure_cosmos_container.query_items(
             query=query_string,
             parameters=parameters,
@@ -113,6 +143,23 @@ def _cosmos_query(
         return []
 
 
+def _cosmos_partition_query(
+    container: str,
+    query_string: str,
+    parameters: list,
+    limit: int,
+    partition_key
+) -> list:
+    # single-partition query, served by one physical partition without a cross-partition plan
+    azure_cosmos_container = get_cosmos_container_client(container)
+    return list(azure_cosmos_container.query_items(
+        query=query_string,
+        parameters=parameters,
+        max_item_count=limit,
+        partition_key=partition_key
+    ))
+
+
 class CosmosPool:
 
     def start_cosmos_process_pool(self):
@@ -151,6 +198,45 @@ class CosmosPool:
             print(e)
             return []
 
+    async def query_cosmos_partitions_in_separate_processes(
+        self,
+        container: str,
+        query_string: str,
+        parameters: list,
+        limit: int,
+        partition_keys: typing.Iterable,
+        max_parallel: int = PARTITION_FANOUT_PARALLELISM
+    ) -> list:
+        """ Run the query once per known partition key, concurrently, and merge the results
+
+            For callers that know the partition key values (e.g. the machine ids of a
+            KPI read), this replaces one serial cross-partition read. `limit` is the
+            page size of each partition's query. Results are concatenated in
+            partition key order. Unlike the serial path, a failure raises instead
+            of returning [], so callers can tell an outage from an empty result """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(max_parallel)
+
+        async def query_partition(partition_key) -> list:
+            async with slots:
+                return await loop.run_in_executor(
+                    self.cosmos_process_pool, functools.partial(
+                        _cosmos_partition_query,
+                        container=container,
+                        query_string=query_string,
+                        parameters=parameters,
+                        limit=limit,
+                        partition_key=partition_key
+                    )
+                )
+
+        try:
+            pages = await asyncio.gather(*[query_partition(key) for key in dict.fromkeys(partition_keys)])
+        except Exception as e:
+            logger.error("Partitioned cosmos query on {} failed: {}".format(container, e))
+            raise
+        return [event for page in pages for event in page]
+
 
 # singleton
 cosmos_pool = CosmosPool()
@@ -0,0 +1,353 @@
+import abc
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+import typing
+import contextlib
+from datetime import datetime, timedelta
+
+import fastapi as fapi
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB, insert
+
+from settings import settings
+from utils import (
+    cache,
+    db as database,
+)
+from utils.cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+# a claimed request that has not written anything yet and was last touched this long ago
+# is assumed dead and may be run again; well above the admission queue wait plus the
+# slowest order creation, so a retry never runs alongside a request that is still going
+STALE_RUNNING_SECONDS = 30 * 60
+# keys are remembered this long, after which they may be reused for a new request
+KEY_TTL_SECONDS = 24 * 60 * 60
+# finished responses are also kept in the response cache, so retry storms skip the store
+REPLAY_CACHE_SECONDS = 10 * 60
+
+# claimed, nothing sent to Salesforce yet: released on failure so the client can retry
+RUNNING = "running"
+# Salesforce writes have started: never run again, a failure is stored and replayed
+WRITING = "writing"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+INTERRUPTED_DETAIL = "The earlier request with this idempotency key stopped after it started writing to Salesforce"
+
+metadata = sa.MetaData()
+
+# one row per (user, route, client idempotency key)
+idempotent_requests = sa.Table(
+    "idempotent_requests",
+    metadata,
+    sa.Column("owner", sa.String(255), primary_key=True),
+    sa.Column("scope", sa.String(64), primary_key=True),
+    sa.Column("idempotency_key", sa.String(255), primary_key=True),
+    sa.Column("fingerprint", sa.String(64), nullable=False),
+    sa.Column("status", sa.String(16), nullable=False),
+    sa.Column("status_code", sa.Integer, nullable=True),
+    sa.Column("response", JSONB, nullable=True),
+    sa.Column("created_at", sa.DateTime, nullable=False, default=datetime.utcnow),
+    sa.Column("updated_at", sa.DateTime, nullable=False, default=datetime.utcnow),
+)
+
+
+def create_tables():
+    idempotent_requests.create(database.engine, checkfirst=True)
+
+
+def fingerprint(**params) -> str:
+    """ Hash of the request parameters, so a key reused for a different request is caught """
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def resolve(record: typing.Optional[dict], request_fingerprint: str, now: datetime) -> str:
+    """ What a new attempt with a key does, given the key's stored record
+
+        "run" (first attempt, or an earlier one died before writing anything),
+        "replay" (finished, successfully or not), "busy" (another attempt is
+        in flight) or "interrupted" (an earlier attempt died after it started
+        writing, so it must be reported as failed rather than run again).
+        Raises 422 when the key was first used with different parameters """
+    if record is None or record["created_at"] < now - timedelta(seconds=KEY_TTL_SECONDS):
+        return "run"
+    if record["fingerprint"] != request_fingerprint:
+        raise fapi.HTTPException(
+            status_code=422, detail="This idempotency key was already used for a different request"
+        )
+    if record["status"] in (SUCCEEDED, FAILED):
+        return "replay"
+    stale = record["updated_at"] < now - timedelta(seconds=STALE_RUNNING_SECONDS)
+    if not stale:
+        return "busy"
+    return "interrupted" if record["status"] == WRITING else "run"
+
+
+def _claimed(action: str, record: dict, request_fingerprint: str, now: datetime) -> dict:
+    """ The record a store saves for `action`; raises 409 for "busy" """
+    if action == "busy":
+        raise fapi.HTTPException(
+            status_code=409, detail="A request with this idempotency key is already in progress"
+        )
+    if action == "run":
+        return {"fingerprint": request_fingerprint, "status": RUNNING, "status_code": None, "response": None,
+                "created_at": now, "updated_at": now}
+    if action == "interrupted":
+        return {**record, "status": FAILED, "status_code": 500, "response": {"detail": INTERRUPTED_DETAIL},
+                "updated_at": now}
+    return record
+
+
+class IdempotencyStore(abc.ABC):
+    """ Records which attempt owns each (owner, scope, key) and what it returned """
+
+    @abc.abstractmethod
+    def claim(self, owner: str, scope: str, idempotency_key: str, request_fingerprint: str) -> dict:
+        """ Claim the key for this attempt, returns the record with "status",
+            "status_code" and "response"; status RUNNING means this attempt runs """
+
+    @abc.abstractmethod
+    def update(self, owner: str, scope: str, idempotency_key: str, **values):
+        pass
+
+    @abc.abstractmethod
+    def release(self, owner: str, scope: str, idempotency_key: str):
+        """ Forget a claim that has not written anything """
+
+
+class InMemoryIdempotencyStore(IdempotencyStore):
+    """ Process-local store, for a single worker """
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def claim(self, owner, scope, idempotency_key, request_fingerprint):
+        now = datetime.utcnow()
+        with self._lock:
+            record = self._records.get((owner, scope, idempotency_key))
+            action = resolve(record, request_fingerprint, now)
+            record = _claimed(action, record, request_fingerprint, now)
+            self._records[(owner, scope, idempotency_key)] = record
+            return dict(record)
+
+    def update(self, owner, scope, idempotency_key, **values):
+        with self._lock:
+            record = self._records.get((owner, scope, idempotency_key))
+            if record is not None:
+                record.update(values, updated_at=datetime.utcnow())
+
+    def release(self, owner, scope, idempotency_key):
+        with self._lock:
+            record = self._records.get((owner, scope, idempotency_key))
+            if record is not None and record["status"] == RUNNING:
+                del self._records[(owner, scope, idempotency_key)]
+
+
+class PostgresIdempotencyStore(IdempotencyStore):
+    """ Shared store in idempotent_requests, the row lock decides between concurrent attempts """
+
+    @staticmethod
+    def _where(owner: str, scope: str, idempotency_key: str):
+        return sa.and_(
+            idempotent_requests.c.owner == owner,
+            idempotent_requests.c.scope == scope,
+            idempotent_requests.c.idempotency_key == idempotency_key,
+        )
+
+    def claim(self, owner, scope, idempotency_key, request_fingerprint):
+        now = datetime.utcnow()
+        where = self._where(owner, scope, idempotency_key)
+        db = next(database.get_db())
+        try:
+            inserted = db.execute(
+                insert(idempotent_requests).values(
+                    owner=owner,
+                    scope=scope,
+                    idempotency_key=idempotency_key,
+                    fingerprint=request_fingerprint,
+                    status=RUNNING,
+                    created_at=now,
+                    updated_at=now,
+                ).on_conflict_do_nothing().returning(idempotent_requests.c.status)
+            ).scalar()
+            if inserted is not None:
+                db.commit()
+                return {"status": RUNNING, "status_code": None, "response": None}
+
+            record = db.execute(
+                sa.select(
+                    idempotent_requests.c.fingerprint,
+                    idempotent_requests.c.status,
+                    idempotent_requests.c.status_code,
+                    idempotent_requests.c.response,
+                    idempotent_requests.c.created_at,
+                    idempotent_requests.c.updated_at,
+                ).where(where).with_for_update()
+            ).mappings().first()
+            record = dict(record) if record is not None else None
+            try:
+                claimed = _claimed(resolve(record, request_fingerprint, now), record, request_fingerprint, now)
+            except fapi.HTTPException:
+                db.rollback()
+                raise
+            if claimed is not record:
+                db.execute(idempotent_requests.update().where(where).values(**claimed))
+            db.commit()
+            return claimed
+        finally:
+            db.close()
+
+    def update(self, owner, scope, idempotency_key, **values):
+        db = next(database.get_db())
+        try:
+            db.execute(
+                idempotent_requests.update()
+                .where(self._where(owner, scope, idempotency_key))
+                .values(updated_at=datetime.utcnow(), **values)
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def release(self, owner, scope, idempotency_key):
+        db = next(database.get_db())
+        try:
+            db.execute(
+                idempotent_requests.delete()
+                .where(self._where(owner, scope, idempotency_key))
+                .where(idempotent_requests.c.status == RUNNING)
+            )
+            db.commit()
+        finally:
+            db.close()
+
+
+class IdempotentRun:
+    """ Handle yielded by `once`
+
+        `replayed` / `result` describe a finished earlier attempt. Otherwise the
+        route calls `mark_written` right before its first Salesforce write,
+        `progress` with whatever partial result it builds up, and `store` with
+        its final result """
+
+    def __init__(
+        self,
+        store: typing.Optional[IdempotencyStore] = None,
+        ident: tuple = (),
+        replayed: bool = False,
+        result=None
+    ):
+        self._store = store
+        self._ident = ident
+        self.replayed = replayed
+        self.result = result
+        self.partial = None
+        self.written = False
+        self.stored = False
+
+    def mark_written(self):
+        """ From here on a failure is stored and replayed, a retry never writes again """
+        if not self.written and self._store is not None:
+            self._store.update(*self._ident, status=WRITING)
+        self.written = True
+
+    def progress(self, partial):
+        self.partial = partial
+
+    def store(self, result):
+        self.result = result
+        self.stored = True
+        return result
+
+
+def _failure(run: IdempotentRun, error: BaseException) -> typing.Tuple[int, typing.Any]:
+    if isinstance(error, fapi.HTTPException):
+        status_code, detail = error.status_code, error.detail
+    else:
+        status_code, detail = 500, "The request failed after it started writing to Salesforce"
+    if run.partial is not None:
+        # e.g. the orders created before a later step failed
+        detail = {"error": detail, "partial_result": run.partial}
+    return status_code, detail
+
+
+def _default_store() -> IdempotencyStore:
+    if getattr(settings, "idempotency_store", None) == "memory":
+        return InMemoryIdempotencyStore()
+    return PostgresIdempotencyStore()
+
+
+# singleton
+idempotency_store = _default_store()
+
+
+@contextlib.asynccontextmanager
+async def once(
+    idempotency_key: typing.Optional[str],
+    owner: str,
+    scope: str,
+    request_fingerprint: str,
+    response: typing.Optional[fapi.Response] = None,
+    store: typing.Optional[IdempotencyStore] = None
+):
+    """ Run a write route at most once per client idempotency key
+
+        Without a key the body simply runs. With one, a successful earlier
+        attempt is handed back as `run.result` (with `run.replayed` set) and a
+        failed one is raised again, instead of running the body. Attempts that
+        fail before `run.mark_written` are forgotten so the client may retry;
+        later failures are kept, so a retry cannot repeat Salesforce writes """
+    if not idempotency_key:
+        yield IdempotentRun()
+        return
+    store = store or idempotency_store
+    ident = (owner, scope, idempotency_key)
+
+    cache_key = cache.make_key("idempotency", owner, scope, idempotency_key)
+    record = response_cache.get(cache_key)
+    if record is None or record["fingerprint"] != request_fingerprint:
+        record = await asyncio.to_thread(store.claim, owner, scope, idempotency_key, request_fingerprint)
+    if record["status"] == FAILED:
+        raise fapi.HTTPException(
+            status_code=record["status_code"], detail=record["response"]["detail"], headers={REPLAYED_HEADER: "true"}
+        )
+    if record["status"] == SUCCEEDED:
+        if response is not None:
+            response.headers[REPLAYED_HEADER] = "true"
+        yield IdempotentRun(replayed=True, result=record["response"])
+        return
+
+    run = IdempotentRun(store, ident)
+    try:
+        yield run
+    except BaseException as e:
+        if not run.written:
+            await asyncio.to_thread(store.release, *ident)
+            raise
+        status_code, detail = _failure(run, e)
+        finished = {"status": FAILED, "status_code": status_code, "response": {"detail": detail}}
+        try:
+            await asyncio.to_thread(store.update, *ident, **finished)
+        except Exception as save_error:
+            # left as "writing", which becomes failed once stale, never run again
+            logger.error("Failure to save idempotent failure for {}: {}".format(cache_key, save_error))
+        raise
+    if not run.stored:
+        await asyncio.to_thread(store.release, *ident)
+        return
+    finished = {"status": SUCCEEDED, "status_code": 200, "response": run.result}
+    try:
+        await asyncio.to_thread(store.update, *ident, **finished)
+    except Exception as e:
+        # the work is done; the key stays "writing" and is reported as interrupted once stale
+        logger.error("Failure to save idempotent response for {}: {}".format(cache_key, e))
+        return
+    response_cache.set(cache_key, {"fingerprint": request_fingerprint, **finished}, REPLAY_CACHE_SECONDS)
@@ -0,0 +1,367 @@
+import asyncio
+import logging
+import threading
+import typing
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB, insert
+
+from utils import (
+    cache,
+    db as database,
+)
+from utils.cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+# worker tuning
+POLL_INTERVAL_SECONDS = 1.0
+WORKER_CONCURRENCY = 4
+DEFAULT_MAX_ATTEMPTS = 5
+# retry backoff is BASE * 2 ** (attempts - 1), capped at MAX
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 300
+# running jobs refresh locked_at this often, however long their handler takes
+HEARTBEAT_INTERVAL_SECONDS = 60
+# jobs without a heartbeat for this long (the worker died) are picked up again
+STALE_RUNNING_SECONDS = 600
+# finished jobs are deleted this long after they last changed
+RETENTION_DAYS = 30
+SWEEP_INTERVAL_SECONDS = 60 * 60
+
+# the job the current worker thread is running, for `checkpoint`
+_current = threading.local()
+
+metadata = sa.MetaData()
+
+background_jobs = sa.Table(
+    "background_jobs",
+    metadata,
+    sa.Column("id", sa.BigInteger, primary_key=True, autoincrement=True),
+    sa.Column("kind", sa.String(64), nullable=False),
+    sa.Column("idempotency_key", sa.String(255), nullable=False, unique=True),
+    sa.Column("owner", sa.String(255), nullable=True),
+    sa.Column("payload", JSONB, nullable=False),
+    sa.Column("status", sa.String(16), nullable=False, default="queued"),
+    sa.Column("attempts", sa.Integer, nullable=False, default=0),
+    sa.Column("max_attempts", sa.Integer, nullable=False, default=DEFAULT_MAX_ATTEMPTS),
+    sa.Column("run_after", sa.DateTime, nullable=False, default=datetime.utcnow),
+    sa.Column("locked_at", sa.DateTime, nullable=True),
+    sa.Column("last_error", sa.Text, nullable=True),
+    sa.Column("result", JSONB, nullable=True),
+    sa.Column("created_at", sa.DateTime, nullable=False, default=datetime.utcnow),
+    sa.Column("updated_at", sa.DateTime, nullable=False, default=datetime.utcnow),
+    sa.Index("ix_background_jobs_status_run_after", "status", "run_after"),
+)
+
+# registry of job kind -> handler(payload) -> json-serializable result
+handlers: typing.Dict[str, typing.Callable[[dict], typing.Any]] = {}
+# job kind -> payload fields dropped once the job succeeds
+transient_fields: typing.Dict[str, typing.Tuple[str, ...]] = {}
+
+
+def handler(kind: str, transient: typing.Sequence[str] = ()):
+    """ Register a function as the handler for a job kind
+
+        `transient` payload fields (e.g. file contents) are only needed to run
+        the job and are removed from the row when it succeeds """
+    def register(fn):
+        handlers[kind] = fn
+        transient_fields[kind] = tuple(transient)
+        return fn
+    return register
+
+
+def enqueue(
+        kind: str,
+        payload: dict,
+        idempotency_key: str,
+        owner: typing.Optional[str] = None,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS
+) -> int:
+    """ Queue a job, returning its id. Re-enqueueing an existing idempotency key
+        returns the original job instead of creating a new one """
+    if kind not in handlers:
+        raise ValueError("No handler registered for job kind '{}'".format(kind))
+
+    db = next(database.get_db())
+    try:
+        stmt = insert(background_jobs).values(
+            kind=kind,
+            idempotency_key=idempotency_key,
+            owner=owner,
+            payload=payload,
+            status="queued",
+            attempts=0,
+            max_attempts=max_attempts,
+        ).on_conflict_do_nothing(
+            index_elements=["idempotency_key"]
+        ).returning(background_jobs.c.id)
+        job_id = db.execute(stmt).scalar()
+        if job_id is None:
+            job_id = db.execute(
+                sa.select(background_jobs.c.id)
+                .where(background_jobs.c.idempotency_key == idempotency_key)
+            ).scalar()
+        db.commit()
+        return job_id
+    finally:
+        db.close()
+
+
+def get_job(job_id: int) -> typing.Optional[dict]:
+    """ Fetch a job's status, without its (potentially large) payload """
+    db = next(database.get_db())
+    try:
+        row = db.execute(
+            sa.select(
+                background_jobs.c.id,
+                background_jobs.c.kind,
+                background_jobs.c.owner,
+                background_jobs.c.status,
+                background_jobs.c.attempts,
+                background_jobs.c.max_attempts,
+                background_jobs.c.run_after,
+                background_jobs.c.last_error,
+                background_jobs.c.result,
+                background_jobs.c.created_at,
+                background_jobs.c.updated_at,
+            ).where(background_jobs.c.id == job_id)
+        ).mappings().first()
+        return dict(row) if row is not None else None
+    finally:
+        db.close()
+
+
+def _claim_next_job() -> typing.Optional[dict]:
+    """ Atomically lock the next runnable job so concurrent workers never share one """
+    db = next(database.get_db())
+    try:
+        now = datetime.utcnow()
+        runnable = (
+            sa.select(background_jobs.c.id)
+            .where(sa.or_(
+                sa.and_(background_jobs.c.status == "queued", background_jobs.c.run_after <= now),
+                sa.and_(
+                    background_jobs.c.status == "running",
+                    background_jobs.c.locked_at < now - timedelta(seconds=STALE_RUNNING_SECONDS)
+                ),
+            ))
+            .order_by(background_jobs.c.run_after)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        row = db.execute(
+            background_jobs.update()
+            .where(background_jobs.c.id == runnable)
+            .values(
+                status="running",
+                locked_at=now,
+                attempts=background_jobs.c.attempts + 1,
+                updated_at=now,
+            )
+            .returning(background_jobs)
+        ).mappings().first()
+        db.commit()
+        return dict(row) if row is not None else None
+    finally:
+        db.close()
+
+
+def _heartbeat(job_id: int):
+    """ Keep a running job's lock fresh, so a slow handler is not taken for a dead worker """
+    db = next(database.get_db())
+    try:
+        db.execute(
+            background_jobs.update()
+            .where(background_jobs.c.id == job_id)
+            .where(background_jobs.c.status == "running")
+            .values(locked_at=datetime.utcnow())
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def checkpoint(**values):
+    """ Save progress into the running job's payload, called from a handler
+
+        The values are in the payload the handler gets on a retry, so a step
+        that already happened (e.g. an upload) is not repeated """
+    job = _current.job
+    job["payload"] = {**job["payload"], **values}
+    db = next(database.get_db())
+    try:
+        db.execute(
+            background_jobs.update()
+            .where(background_jobs.c.id == job["id"])
+            .values(payload=job["payload"], updated_at=datetime.utcnow())
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _finish_job(job: dict, result=None, error: typing.Optional[str] = None):
+    db = next(database.get_db())
+    try:
+        now = datetime.utcnow()
+        if error is None:
+            values = {"status": "succeeded", "result": result, "last_error": None}
+            if transient_fields.get(job["kind"]):
+                values["payload"] = {
+                    key: value for key, value in job["payload"].items() if key not in transient_fields[job["kind"]]
+                }
+        elif job["attempts"] >= job["max_attempts"]:
+            values = {"status": "failed", "last_error": error}
+        else:
+            delay = min(RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1), RETRY_MAX_SECONDS)
+            values = {
+                "status": "queued",
+                "last_error": error,
+                "run_after": now + timedelta(seconds=delay),
+            }
+        db.execute(
+            background_jobs.update()
+            .where(background_jobs.c.id == job["id"])
+            .values(locked_at=None, updated_at=now, **values)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _delete_finished_jobs() -> int:
+    """ Delete succeeded and failed jobs older than RETENTION_DAYS, returns how many """
+    db = next(database.get_db())
+    try:
+        deleted = db.execute(
+            background_jobs.delete()
+            .where(background_jobs.c.status.in_(["succeeded", "failed"]))
+            .where(background_jobs.c.updated_at < datetime.utcnow() - timedelta(days=RETENTION_DAYS))
+        ).rowcount
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+
+def _run_job(job: dict):
+    _current.job = job
+    try:
+        result = handlers[job["kind"]](job["payload"])
+    except Exception as e:
+        # HTTPExceptions from the salesforce helpers carry the useful part in `detail`
+        error = str(getattr(e, "detail", e))
+        logger.warning("Job {} ({}) attempt {} failed: {}".format(job["id"], job["kind"], job["attempts"], error))
+        _finish_job(job, error=error)
+    else:
+        _finish_job(job, result=result)
+
+
+class JobWorker:
+    """ Polls `background_jobs` and runs handlers in the default thread pool """
+
+    def __init__(self, concurrency: int = WORKER_CONCURRENCY):
+        self.concurrency = concurrency
+        self.tasks = []
+
+    def start_job_workers(self):
+        background_jobs.create(database.engine, checkfirst=True)
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self._work()) for _ in range(self.concurrency)]
+        self.tasks.append(loop.create_task(self._sweep_forever()))
+
+    async def shutdown_job_workers(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                job = await loop.run_in_executor(None, _claim_next_job)
+                if job is None:
+                    await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                    continue
+                heartbeat = loop.create_task(self._heartbeat(job["id"]))
+                try:
+                    await loop.run_in_executor(None, _run_job, job)
+                finally:
+                    heartbeat.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Job worker error: {}".format(e))
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+
+    async def _sweep_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                deleted = await loop.run_in_executor(None, _delete_finished_jobs)
+                if deleted:
+                    logger.info("Deleted {} finished jobs".format(deleted))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Job retention sweep failed: {}".format(e))
+            await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+
+    async def _heartbeat(self, job_id: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+            try:
+                await loop.run_in_executor(None, _heartbeat, job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Job {} heartbeat failed: {}".format(job_id, e))
+
+
+# singleton
+job_worker = JobWorker()
+
+
+# post-checkout handlers
+# the PDF is only needed until it is uploaded
+@handler("attach_pdf", transient=("pdf",))
+def _attach_pdf(payload: dict):
+    from utils import salesforce, salesforce_orders
+
+    sf = salesforce.SalesforceContext(payload["sf_username"])
+    content_version_id = payload.get("content_version_id")
+    if content_version_id is None:
+        content_version_id = salesforce_orders.upload_pdf_to_sf(
+            payload["pdf"], payload["order_id"], payload["owner_id"], sf
+        )
+        # a retry after a failed link goes straight to the link step instead of uploading again
+        checkpoint(content_version_id=content_version_id)
+    salesforce_orders.link_pdf_to_po(content_version_id, payload["sf_po_id"], sf)
+    return {"content_version_id": content_version_id}
+
+
+@handler("flip_po")
+def _flip_po(payload: dict):
+    from utils import salesforce_orders
+
+    if not salesforce_orders.flip_sf_po(payload["sf_po_id"]):
+        raise Exception("Failed to approve salesforce po {}".format(payload["sf_po_id"]))
+    # the purchase order list shows the approval status
+    if payload.get("sf_username"):
+        response_cache.invalidate(cache.orders_tag(payload["sf_username"]))
+    return {"sf_po_id": payload["sf_po_id"]}
+
+
+# maintenance handlers
+@handler("reconcile_carts")
+def _reconcile_carts(payload: dict):
+    from utils import cart_reconciliation
+
+    return cart_reconciliation.reconcile_carts(dry_run=payload.get("dry_run", False))
@@ -0,0 +1,146 @@
+import datetime
+import typing
+
+import numpy as np
+
+
+def _iso_to_epoch(value: str) -> float:
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    # naive timestamps are UTC, like the fast path assumes
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _to_epoch(value) -> float:
+    """ One timestamp as epoch seconds, NaN when it is neither a number nor an ISO-8601 string """
+    if _is_number(value):
+        # epoch milliseconds
+        return value / 1000 if value > 1e11 else float(value)
+    try:
+        return _iso_to_epoch(value)
+    except (ValueError, TypeError, AttributeError):
+        return np.nan
+
+
+def _epoch_seconds(raw_times: list) -> np.ndarray:
+    """ Timestamps as float epoch seconds, from epoch numbers or ISO-8601 strings
+
+        Containers written by different producers may mix both, those and
+        unparseable values go through the per-value path, the latter as NaN """
+    if all(_is_number(t) for t in raw_times):
+        times = np.asarray(raw_times, dtype=np.float64)
+        # epoch milliseconds
+        return times / 1000 if times.size and np.nanmax(times) > 1e11 else times
+    if all(isinstance(t, str) for t in raw_times):
+        try:
+            # the fast path handles naive and "Z" suffixed UTC strings, not explicit offsets
+            if any("+" in t[19:] or "-" in t[19:] for t in raw_times):
+                raise ValueError("timezone offsets")
+            parsed = np.array([t[:-1] if t.endswith("Z") else t for t in raw_times], dtype="datetime64[ms]")
+            return parsed.astype(np.int64) / 1000.0
+        except (ValueError, TypeError):
+            pass
+    return np.array([_to_epoch(t) for t in raw_times], dtype=np.float64)
+
+
+def to_arrays(
+    documents: typing.List[dict],
+    time_field: str,
+    value_fields: typing.Sequence[str]
+) -> typing.Tuple[np.ndarray, typing.Dict[str, np.ndarray]]:
+    """ Time-sorted epoch seconds and one float64 array per field, NaN where a value is missing """
+    documents = [d for d in documents if d.get(time_field) is not None]
+    times = _epoch_seconds([d[time_field] for d in documents])
+    # documents whose timestamp could not be read are left out
+    valid = ~np.isnan(times)
+    if not valid.all():
+        documents = [d for d, keep in zip(documents, valid) if keep]
+        times = times[valid]
+    order = np.argsort(times, kind="stable")
+    values = {}
+    for field in value_fields:
+        column = np.array([
+            v if isinstance(v, (int, float)) and not isinstance(v, bool) else np.nan
+            for v in (d.get(field) for d in documents)
+        ], dtype=np.float64)
+        values[field] = column[order]
+    return times[order], values
+
+
+def bucket_aggregate(
+    times: np.ndarray,
+    values: typing.Dict[str, np.ndarray],
+    bucket_seconds: float,
+    origin: typing.Optional[float] = None
+) -> dict:
+    """ mean/min/max/last per field over fixed time buckets, NaN values ignored
+
+        `times` must be sorted. Empty buckets are omitted; buckets whose values
+        are all NaN give NaN for every aggregate """
+    if times.size == 0:
+        return {"time": np.empty(0), "fields": {field: {} for field in values}}
+    origin = times[0] if origin is None else origin
+    bucket_ids = np.floor((times - origin) / bucket_seconds).astype(np.int64)
+    # sorted times give sorted bucket ids, so each bucket is one contiguous segment
+    starts = np.flatnonzero(np.r_[True, bucket_ids[1:] != bucket_ids[:-1]])
+    positions = np.arange(times.size)
+
+    result = {"time": origin + bucket_ids[starts] * bucket_seconds, "fields": {}}
+    for field, column in values.items():
+        present = ~np.isnan(column)
+        counts = np.add.reduceat(present, starts)
+        sums = np.add.reduceat(np.where(present, column, 0.0), starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(counts > 0, sums / counts, np.nan)
+        # fmin/fmax skip NaN unless the whole bucket is NaN
+        minimum = np.fmin.reduceat(column, starts)
+        maximum = np.fmax.reduceat(column, starts)
+        last_position = np.maximum.reduceat(np.where(present, positions, -1), starts)
+        last = np.where(last_position >= 0, column[np.maximum(last_position, 0)], np.nan)
+        result["fields"][field] = {"mean": mean, "min": minimum, "max": maximum, "last": last}
+    return result
+
+
+def lttb(times: np.ndarray, column: np.ndarray, threshold: int) -> np.ndarray:
+    """ Indices of the points Largest-Triangle-Three-Buckets keeps to draw `column` with
+        `threshold` points; NaN values are dropped first and `times` must be sorted """
+    indices = np.flatnonzero(~np.isnan(column))
+    if threshold >= indices.size or threshold < 3:
+        return indices
+    x = times[indices]
+    y = column[indices]
+
+    # first and last points are always kept, the rest are split into threshold - 2 buckets
+    edges = np.linspace(1, x.size - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = x.size - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # average of the next bucket, or the last point for the final bucket
+        next_start, next_end = end, edges[i + 2] if i + 2 < edges.size else x.size
+        next_x = x[next_start:next_end].mean()
+        next_y = y[next_start:next_end].mean()
+        # twice the triangle area for every candidate in this bucket
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return indices[selected]
+
+
+def to_json_list(array: np.ndarray) -> list:
+    """ Plain floats for JSON, with None for NaN """
+    return [None if value != value else value for value in array.tolist()]
+
+
+def to_epoch_ms(times: np.ndarray) -> list:
+    return np.round(times * 1000).astype(np.int64).tolist()
@@ -0,0 +1,136 @@
+import json
+import typing
+
+# pyarrow is optional, the export routes answer 501 without it
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+# documents per Cosmos page; each page becomes one record batch
+EXPORT_PAGE_SIZE = 5000
+# parquet row groups are written once this many rows are buffered
+PARQUET_ROW_GROUP_ROWS = 100000
+
+MEDIA_TYPES = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+class _ChunkSink:
+    """ Write-only file object the Arrow writers write into, drained after every batch """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _clean(document: dict) -> dict:
+    # _rid, _self, _etag, _attachments and _ts are Cosmos bookkeeping
+    return {key: value for key, value in document.items() if not key.startswith("_")}
+
+
+def infer_schema(documents: typing.List[dict]) -> "pa.Schema":
+    """ Schema from the first page, used for the whole export
+
+        JSON does not tell 1 from 1.0, so integer columns are widened to float64,
+        and columns that are null throughout the first page become strings """
+    fields = []
+    for field in pa.Table.from_pylist(documents).schema:
+        if pa.types.is_integer(field.type):
+            field = field.with_type(pa.float64())
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def _coerce(value, arrow_type):
+    if value is None:
+        return None
+    if pa.types.is_string(arrow_type):
+        return value if isinstance(value, str) else json.dumps(value)
+    if pa.types.is_floating(arrow_type):
+        return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+    if pa.types.is_boolean(arrow_type):
+        return value if isinstance(value, bool) else None
+    return None
+
+
+def to_record_batch(documents: typing.List[dict], schema: "pa.Schema") -> "pa.RecordBatch":
+    """ Columns outside the schema are dropped, values that do not fit its types become null """
+    columns = []
+    for field in schema:
+        values = [document.get(field.name) for document in documents]
+        try:
+            columns.append(pa.array(values, type=field.type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError):
+            columns.append(pa.array([_coerce(value, field.type) for value in values], type=field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def iter_export(pages: typing.Iterable[typing.Iterable[dict]], fmt: str) -> typing.Iterator[bytes]:
+    """ Encode Cosmos result pages (e.g. `query_items(...).by_page()`) as an Arrow IPC
+        stream or a Parquet file, yielding bytes as each page is written so only one
+        page (or one parquet row group) is held in memory """
+    sink = _ChunkSink()
+    schema = None
+    writer = None
+    row_group = []
+    row_group_rows = 0
+
+    for page in pages:
+        documents = [_clean(document) for document in page]
+        if not documents:
+            continue
+        if schema is None:
+            schema = infer_schema(documents)
+            if fmt == "parquet":
+                writer = pa.parquet.ParquetWriter(sink, schema, compression="zstd")
+            else:
+                writer = pa.ipc.new_stream(sink, schema)
+        batch = to_record_batch(documents, schema)
+
+        if fmt == "parquet":
+            row_group.append(batch)
+            row_group_rows += batch.num_rows
+            if row_group_rows < PARQUET_ROW_GROUP_ROWS:
+                continue
+            writer.write_table(pa.Table.from_batches(row_group, schema=schema))
+            row_group, row_group_rows = [], 0
+        else:
+            writer.write_batch(batch)
+        yield sink.drain()
+
+    if writer is None:
+        # no documents: still a valid, empty file
+        schema = pa.schema([])
+        writer = pa.parquet.ParquetWriter(sink, schema) if fmt == "parquet" else pa.ipc.new_stream(sink, schema)
+    if row_group:
+        writer.write_table(pa.Table.from_batches(row_group, schema=schema))
+    writer.close()
+    yield sink.drain()
@@ -0,0 +1,258 @@
+import asyncio
+import logging
+import typing
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+
+from models import (
+    Machine as MachineModel,
+    Organization as OrganizationModel,
+    Plant as PlantModel,
+)
+from utils import (
+    cache,
+    db as database,
+    salesforce,
+)
+from utils.account_index import account_index
+from utils.cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL_SECONDS = 5 * 60
+UPSERT_BATCH_SIZE = 1000
+WATERMARK_NAME = "Asset"
+# first sync pulls everything
+EPOCH = datetime(2000, 1, 1)
+# a sync that saw no changes moves the watermark to its start minus this, for clock skew with Salesforce
+WATERMARK_SKEW = timedelta(minutes=5)
+
+metadata = sa.MetaData()
+
+sf_machine_assets = sa.Table(
+    "sf_machine_assets",
+    metadata,
+    sa.Column("id", sa.String(18), primary_key=True),
+    sa.Column("account_id", sa.String(18), nullable=True, index=True),
+    sa.Column("name", sa.String(255), nullable=False),
+    sa.Column("serial_number", sa.String(255), nullable=True, index=True),
+    sa.Column("status", sa.String(64), nullable=True),
+    sa.Column("product_code", sa.String(255), nullable=True),
+    sa.Column("install_date", sa.Date, nullable=True),
+    sa.Column("last_modified", sa.DateTime, nullable=False),
+    # resolved by every sync, see _resolve_org_ids
+    sa.Column("org_id", sa.String(64), nullable=True, index=True),
+)
+
+sync_watermarks = sa.Table(
+    "sync_watermarks",
+    metadata,
+    sa.Column("name", sa.String(64), primary_key=True),
+    sa.Column("watermark", sa.DateTime, nullable=False),
+)
+
+
+def _parse_sf_datetime(value: str) -> datetime:
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def create_tables():
+    metadata.create_all(database.engine, checkfirst=True)
+    # tables created before org_id existed
+    with database.engine.begin() as connection:
+        connection.execute(sa.text("ALTER TABLE sf_machine_assets ADD COLUMN IF NOT EXISTS org_id VARCHAR(64)"))
+        connection.execute(sa.text(
+            "CREATE INDEX IF NOT EXISTS ix_sf_machine_assets_org_id ON sf_machine_assets (org_id)"
+        ))
+
+
+def _get_watermark(db) -> datetime:
+    watermark = db.execute(
+        sa.select(sync_watermarks.c.watermark).where(sync_watermarks.c.name == WATERMARK_NAME)
+    ).scalar()
+    return watermark or EPOCH
+
+
+def _resolve_org_ids(db) -> int:
+    """ Set org_id on every synced Asset, returns how many changed
+
+        An Asset belongs to the organization owning the plant of the machine
+        with its serial number or, for Assets matching none of our machines, to
+        the organization whose Salesforce Accounts include its AccountId. Runs
+        over all rows on every sync, since machines and accounts are linked
+        independently of Asset changes """
+    org_by_serial = {
+        serial_number: str(org_id)
+        for serial_number, org_id in db.execute(
+            sa.select(MachineModel.serial_number, PlantModel.org_id)
+            .join(PlantModel, MachineModel.plant_id == PlantModel.id)
+            .where(MachineModel.serial_number.isnot(None))
+        )
+    }
+    org_by_account = {}
+    if account_index.loaded:
+        for org_id, org_name in db.execute(sa.select(OrganizationModel.id, OrganizationModel.name)):
+            for record in account_index.get(org_name):
+                org_by_account[record["Id"]] = str(org_id)
+
+    changes = []
+    for asset_id, serial_number, account_id, org_id in db.execute(sa.select(
+        sf_machine_assets.c.id, sf_machine_assets.c.serial_number,
+        sf_machine_assets.c.account_id, sf_machine_assets.c.org_id,
+    )):
+        if serial_number in org_by_serial:
+            resolved = org_by_serial[serial_number]
+        elif account_index.loaded:
+            resolved = org_by_account.get(account_id)
+        else:
+            # keep the last account based value until the account index has loaded
+            resolved = org_id
+        if resolved != org_id:
+            changes.append({"asset_id": asset_id, "resolved_org_id": resolved})
+
+    for offset in range(0, len(changes), UPSERT_BATCH_SIZE):
+        db.execute(
+            sf_machine_assets.update()
+            .where(sf_machine_assets.c.id == sa.bindparam("asset_id"))
+            .values(org_id=sa.bindparam("resolved_org_id")),
+            changes[offset:offset + UPSERT_BATCH_SIZE],
+        )
+    return len(changes)
+
+
+def sync_assets() -> int:
+    """ Pull Assets modified since the last watermark into sf_machine_assets and
+        re-resolve their organizations, returns the change count """
+    started = datetime.utcnow()
+    db = next(database.get_db())
+    try:
+        watermark = _get_watermark(db)
+        sf = salesforce.sf_client()
+        # >= re-reads the boundary second so same-second edits are never skipped, the upsert
+        # makes that harmless. queryAll includes deleted records, so deletions propagate too
+        records = sf.query_all(
+            "SELECT Id, Name, AccountId, SerialNumber, Status, Product2.ProductCode, InstallDate, "
+            "LastModifiedDate, IsDeleted FROM Asset WHERE LastModifiedDate >= {} ORDER BY LastModifiedDate".format(
+                watermark.strftime("%Y-%m-%dT%H:%M:%SZ")
+            ),
+            include_deleted=True,
+        )["records"]
+
+        if records:
+            deleted = [r["Id"] for r in records if r["IsDeleted"]]
+            rows = [
+                {
+                    "id": record["Id"],
+                    "account_id": record["AccountId"],
+                    "name": record["Name"],
+                    "serial_number": record["SerialNumber"],
+                    "status": record["Status"],
+                    "product_code": (record.get("Product2") or {}).get("ProductCode"),
+                    "install_date": record["InstallDate"],
+                    "last_modified": _parse_sf_datetime(record["LastModifiedDate"]),
+                }
+                for record in records
+                if not record["IsDeleted"]
+            ]
+
+            for offset in range(0, len(rows), UPSERT_BATCH_SIZE):
+                stmt = insert(sf_machine_assets).values(rows[offset:offset + UPSERT_BATCH_SIZE])
+                # org_id is left to _resolve_org_ids
+                db.execute(stmt.on_conflict_do_update(
+                    index_elements=["id"],
+                    set_={
+                        c.name: stmt.excluded[c.name]
+                        for c in sf_machine_assets.columns if c.name not in ("id", "org_id")
+                    },
+                ))
+            if deleted:
+                db.execute(sf_machine_assets.delete().where(sf_machine_assets.c.id.in_(deleted)))
+            new_watermark = _parse_sf_datetime(records[-1]["LastModifiedDate"])
+        else:
+            # always written, its row is also what tells readers the sync has run
+            new_watermark = max(watermark, started - WATERMARK_SKEW)
+        stmt = insert(sync_watermarks).values(name=WATERMARK_NAME, watermark=new_watermark)
+        db.execute(stmt.on_conflict_do_update(index_elements=["name"], set_={"watermark": new_watermark}))
+
+        relinked = _resolve_org_ids(db)
+        db.commit()
+        if records or relinked:
+            response_cache.invalidate(cache.MACHINES_TAG)
+            logger.info("Synced {} changed Assets, {} moved organization".format(len(records), relinked))
+        return len(records) + relinked
+    finally:
+        db.close()
+
+
+def _machine_out(row) -> dict:
+    """ The response shape of GET /salesforce_machines/{org_id} """
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "serial_number": row["serial_number"],
+        "status": row["status"],
+        "product_code": row["product_code"],
+        "install_date": row["install_date"].isoformat() if row["install_date"] else None,
+        "account_id": row["account_id"],
+        "machine_id": str(row["machine_id"]) if row["machine_id"] else None,
+        "plant_id": str(row["plant_id"]) if row["plant_id"] else None,
+    }
+
+
+def get_machines(org_id: str) -> typing.Optional[typing.List[dict]]:
+    """ Synced Assets of an organization, None if the sync has never run """
+    db = next(database.get_db())
+    try:
+        if db.execute(
+            sa.select(sync_watermarks.c.name).where(sync_watermarks.c.name == WATERMARK_NAME)
+        ).first() is None:
+            return None
+        rows = db.execute(
+            sa.select(
+                sf_machine_assets,
+                MachineModel.id.label("machine_id"),
+                MachineModel.plant_id.label("plant_id"),
+            )
+            .select_from(sf_machine_assets)
+            .outerjoin(MachineModel, MachineModel.serial_number == sf_machine_assets.c.serial_number)
+            .where(sf_machine_assets.c.org_id == str(org_id))
+            .order_by(sf_machine_assets.c.name)
+        ).mappings().all()
+        return [_machine_out(row) for row in rows]
+    finally:
+        db.close()
+
+
+class MachineSync:
+    """ Runs the Asset delta sync in the background """
+
+    def __init__(self, interval: int = SYNC_INTERVAL_SECONDS):
+        self.interval = interval
+        self.task = None
+
+    async def start_machine_sync(self):
+        await asyncio.get_running_loop().run_in_executor(None, create_tables)
+        self.task = asyncio.get_running_loop().create_task(self._sync_forever())
+
+    async def shutdown_machine_sync(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _sync_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, sync_assets)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Asset sync failed: {}".format(e))
+            await asyncio.sleep(self.interval)
+
+
+# singleton
+machine_sync = MachineSync()
@@ -0,0 +1,176 @@
+import time
+import typing
+import inspect
+import functools
+import contextlib
+import contextvars
+
+# prometheus_client is optional, timings still feed Server-Timing without it
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+PHASE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# per-request state: {"scope": asgi scope, "timings": {phase: [seconds, count]}}
+_request_state: contextvars.ContextVar[typing.Optional[dict]] = contextvars.ContextVar(
+    "request_metrics", default=None
+)
+
+
+class _NoopMetric:
+    """ Stands in for prometheus metrics when prometheus_client is not installed """
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+
+if prometheus_client is not None:
+    registry = prometheus_client.CollectorRegistry(auto_describe=True)
+    phase_seconds = prometheus_client.Histogram(
+        "request_phase_seconds", "Time spent per request phase", ["route", "phase"],
+        buckets=PHASE_BUCKETS, registry=registry,
+    )
+    request_seconds = prometheus_client.Histogram(
+        "request_seconds", "Total request time", ["route", "method", "status"],
+        buckets=PHASE_BUCKETS, registry=registry,
+    )
+    salesforce_calls = prometheus_client.Counter(
+        "salesforce_calls_total", "Outbound Salesforce calls", ["route", "method", "status"],
+        registry=registry,
+    )
+    token_cache = prometheus_client.Counter(
+        "salesforce_token_cache_total", "Salesforce access token lookups", ["result"],
+        registry=registry,
+    )
+    db_pool_wait_seconds = prometheus_client.Histogram(
+        "db_pool_wait_seconds", "Time waiting for a Postgres connection from the pool",
+        buckets=PHASE_BUCKETS, registry=registry,
+    )
+    admission_rejections = prometheus_client.Counter(
+        "admission_rejections_total", "Requests shed by admission control", ["limiter", "reason"],
+        registry=registry,
+    )
+else:
+    registry = None
+    phase_seconds = request_seconds = salesforce_calls = token_cache = db_pool_wait_seconds = _NoopMetric()
+    admission_rejections = _NoopMetric()
+
+
+def current_route() -> str:
+    """ Route template of the current request, e.g. /salesforce_orders/me/{order_id} """
+    state = _request_state.get()
+    if state is None:
+        return "background"
+    route = state["scope"].get("route")
+    if route is not None:
+        return route.path
+    # older starlette versions only expose the endpoint
+    endpoint = state["scope"].get("endpoint")
+    return getattr(endpoint, "__name__", None) or "unmatched"
+
+
+def record(phase: str, seconds: float):
+    """ Add time to a phase of the current request and to the phase histogram """
+    state = _request_state.get()
+    if state is not None:
+        total = state["timings"].setdefault(phase, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+    phase_seconds.labels(route=current_route(), phase=phase).observe(seconds)
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """ Time a block as a named phase of the current request """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """ Decorator form of `phase`, works on sync and async functions """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with phase(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def salesforce_response_hook(response, *args, **kwargs):
+    """ requests response hook for the shared Salesforce session """
+    record("salesforce", response.elapsed.total_seconds())
+    salesforce_calls.labels(
+        route=current_route(), method=response.request.method, status=str(response.status_code)
+    ).inc()
+    return response
+
+
+def server_timing_header(timings: dict) -> str:
+    entries = []
+    for name, (seconds, count) in timings.items():
+        entry = "{};dur={:.1f}".format(name, seconds * 1000)
+        if count > 1:
+            entry += ';desc="{} calls"'.format(count)
+        entries.append(entry)
+    return ", ".join(entries)
+
+
+class ServerTimingMiddleware:
+    """ ASGI middleware that collects phase timings for each request, returns
+        them in a Server-Timing header and records the total request time """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        state = {"scope": scope, "timings": {}}
+        token = _request_state.set(state)
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                timings = dict(state["timings"])
+                timings["total"] = [time.perf_counter() - start, 1]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing_header(timings).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_seconds.labels(
+                route=current_route(), method=scope["method"], status=str(status["code"])
+            ).observe(time.perf_counter() - start)
+            _request_state.reset(token)
+
+
+def render_latest() -> typing.Tuple[bytes, str]:
+    """ Prometheus exposition of the metrics above """
+    if prometheus_client is None:
+        return b"", "text/plain"
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,92 @@
+import json
+import time
+import hashlib
+import threading
+import collections
+from typing import Optional
+
+# how many order detail responses to keep per worker
+MAX_ENTRIES = 2048
+# within this window a cached order is served without revalidating with Salesforce
+FRESH_SECONDS = 30
+
+
+def make_etag(body) -> str:
+    """ Build an ETag for a JSON body, independent of Salesforce's own validators
+
+        Weak, since it is computed before compression and the same value is sent
+        for the identity, gzip and br representations """
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":"))
+    return 'W/"' + hashlib.sha1(canonical.encode("utf8")).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """ Compare an If-None-Match request header against our ETag """
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # weak comparison is what If-None-Match uses, so ignore the W/ prefix on both sides
+    opaque = etag.replace("W/", "", 1)
+    return "*" in candidates or opaque in [tag.replace("W/", "", 1) for tag in candidates]
+
+
+class OrderCache:
+    """ LRU cache of order detail responses keyed by (sf_username, order_id)
+
+        Each entry keeps the Salesforce validators (ETag / Last-Modified) so it can
+        be revalidated with a conditional request, plus our own ETag for clients """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, fresh_seconds: int = FRESH_SECONDS):
+        self.max_entries = max_entries
+        self.fresh_seconds = fresh_seconds
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sf_username: str, order_id: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get((sf_username, order_id))
+            if entry is not None:
+                self._entries.move_to_end((sf_username, order_id))
+            return entry
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.monotonic() - entry["validated_at"] < self.fresh_seconds
+
+    def conditional_headers(self, entry: Optional[dict]) -> dict:
+        """ Headers to revalidate a cached entry with Salesforce """
+        if entry is None:
+            return {}
+        headers = {}
+        if entry["sf_etag"]:
+            headers["If-None-Match"] = entry["sf_etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, sf_username: str, order_id: str, body, sf_etag: Optional[str], last_modified: Optional[str]) -> dict:
+        entry = {
+            "body": body,
+            "etag": make_etag(body),
+            "sf_etag": sf_etag,
+            "last_modified": last_modified,
+            "validated_at": time.monotonic(),
+        }
+        with self._lock:
+            self._entries[(sf_username, order_id)] = entry
+            self._entries.move_to_end((sf_username, order_id))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def touch(self, entry: dict) -> dict:
+        """ Mark an entry as revalidated (Salesforce answered 304) """
+        entry["validated_at"] = time.monotonic()
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# singleton
+order_cache = OrderCache()
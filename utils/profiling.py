@@ -0,0 +1,93 @@
+import os
+import re
+import uuid
+import logging
+import typing
+from datetime import datetime
+
+import fastapi.security as fapis
+
+from enums import SecurityScope
+from utils import auth
+
+# pyinstrument is optional, without it profiling requests are served unprofiled
+try:
+    import pyinstrument
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:
+    pyinstrument = None
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_QUERY_FLAG = re.compile(rb"(^|&)profile=(1|true)(&|$)")
+PROFILE_DIR = "profiles"
+SAMPLE_INTERVAL_SECONDS = 0.001
+PROFILE_ID_PATTERN = re.compile(r"^[0-9]{8}T[0-9]{6}-[0-9a-f]{32}$")
+
+# only admins may profile a request, the flag is ignored for everyone else
+PROFILE_SCOPES = fapis.SecurityScopes(scopes=[SecurityScope.admin])
+
+
+def _wants_profile(scope) -> bool:
+    if PROFILE_QUERY_FLAG.search(scope.get("query_string", b"")):
+        return True
+    return any(name == PROFILE_HEADER for name, _ in scope["headers"])
+
+
+async def _is_admin(scope) -> bool:
+    authorization = dict(scope["headers"]).get(b"authorization", b"").decode("latin-1")
+    if not authorization.lower().startswith("bearer "):
+        return False
+    try:
+        await auth.get_secured_token(security_scopes=PROFILE_SCOPES, token=authorization[7:])
+    except (auth.AuthException, auth.NotEnoughPermissionsException):
+        return False
+    return True
+
+
+def profile_path(profile_id: str) -> typing.Optional[str]:
+    """ Location of a stored report, None for ids that are not ours """
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    return os.path.join(PROFILE_DIR, profile_id + ".speedscope.json")
+
+
+class ProfilingMiddleware:
+    """ ASGI middleware that samples a single request when an admin asks for it
+        with an `X-Profile` header or `?profile=1`
+
+        The report is written in speedscope format (flame graph ready) and its id
+        returned in the `X-Profile-Id` response header. Requests without the flag
+        only pay for the header check """
+
+    def __init__(self, app):
+        self.app = app
+        if pyinstrument is None:
+            logger.info("pyinstrument is not installed, request profiling is disabled")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or pyinstrument is None or not _wants_profile(scope):
+            return await self.app(scope, receive, send)
+        if not await _is_admin(scope):
+            return await self.app(scope, receive, send)
+
+        profile_id = "{}-{}".format(datetime.utcnow().strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex)
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        profiler = pyinstrument.Profiler(interval=SAMPLE_INTERVAL_SECONDS, async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profiler.stop()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(profile_path(profile_id), "w") as report:
+                report.write(profiler.output(SpeedscopeRenderer()))
+            logger.info("Profiled {} {} as {}".format(scope["method"], scope["path"], profile_id))
@@ -0,0 +1,82 @@
+import gzip
+import json
+import typing
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+
+# orjson and brotli are optional, fall back to the standard library when missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bodies smaller than this are not worth compressing
+COMPRESSION_THRESHOLD = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+JSON_MEDIA_TYPE = "application/json"
+
+
+def dumps(content: typing.Any) -> bytes:
+    """ Serialize already-validated content to JSON bytes """
+    if orjson is not None:
+        try:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            # pydantic models and other types orjson does not know about
+            return orjson.dumps(jsonable_encoder(content), option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")
+    ).encode("utf8")
+
+
+def _pick_encoding(accept_encoding: str) -> typing.Optional[str]:
+    accepted = [value.split(";")[0].strip().lower() for value in accept_encoding.split(",")]
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, accept_encoding: str) -> typing.Tuple[bytes, typing.Optional[str]]:
+    """ Compress a body with the best encoding the client accepts, if it is large enough """
+    if len(body) < COMPRESSION_THRESHOLD:
+        return body, None
+    encoding = _pick_encoding(accept_encoding or "")
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY), encoding
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), encoding
+    return body, None
+
+
+def fast_response(
+    request: Request,
+    content: typing.Any,
+    status_code: int = 200,
+    headers: typing.Optional[dict] = None,
+) -> Response:
+    """ Serialize with the fast encoder and compress large bodies for the client
+
+        Returning a Response from a route makes FastAPI skip the `response_model`
+        validation and encoding pass, so only use it for data that is already
+        validated (Salesforce payloads or our own schemas) """
+    body, encoding = compress(dumps(content), request.headers.get("accept-encoding", ""))
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(
+        content=body,
+        status_code=status_code,
+        headers=headers,
+        media_type=JSON_MEDIA_TYPE,
+    )
@@ -1,17 +1,24 @@
 import jwt
 import requests
+import sqlalchemy as sa
 import datetime
 import os.path
-from simple_salesforce import Salesforce
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
+import threading
+import functools
+import typing
+import fastapi as fapi
 
 from settings import settings
 
 from models import User as user_model
 from utils import auth
+from utils import metrics
+from utils.token_refresher import token_refresher
 from utils import db as database
 
+if typing.TYPE_CHECKING:
+    from simple_salesforce import Salesforce
+
 # SFCC connection details
 #TODO: reminder to create new connected app and certificate/keys for Salesforce production org
 #TODO: move these values to AZ Key Vault
@@ -21,14 +28,28 @@ sfcc_admin_username = settings.sfcc_admin_username
 sfcc_admin_password = settings.sfcc_admin_password.get_secret_value()
 sfcc_admin_token = settings.sfcc_admin_token
 
+# Salesforce ends a session after the org's session timeout (2 hours by default); a minted
+# access token is reused until shortly before that, then re-minted by the token refresher
+SESSION_TIMEOUT_MINUTES = getattr(settings, "sfcc_session_timeout_minutes", None) or 120
+TOKEN_CACHE_MINUTES = max(SESSION_TIMEOUT_MINUTES - 10, 1)
+
+# shared session for every Salesforce call: pooled connections and per-call metrics
+http = requests.Session()
+http.hooks["response"].append(metrics.salesforce_response_hook)
+
 def sf_client():
+    # only the background syncs use simple_salesforce, keep it off the import path
+    from simple_salesforce import Salesforce
+
     return Salesforce(
         username=sfcc_admin_username,
         password=sfcc_admin_password,
         security_token=sfcc_admin_token,
-        domain=settings.sfcc_domain_name
+        domain=settings.sfcc_domain_name,
+        session=http
     )
 
+@metrics.timed("prep_request")
 def prep_request(sf_username):
     """ Prepare the Salesforce API requests by fetching new access tokens and setting headers """
     
@@ -44,8 +65,60 @@ def prep_request(sf_username):
     }
     return {"instance_url": instance_url, "headers": headers}
 
+class SalesforceContext:
+    """ Salesforce credentials and admin client for one request, each resolved at most once
+
+        Pass it to every helper in utils/salesforce_orders.py so a multi-step
+        request logs in once. Safe to share between threads of the same request """
+
+    def __init__(self, sf_username: str):
+        self.sf_username = sf_username
+        self._creds = None
+        self._client = None
+        # separate locks so the user token and the admin login can resolve in parallel
+        self._creds_lock = threading.Lock()
+        self._client_lock = threading.Lock()
+
+    @property
+    def creds(self) -> dict:
+        """ {"instance_url", "headers"} for the user, as returned by prep_request """
+        with self._creds_lock:
+            if self._creds is None:
+                self._creds = prep_request(self.sf_username)
+            return self._creds
+
+    @property
+    def instance_url(self) -> str:
+        return self.creds["instance_url"]
+
+    @property
+    def headers(self) -> dict:
+        return self.creds["headers"]
+
+    @property
+    def client(self) -> "Salesforce":
+        """ simple_salesforce admin client on the shared session """
+        with self._client_lock:
+            if self._client is None:
+                self._client = sf_client()
+            return self._client
+
+
+def get_salesforce_context(
+    token=fapi.Security(auth.get_secure_token_and_user),
+) -> SalesforceContext:
+    """ FastAPI dependency, use as fapi.Security(salesforce.get_salesforce_context, scopes=[...])
+
+        The route's scopes are passed down to the token check, and FastAPI
+        caches both for the rest of the request """
+    return SalesforceContext(token.details.sf_username)
+
+@functools.lru_cache(maxsize=1)
+@metrics.timed("key_vault")
 def get_key_from_azure():
     """ Fetch the SFCC private_key from Azure Key Vault """
+    from azure.identity import DefaultAzureCredential
+    from azure.keyvault.secrets import SecretClient
 
     credential = DefaultAzureCredential(exclude_visual_studio_code_credential=True)
     secret_client = SecretClient(vault_url=settings.azure_key_vault_url, credential=credential)
@@ -76,30 +149,71 @@ def get_key_from_azure():
 
     return private_key
 
+@metrics.timed("jwt_login")
 def jwt_login(client_id, sf_username):
     """ Sign a JWT and send to Salesforce in exchange for an access token
         Leverages the logged-in user's sf_username """
 
     # TODO: may want to add try/catch logic
 
+    # keep this user's token warm in the background from now on
+    token_refresher.touch(sf_username)
+
     # Initialize db session
     db = next(database.get_db())
-    # try to fetch token from db
+    # try to fetch token and expiration time from db
     db_token = (
-        db.query(user_model.sf_access_token)
-        .filter(user_model.sf_username == sf_username).first()
-    )
-     
-    # fetch expiration time from db
-    db_expiration_time = (
-        db.query(user_model.sf_token_expiration)
+        db.query(user_model.sf_access_token, user_model.sf_token_expiration)
         .filter(user_model.sf_username == sf_username).first()
     )
 
     # check the database to see if there is a token and if it has not expired
-    if db_token and db_expiration_time[0] >= datetime.datetime.utcnow():
+    if db_token and db_token[0] and db_token[1] >= datetime.datetime.utcnow():
+        metrics.token_cache.labels(result="hit").inc()
         return {"access_token": auth.decrypt(db_token[0]), "instance_url": settings.sfcc_storefront_base_endpoint}
 
+    metrics.token_cache.labels(result="miss").inc()
+    return mint_token_once(client_id, sf_username, db, datetime.datetime.utcnow())
+
+def mint_token_once(client_id, sf_username, db, valid_until, wait=True):
+    """ Mint a token unless the user has one valid past `valid_until`, one worker at a time per user
+
+        A Postgres advisory lock (held until mint_token commits) makes concurrent
+        callers in every worker wait for, and reuse, the first one's token. With
+        wait=False, None is returned when another worker is minting or already has """
+    lock = "pg_advisory_xact_lock" if wait else "pg_try_advisory_xact_lock"
+    acquired = db.execute(
+        sa.text("SELECT {}(hashtext(:key))".format(lock)), {"key": "sf-token:" + sf_username}
+    ).scalar()
+    if not wait and not acquired:
+        return None
+
+    try:
+        db_token = (
+            db.query(user_model.sf_access_token, user_model.sf_token_expiration)
+            .filter(user_model.sf_username == sf_username).first()
+        )
+        if db_token and db_token[0] and db_token[1] is not None and db_token[1] > valid_until:
+            # minted by another worker while we waited
+            db.rollback()
+            if not wait:
+                return None
+            return {"access_token": auth.decrypt(db_token[0]), "instance_url": settings.sfcc_storefront_base_endpoint}
+        result = mint_token(client_id, sf_username, db)
+    except Exception:
+        db.rollback()
+        raise
+    if "error" in result:
+        # nothing stored, just release the lock
+        db.rollback()
+    return result
+
+def mint_token(client_id, sf_username, db=None):
+    """ Exchange a freshly signed JWT for an access token and store it for the user """
+
+    if db is None:
+        db = next(database.get_db())
+
     # fetch private_key for encrypting JWT from Azure Key Vault
     private_key = get_key_from_azure()
 
@@ -120,7 +234,7 @@ def jwt_login(client_id, sf_username):
     )
 
     # submit JWT to Salesforce in exchange for an access_token
-    response = requests.post(
+    response = http.post(
         endpoint + '/services/oauth2/token',
         data={
             'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
@@ -137,11 +251,9 @@ def jwt_login(client_id, sf_username):
         # set access token details
         access_token = body["access_token"]
         instance_url = body["instance_url"]
-        expiration = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
-        
-        # if there is no token in the database, or expiration time for token is expired
-        if not db_token[0] or db_expiration_time[0] < datetime.datetime.utcnow():
-            # store in db 
-            db.query(user_model).filter(user_model.sf_username == sf_username).update({"sf_access_token": auth.encrypt(access_token), "sf_token_expiration": expiration}, synchronize_session=False)
-            db.commit()
-        return {"access_token": access_token, "instance_url": instance_url}
\ No newline at end of file
+        expiration = datetime.datetime.utcnow() + datetime.timedelta(minutes=TOKEN_CACHE_MINUTES)
+
+        # store in db
+        db.query(user_model).filter(user_model.sf_username == sf_username).update({"sf_access_token": auth.encrypt(access_token), "sf_token_expiration": expiration}, synchronize_session=False)
+        db.commit()
+        return {"access_token": access_token, "instance_url": instance_url}
@@ -1,16 +1,26 @@
+import io
 import json
+import uuid
+import base64
+import typing
 import schemas
 import logging
-import requests
 import collections
 import fastapi as fapi
 from datetime import datetime
+from models import SfCarts
 from utils import (
-    salesforce
+    active_carts,
+    db as database,
+    cache,
+    jobs,
+    salesforce,
+    soql
 )
-from settings import settings
+from utils.cache import response_cache
+from utils.catalog import catalog
+from utils.sf_metadata import sf_metadata
 from schemas import order_quote
-from functools import lru_cache
 
 
 # this should return the salesforce po id to be used for the rest of order flow
@@ -20,10 +30,11 @@ def create_sf_po(
         account_id: str,
         approver_email: str,
         approver_decision_date: datetime.date,
-        purchase_order_number: str
+        purchase_order_number: str,
+        sf_context: typing.Optional[salesforce.SalesforceContext] = None
 
 ) -> str:
-    sf = salesforce.sf_client()
+    sf = sf_context.client if sf_context is not None else salesforce.sf_client()
     try:
         po = sf.Purchase_Order__c.create({
             "UUID__c": uuid,
@@ -34,144 +45,242 @@ def create_sf_po(
             "Purchase_Order_Number__c": purchase_order_number,
             "Approval_Status__c": "Approval Pending"
         })
+        soql.invalidate("Purchase_Order__c")
         return po["id"]
     except Exception as e:
         logging.error("Failure to create salesforce po for uuid: {}. Failure is: {}".format(uuid, e))
 
 
-# helper function to get network ID
-@lru_cache()
+# helper function to get network ID, served from the startup-prefetched metadata cache
 def get_network_id() -> str:
-    try:
-        sf = salesforce.sf_client()
-        query = "SELECT Id FROM Network WHERE Name = '{}'".format(settings.sfcc_network_name)
-        results = sf.query(query)
-        if results['records']:
-            return results['records'][0]['Id']
-        else:
-            raise Exception
-    except Exception as e:
-        logging.info("Failure to get network id: {}".format(e))
+    return sf_metadata.network_id
+
+
+# size of each chunk read from the PDF while streaming it to Salesforce
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def _pdf_source(pdf: typing.Union[str, bytes, typing.BinaryIO]) -> typing.Tuple[int, typing.Callable[[], typing.Iterator[bytes]]]:
+    """ Return the decoded size of the PDF and a factory for an iterator over its bytes
+
+        Accepts the base64 string callers used to send, raw bytes, or a binary file object """
+    if isinstance(pdf, str):
+        # MIME-style base64 is wrapped with line breaks, which would throw off the size
+        encoded = "".join(pdf.split())
+        padding = len(encoded) - len(encoded.rstrip("="))
+        size = len(encoded) // 4 * 3 - padding
+
+        def chunks():
+            # decode in multiples of 4 base64 chars so each slice decodes on its own
+            step = UPLOAD_CHUNK_SIZE // 3 * 4
+            for offset in range(0, len(encoded), step):
+                yield base64.b64decode(encoded[offset:offset + step])
+        return size, chunks
+
+    if isinstance(pdf, (bytes, bytearray, memoryview)):
+        view = memoryview(pdf)
+
+        def chunks():
+            for offset in range(0, len(view), UPLOAD_CHUNK_SIZE):
+                yield bytes(view[offset:offset + UPLOAD_CHUNK_SIZE])
+        return len(view), chunks
+
+    start = pdf.tell()
+    size = pdf.seek(0, io.SEEK_END) - start
+    pdf.seek(start)
+
+    def chunks():
+        while True:
+            chunk = pdf.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    return size, chunks
+
+
+class _MultipartBody:
+    """ Iterable multipart/form-data body with a known length; requests takes the
+        Content-Length from __len__ and streams it instead of buffering or chunking it """
+
+    def __init__(self, entity_content: dict, filename: str, pdf):
+        self.boundary = "boundary_" + uuid.uuid4().hex
+        self.head = (
+            "--{b}\r\n"
+            "Content-Disposition: form-data; name=\"entity_content\"\r\n"
+            "Content-Type: application/json\r\n\r\n"
+            "{entity}\r\n"
+            "--{b}\r\n"
+            "Content-Disposition: form-data; name=\"VersionData\"; filename=\"{filename}\"\r\n"
+            "Content-Type: application/pdf\r\n\r\n"
+        ).format(b=self.boundary, entity=json.dumps(entity_content), filename=filename).encode("utf8")
+        self.tail = "\r\n--{}--\r\n".format(self.boundary).encode("utf8")
+        self.pdf_size, self.pdf_chunks = _pdf_source(pdf)
+
+    @property
+    def content_type(self) -> str:
+        return "multipart/form-data; boundary=" + self.boundary
+
+    def __len__(self) -> int:
+        return len(self.head) + self.pdf_size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        yield from self.pdf_chunks()
+        yield self.tail
 
 
 def attach_pdf_to_sf(
         sf_po_id: str,  # pdf content in SF linked to this
-        pdf_byte_string: str,
+        pdf_byte_string: typing.Union[str, bytes, typing.BinaryIO],
         order_id: str,
         current_user: schemas.UserInDB,
-        owner_id: str
+        owner_id: str,
+        sf_context: typing.Optional[salesforce.SalesforceContext] = None
 ):
-    # currently requires you to pass the Account ID and Cart ID as a query parameter
-    sf_username = current_user.sf_username
+    """ Upload the order PDF as a ContentVersion and share it with the PO """
+    # reuse the request's credentials when the caller already resolved them
+    sf = sf_context or salesforce.SalesforceContext(current_user.sf_username)
+    content_version_id = upload_pdf_to_sf(pdf_byte_string, order_id, owner_id, sf)
+    link_pdf_to_po(content_version_id, sf_po_id, sf)
+    return content_version_id
+
 
-    # get the credentials and set initial headers
-    sf = salesforce.prep_request(sf_username)
-    instance_url = sf["instance_url"]
-    headers = sf["headers"]
+def upload_pdf_to_sf(
+        pdf_byte_string: typing.Union[str, bytes, typing.BinaryIO],
+        order_id: str,
+        owner_id: str,
+        sf: salesforce.SalesforceContext
+) -> str:
+    """ Upload the order PDF as a ContentVersion, returns its id
+
+        The PDF is streamed as the binary part of a multipart request """
+    instance_url = sf.instance_url
+    headers = sf.headers
 
     url = instance_url + "/services/data/v53.0/sobjects/ContentVersion"
     current_date = datetime.today().strftime("%Y-%m-%d")
     current_date = current_date.replace("-", "/")
     filename = '{}/{}.pdf'.format(current_date, str(order_id))
-    data = {
+    entity_content = {
         'Title': filename,
         'PathOnClient': filename,
         'ContentLocation': "S",
-        'VersionData': pdf_byte_string,
         'OwnerID': owner_id,
-        'NetworkId': get_network_id()
+        'NetworkId': get_network_id(),
     }
 
-    # Create a content version
-    content_version = requests.post(url, headers=headers, data=json.dumps(data))
+    body = _MultipartBody(entity_content, filename, pdf_byte_string)
+
+    # create the content version; `body` has a length, so it is sent with Content-Length, not chunked
+    content_version = salesforce.http.post(url, headers={**headers, "Content-Type": body.content_type}, data=body)
     if content_version.ok is not True:
         raise fapi.HTTPException(
             status_code=content_version.status_code, detail=content_version.json()
         )
-    content_version_id = content_version.json().get('id')
-
-    # Get ContentDocument id
-    url = instance_url + "/services/data/v53.0/sobjects/ContentVersion/%s" % content_version_id
-    content_version = requests.get(url, headers=headers)
-    content_document_id = content_version.json().get('ContentDocumentId')
-
-    # Create a content document link
-    url = instance_url + "/services/data/v53.0/sobjects/ContentDocumentLink"
-    r = requests.post(url, headers=headers, data=json.dumps({
-        'ContentDocumentId': content_document_id,
-        'LinkedEntityId': sf_po_id,
-        "Visibility": "AllUsers"
+    return content_version.json().get('id')
+
+
+def link_pdf_to_po(content_version_id: str, sf_po_id: str, sf: salesforce.SalesforceContext):
+    """ Share an uploaded ContentVersion with the PO
+
+        The ContentDocumentLink (visible to all users, as the portal needs) is
+        created in one composite call that also looks up the ContentDocumentId """
+    headers = sf.headers
+    # get the ContentDocument id and link it to the PO in one round trip
+    url = sf.instance_url + "/services/data/v53.0/composite"
+    response = salesforce.http.post(url, headers=headers, data=json.dumps({
+        "allOrNone": True,
+        "compositeRequest": [
+            {
+                "method": "GET",
+                "url": "/services/data/v53.0/sobjects/ContentVersion/{}?fields=ContentDocumentId".format(
+                    content_version_id
+                ),
+                "referenceId": "version",
+            },
+            {
+                "method": "POST",
+                "url": "/services/data/v53.0/sobjects/ContentDocumentLink",
+                "referenceId": "link",
+                "body": {
+                    "ContentDocumentId": "@{version.ContentDocumentId}",
+                    "LinkedEntityId": sf_po_id,
+                    "Visibility": "AllUsers",
+                },
+            },
+        ],
     }))
+    if response.ok is not True:
+        raise fapi.HTTPException(status_code=response.status_code, detail=response.json())
+    for sub_response in response.json()["compositeResponse"]:
+        if sub_response["httpStatusCode"] >= 400:
+            raise fapi.HTTPException(status_code=sub_response["httpStatusCode"], detail=sub_response["body"])
+
+
+def get_cart_items(
+        instance_url: str,
+        headers: dict,
+        cart_id: str
+) -> list:
+    """ Fetch the CartItem records of a cart """
+    query = soql.select(
+        "CartItem",
+        ["Id", "CartId", "Name", "Product2.ProductCode", "SalesPrice", "Quantity"],
+        where=[("CartId", "=", cart_id)],
+    )
+    # never cached, checkout has to see the cart as it is now
+    return soql.run(instance_url, headers, query)["records"]
 
 
-# returns dict["results"] which is a list of the orders' metatdata
-def create_salesforce_order(
-        account_id: str,
-        cart_id: str,
-        current_user: schemas.UserInDB,
-        purchase_data: order_quote.OrderInput,
-        sf_po_id: str,
-        is_urgent: bool
+def find_pricebook_entry(
+        instance_url: str,
+        headers: dict,
+        sku: str,
+        price: float,
+        sf_username: typing.Optional[str] = None
 ) -> dict:
-    """Create an Order (quote) in Salesforce with 'Draft' status"""
-    # TODO: map logged in user's plant to Salesforce Account ID, fetching plant/product/pricing data dynamically
-    # currently requires you to pass the Account ID and Cart ID as a query parameter
-    sf_username = current_user.sf_username
-
-    # get the credentials and set initial headers
-    sf = salesforce.prep_request(sf_username)
-    instance_url = sf["instance_url"]
-    headers = sf["headers"]
-
-    # fetch products in active cart
-    query = (
-            "SELECT Id, CartId, Name, Product2.ProductCode, SalesPrice, Quantity FROM CartItem WHERE CartId = "
-            + "'"
-            + cart_id
-            + "'"
+    """ First PricebookEntry for a product code at a unit price, with its Pricebook2.Id """
+    # TODO: re-think a more "unique" query to only return 1 item
+    query = soql.select(
+        "PriceBookEntry",
+        ["Id", "PriceBook2.Id"],
+        where=[("UnitPrice", "=", float(price)), ("Product2.ProductCode", "=", sku)],
     )
-    url = instance_url + "/services/data/v53.0/query/?q=" + query
+    # which pricebooks a buyer sees depends on their sharing, so results are cached per user
+    body = soql.run(instance_url, headers, query, cache_scope=sf_username)
+    return body["records"][0]
 
-    cart_items_query_response = requests.get(url, headers=headers)
-    if cart_items_query_response.ok is not True:
-        raise fapi.HTTPException(
-            status_code=cart_items_query_response.status_code, detail=cart_items_query_response.json()
-        )
 
-    cart_products = cart_items_query_response.json()
-    pricebook_map = collections.defaultdict(list)  # strucutre is {PB.id:[records]}
-    order_responses = {"results": []}
+def resolve_pricebook_entries(
+        instance_url: str,
+        headers: dict,
+        cart_items: list,
+        sf_username: typing.Optional[str] = None
+) -> dict:
+    """ Group cart items into OrderItem records by pricebook, structure is {PB.id:[records]} """
+    pricebook_map = collections.defaultdict(list)
 
     # iterate through list of products and query for PriceBookEntry IDs
-    for product in cart_products["records"]:
-        cart_item_id = product["Id"]
-        cart_item_name = product["Name"]
+    for product in cart_items:
         sku = product["Product2"]["ProductCode"]
         price = product["SalesPrice"]
         qty = product["Quantity"]
 
-        # TODO: refactor this to read from database, since PBEs should be stored
-        # TODO: re-think a more "unique" query to only return 1 item
-        query = (
-                "SELECT Id, PriceBook2.Id FROM PriceBookEntry WHERE UnitPrice = {0}".format(float(price))
-                + " AND Product2.ProductCode = "
-                + "'"
-                + sku
-                + "'"
-        )
-        url = instance_url + "/services/data/v53.0/query/?q=" + query
-
-        pb_query_response = requests.get(url, headers=headers)
-        if pb_query_response.ok is not True:
-            raise fapi.HTTPException(
-                status_code=pb_query_response.status_code,
-                detail=pb_query_response.json(),
-            )
+        # use the synced catalog, falling back to Salesforce for entries it has not seen yet
+        entry = catalog.index.find_entry(sku, price, sf_metadata.pricebook_ids)
+        if entry is not None:
+            pricebook_map[entry["pricebook_id"]].append({
+                "attributes": {"type": "OrderItem"},
+                "PricebookEntryId": entry["id"],
+                "quantity": qty,
+                "UnitPrice": price,
+            })
+            continue
 
-        body = pb_query_response.json()
+        pb_entry = find_pricebook_entry(instance_url, headers, sku, price, sf_username)
 
-        pb_entry_id = body["records"][0]["Id"]
-        pricebook_id = body["records"][0]["Pricebook2"]["Id"]
+        pb_entry_id = pb_entry["Id"]
+        pricebook_id = pb_entry["Pricebook2"]["Id"]
 
         record = {
             "attributes": {"type": "OrderItem"},
@@ -181,10 +290,34 @@ def create_salesforce_order(
         }
         pricebook_map[pricebook_id].append(record)
 
+    return dict(pricebook_map)
+
+
+def create_orders(
+        instance_url: str,
+        headers: dict,
+        account_id: str,
+        pricebook_map: dict,
+        purchase_data: order_quote.OrderInput,
+        sf_po_id: str,
+        is_urgent: bool,
+        progress: typing.Optional[dict] = None,
+        on_progress: typing.Optional[typing.Callable[[dict], None]] = None
+) -> dict:
+    """ Create one Draft Order per pricebook, returns dict["results"] with each order's metadata
+
+        `progress` is what an earlier, failed attempt returned through
+        `on_progress`: its pricebooks already have an order and are skipped.
+        `on_progress` is called after every created order, so the caller can
+        save it before the next one is attempted """
+    order_responses = progress or {"results": [], "pricebooks": []}
+
     # create an Order with products in Cart
     url = instance_url + "/services/data/v53.0/commerce/sale/order"
 
     for pricebook in pricebook_map:
+        if pricebook in order_responses["pricebooks"]:
+            continue
         payload = {
             "order": [
                 {
@@ -210,7 +343,7 @@ def create_salesforce_order(
             ]
         }
 
-        order_response = requests.post(
+        order_response = salesforce.http.post(
             url, headers=headers, data=json.dumps(payload)
         )
         if order_response.ok is not True:
@@ -221,13 +354,25 @@ def create_salesforce_order(
             )
         else:
             order_responses["results"].append(order_response.json())
+            order_responses["pricebooks"].append(pricebook)
+            soql.invalidate("Order", "OrderItem")
+            if on_progress is not None:
+                on_progress(order_responses)
 
-    # if Order creation is a success, close the Cart
+    return order_responses
+
+
+def close_cart(
+        instance_url: str,
+        headers: dict,
+        cart_id: str
+):
+    """ Close the WebCart once its Orders exist """
     url = instance_url + "/services/data/v53.0/sobjects/WebCart/" + cart_id
 
     payload = {"Status": "Closed"}
 
-    cart_update_response = requests.patch(
+    cart_update_response = salesforce.http.patch(
         url, headers=headers, data=json.dumps(payload)
     )
     if cart_update_response.ok is not True:
@@ -236,6 +381,55 @@ def create_salesforce_order(
             detail=cart_update_response.json(),
         )
 
+    soql.invalidate("WebCart", "CartItem")
+    remove_cart_from_mirror(cart_id)
+
+
+def remove_cart_from_mirror(cart_id: str):
+    """ Drop a closed cart's rows from sf_carts so cart summaries only count open carts """
+    db = next(database.get_db())
+    try:
+        account_ids = {
+            row[0] for row in db.query(SfCarts.sf_account_id).filter_by(sf_cart_id=cart_id).distinct()
+        }
+        db.query(SfCarts).filter_by(sf_cart_id=cart_id).delete(synchronize_session=False)
+        active_carts.forget(db, cart_id)
+        db.commit()
+    finally:
+        db.close()
+    response_cache.invalidate(*[cache.cart_account_tag(account_id) for account_id in account_ids])
+
+
+# returns dict["results"] which is a list of the orders' metatdata
+def create_salesforce_order(
+        account_id: str,
+        cart_id: str,
+        current_user: schemas.UserInDB,
+        purchase_data: order_quote.OrderInput,
+        sf_po_id: str,
+        is_urgent: bool,
+        sf_context: typing.Optional[salesforce.SalesforceContext] = None
+) -> dict:
+    """Create an Order (quote) in Salesforce with 'Draft' status"""
+    # TODO: map logged in user's plant to Salesforce Account ID, fetching plant/product/pricing data dynamically
+    # currently requires you to pass the Account ID and Cart ID as a query parameter
+
+    # reuse the request's credentials when the caller already resolved them
+    sf = sf_context or salesforce.SalesforceContext(current_user.sf_username)
+    instance_url = sf.instance_url
+    headers = sf.headers
+
+    # fetch products in active cart and resolve their pricebook entries
+    cart_items = get_cart_items(instance_url, headers, cart_id)
+    pricebook_map = resolve_pricebook_entries(instance_url, headers, cart_items, current_user.sf_username)
+
+    order_responses = create_orders(
+        instance_url, headers, account_id, pricebook_map, purchase_data, sf_po_id, is_urgent
+    )
+
+    # if Order creation is a success, close the Cart
+    close_cart(instance_url, headers, cart_id)
+
     # return the metadata received from Salesforce
     # TODO: maybe parse this to only give the order IDs
     return order_responses
@@ -243,15 +437,52 @@ def create_salesforce_order(
 
 # this should return the salesforce po id to be used for the rest of order flow
 def flip_sf_po(
-        sf_po_id: str
+        sf_po_id: str,
+        sf_context: typing.Optional[salesforce.SalesforceContext] = None
 ) -> bool:
-    sf = salesforce.sf_client()
+    sf = sf_context.client if sf_context is not None else salesforce.sf_client()
     # use query to flip the value
     data = {
         "Approval_Status__c": "Approved"
     }
     try:
         sf.Purchase_Order__c.update(sf_po_id, data)
+        soql.invalidate("Purchase_Order__c")
         return True
     except:
         return False
+
+
+def enqueue_attach_pdf_to_sf(
+        sf_po_id: str,
+        pdf_byte_string: str,
+        order_id: str,
+        current_user: schemas.UserInDB,
+        owner_id: str
+) -> int:
+    """ Queue attach_pdf_to_sf on the background job workers, returns the job id """
+    return jobs.enqueue(
+        "attach_pdf",
+        {
+            "sf_po_id": sf_po_id,
+            "pdf": pdf_byte_string,
+            "order_id": str(order_id),
+            "sf_username": current_user.sf_username,
+            "owner_id": owner_id,
+        },
+        idempotency_key="attach_pdf:{}:{}".format(sf_po_id, order_id),
+        owner=current_user.email,
+    )
+
+
+def enqueue_flip_sf_po(
+        sf_po_id: str,
+        current_user: schemas.UserInDB
+) -> int:
+    """ Queue flip_sf_po on the background job workers, returns the job id """
+    return jobs.enqueue(
+        "flip_po",
+        {"sf_po_id": sf_po_id, "sf_username": current_user.sf_username},
+        idempotency_key="flip_po:{}".format(sf_po_id),
+        owner=current_user.email,
+    )
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import threading
+import typing
+
+import fastapi as fapi
+
+from settings import settings
+from utils import salesforce
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL_SECONDS = 60 * 60
+# while any value is missing, the refresher retries this often
+RETRY_INTERVAL_SECONDS = 30
+
+
+def _load_network_id(sf) -> str:
+    results = sf.query("SELECT Id FROM Network WHERE Name = '{}'".format(settings.sfcc_network_name))
+    if not results["records"]:
+        raise LookupError("No Network named '{}'".format(settings.sfcc_network_name))
+    return results["records"][0]["Id"]
+
+
+def _load_webstore_id(sf) -> str:
+    results = sf.query("SELECT Id FROM WebStore WHERE Id = '{}'".format(settings.webstore_id))
+    if not results["records"]:
+        raise LookupError("No WebStore with Id '{}'".format(settings.webstore_id))
+    return results["records"][0]["Id"]
+
+
+def _load_pricebook_ids(sf) -> typing.List[str]:
+    results = sf.query(
+        "SELECT Pricebook2Id FROM WebStorePricebook WHERE IsActive = true AND WebStoreId = '{}'".format(
+            settings.webstore_id
+        )
+    )
+    if not results["records"]:
+        raise LookupError("No active pricebooks for WebStore '{}'".format(settings.webstore_id))
+    return [record["Pricebook2Id"] for record in results["records"]]
+
+
+class SalesforceMetadata:
+    """ Org-level Salesforce IDs that rarely change, loaded at startup and refreshed on a schedule
+
+        Requests only ever read the last known value; loading is left to the
+        refresher task, so no request pays for a Salesforce login. A failed
+        refresh keeps the last good value, and while anything is missing the
+        refresher retries every RETRY_INTERVAL_SECONDS """
+
+    loaders = {
+        "network_id": _load_network_id,
+        "webstore_id": _load_webstore_id,
+        "pricebook_ids": _load_pricebook_ids,
+    }
+
+    def __init__(self, interval: int = REFRESH_INTERVAL_SECONDS):
+        self.interval = interval
+        self._values = {}
+        self._lock = threading.Lock()
+        self.task = None
+
+    def _load(self, name: str, sf):
+        try:
+            value = self.loaders[name](sf)
+        except Exception as e:
+            logger.warning("Failure to load salesforce metadata {}: {}".format(name, e))
+            return
+        with self._lock:
+            self._values[name] = value
+
+    def refresh(self):
+        """ Reload every value with a single Salesforce login """
+        try:
+            sf = salesforce.sf_client()
+        except Exception as e:
+            logger.warning("Failure to log in to refresh salesforce metadata: {}".format(e))
+            return
+        for name in self.loaders:
+            self._load(name, sf)
+
+    def get(self, name: str):
+        """ Last known value, None if it has not loaded yet """
+        return self._values.get(name)
+
+    def require(self, name: str):
+        """ Last known value, failing fast with a 503 if it has not loaded yet """
+        value = self.get(name)
+        if value is None:
+            raise fapi.HTTPException(
+                status_code=503,
+                detail="Salesforce metadata '{}' is not loaded yet".format(name),
+                headers={"Retry-After": str(RETRY_INTERVAL_SECONDS)},
+            )
+        return value
+
+    @property
+    def network_id(self) -> str:
+        return self.require("network_id")
+
+    @property
+    def webstore_id(self) -> str:
+        # the configured id is still usable if Salesforce cannot confirm it right now
+        return self.get("webstore_id") or settings.webstore_id
+
+    @property
+    def pricebook_ids(self) -> typing.List[str]:
+        return self.get("pricebook_ids") or []
+
+    async def start_metadata_refresh(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.refresh)
+        self.task = loop.create_task(self._refresh_forever())
+
+    async def shutdown_metadata_refresh(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _refresh_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # retry soon while anything is missing, otherwise on the regular schedule
+            missing = any(name not in self._values for name in self.loaders)
+            await asyncio.sleep(RETRY_INTERVAL_SECONDS if missing else self.interval)
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Salesforce metadata refresh failed: {}".format(e))
+
+
+# singleton
+sf_metadata = SalesforceMetadata()
@@ -0,0 +1,163 @@
+import re
+import decimal
+import hashlib
+import datetime
+import typing
+
+import fastapi as fapi
+
+from utils import (
+    cache,
+    salesforce,
+)
+from utils.cache import response_cache
+
+API_VERSION = "v53.0"
+# cached results are also dropped whenever our own writes touch one of their sObjects
+RESULT_CACHE_SECONDS = 60
+
+_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+_OPERATORS = {"=", "!=", "<", "<=", ">", ">=", "LIKE", "IN", "NOT IN", "INCLUDES", "EXCLUDES"}
+# backslash first, so the escapes added for the others are not escaped again
+_ESCAPES = [("\\", "\\\\"), ("'", "\\'"), ('"', '\\"'), ("\n", "\\n"), ("\r", "\\r"), ("\t", "\\t"),
+            ("\b", "\\b"), ("\f", "\\f")]
+
+
+def _name(value: str) -> str:
+    if not _NAME.match(value):
+        raise ValueError("Invalid SOQL field or sObject name: {!r}".format(value))
+    return value
+
+
+def _ordering(item: str) -> str:
+    """ "Field" or "Field ASC|DESC" """
+    parts = item.split()
+    if len(parts) == 2 and parts[1].upper() in ("ASC", "DESC"):
+        return _name(parts[0]) + " " + parts[1].upper()
+    if len(parts) != 1:
+        raise ValueError("Invalid SOQL ordering: {!r}".format(item))
+    return _name(parts[0])
+
+
+def literal(value) -> str:
+    """ Render a Python value as a SOQL literal, quoting and escaping strings """
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        # date-time literals are unquoted and need a zone
+        if value.tzinfo is None:
+            return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+        # no fractional seconds, and the offset as +hh:mm
+        text = value.strftime("%Y-%m-%dT%H:%M:%S%z")
+        return text[:-2] + ":" + text[-2:]
+    if isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return "(" + ", ".join(literal(v) for v in value) + ")"
+    text = str(value)
+    for char, escaped in _ESCAPES:
+        text = text.replace(char, escaped)
+    return "'" + text + "'"
+
+
+class Query:
+    """ A normalized SOQL SELECT
+
+        `text` is built the same way for the same inputs, so it doubles as a
+        cache key. `sobjects` are the sObjects the result depends on, its own
+        plus any passed as `depends_on` for relationship fields and subqueries """
+
+    def __init__(
+        self,
+        sobject: str,
+        fields: typing.Sequence[typing.Union[str, "Query"]],
+        where: typing.Sequence[typing.Tuple[str, str, typing.Any]] = (),
+        order_by: typing.Sequence[str] = (),
+        limit: typing.Optional[int] = None,
+        depends_on: typing.Iterable[str] = ()
+    ):
+        self.sobject = _name(sobject)
+        rendered = []
+        sobjects = {sobject, *depends_on}
+        for field in fields:
+            if isinstance(field, Query):
+                rendered.append("(" + field.text + ")")
+                sobjects |= field.sobjects
+            elif field not in rendered:
+                rendered.append(_name(field))
+
+        conditions = []
+        for field, operator, value in where:
+            operator = operator.upper()
+            if operator not in _OPERATORS:
+                raise ValueError("Invalid SOQL operator: {!r}".format(operator))
+            conditions.append("{} {} {}".format(_name(field), operator, literal(value)))
+
+        text = "SELECT {} FROM {}".format(", ".join(rendered), self.sobject)
+        if conditions:
+            text += " WHERE " + " AND ".join(conditions)
+        if order_by:
+            text += " ORDER BY " + ", ".join(_ordering(item) for item in order_by)
+        if limit is not None:
+            text += " LIMIT {}".format(int(limit))
+
+        self.text = text
+        self.sobjects = frozenset(sobjects)
+
+    def __str__(self) -> str:
+        return self.text
+
+
+def select(sobject: str, fields: typing.Sequence[typing.Union[str, Query]], **kwargs) -> Query:
+    return Query(sobject, fields, **kwargs)
+
+
+def sobject_tag(sobject: str) -> str:
+    return cache.make_key("sobject", sobject)
+
+
+def invalidate(*sobjects: str):
+    """ Drop every cached query result depending on these sObjects, call after writing to them """
+    response_cache.invalidate(*[sobject_tag(sobject) for sobject in sobjects])
+
+
+async def ainvalidate(*sobjects: str):
+    """ `invalidate` for async routes """
+    await response_cache.ainvalidate(*[sobject_tag(sobject) for sobject in sobjects])
+
+
+def run(
+    instance_url: str,
+    headers: dict,
+    query: Query,
+    cache_scope: typing.Optional[str] = None,
+    ttl: int = RESULT_CACHE_SECONDS
+) -> dict:
+    """ Run a query through the REST API, returning the response body
+
+        Results are cached under `cache_scope` (usually the sf_username, since
+        sharing rules make results per user) when one is given; without it the
+        query always goes to Salesforce """
+    key = None
+    if cache_scope is not None:
+        key = cache.make_key("soql", cache_scope, hashlib.sha1(query.text.encode("utf8")).hexdigest())
+        body = response_cache.get(key)
+        if body is not None:
+            return body
+
+    response = salesforce.http.get(
+        instance_url + "/services/data/" + API_VERSION + "/query/",
+        headers=headers,
+        params={"q": query.text},
+    )
+    if response.ok is not True:
+        raise fapi.HTTPException(status_code=response.status_code, detail=response.json())
+    body = response.json()
+
+    if key is not None:
+        response_cache.set(key, body, ttl, tags=[sobject_tag(sobject) for sobject in query.sobjects])
+    return body
@@ -0,0 +1,129 @@
+import time
+import asyncio
+import datetime
+import logging
+import threading
+import typing
+
+logger = logging.getLogger(__name__)
+
+CHECK_INTERVAL_SECONDS = 30
+# re-mint tokens expiring within this window
+REFRESH_AHEAD_SECONDS = 5 * 60
+# users without a request for this long are no longer refreshed
+INACTIVITY_SECONDS = 15 * 60
+# token bucket on OAuth calls, to stay well under Salesforce login limits
+MAX_MINTS_PER_SECOND = 2.0
+MAX_MINT_BURST = 10
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class TokenRefresher:
+    """ Re-mints Salesforce access tokens for recently active users shortly before they expire,
+        so `jwt_login` on the request path almost always finds a valid token
+
+        Every worker runs one; tokens live in Postgres and the per-user lock in
+        `mint_token_once` lets a single worker mint while the others skip the user """
+
+    def __init__(self):
+        self._last_seen = {}
+        self._lock = threading.Lock()
+        self._bucket = _TokenBucket(MAX_MINTS_PER_SECOND, MAX_MINT_BURST)
+        self.task = None
+
+    def touch(self, sf_username: str):
+        """ Record activity for a user, called by jwt_login """
+        with self._lock:
+            self._last_seen[sf_username] = time.monotonic()
+
+    def active_users(self) -> typing.List[str]:
+        """ Users seen within INACTIVITY_SECONDS, evicting everyone else """
+        cutoff = time.monotonic() - INACTIVITY_SECONDS
+        with self._lock:
+            for sf_username in [u for u, seen in self._last_seen.items() if seen < cutoff]:
+                del self._last_seen[sf_username]
+            return list(self._last_seen)
+
+    def refresh_expiring(self) -> int:
+        """ Mint new tokens for active users whose token is missing or about to expire """
+        from models import User as user_model
+        from utils import db as database
+        from utils import salesforce
+
+        active = self.active_users()
+        if not active:
+            return 0
+
+        db = next(database.get_db())
+        try:
+            rows = (
+                db.query(user_model.sf_username, user_model.sf_access_token, user_model.sf_token_expiration)
+                .filter(user_model.sf_username.in_(active))
+                .all()
+            )
+            deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=REFRESH_AHEAD_SECONDS)
+            # soonest expiry first, so the rate limit delays the least urgent users
+            expiring = [
+                sf_username for expiration, sf_username in sorted(
+                    (expiration or datetime.datetime.min, sf_username)
+                    for sf_username, token, expiration in rows
+                    if not token or expiration is None or expiration <= deadline
+                )
+            ]
+
+            minted = 0
+            for sf_username in expiring:
+                if not self._bucket.take():
+                    logger.info("Token refresh rate limited, {} users deferred".format(len(expiring) - minted))
+                    break
+                result = salesforce.mint_token_once(salesforce.client_id, sf_username, db, deadline, wait=False)
+                if result is None:
+                    # being minted by another worker, or already was
+                    continue
+                if "error" in result:
+                    logger.warning("Failure to refresh token for {}: {}".format(sf_username, result["message"]))
+                else:
+                    minted += 1
+            return minted
+        finally:
+            db.close()
+
+    async def start_token_refresher(self):
+        self.task = asyncio.get_running_loop().create_task(self._refresh_forever())
+
+    async def shutdown_token_refresher(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _refresh_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+            try:
+                await loop.run_in_executor(None, self.refresh_expiring)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Token refresh failed: {}".format(e))
+
+
+# singleton
+token_refresher = TokenRefresher()
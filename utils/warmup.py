@@ -0,0 +1,86 @@
+import time
+import asyncio
+import logging
+import typing
+
+import sqlalchemy as sa
+
+from settings import settings
+from utils import (
+    auth,
+    db as database,
+    salesforce,
+)
+
+logger = logging.getLogger(__name__)
+
+# readiness is reported once warm-up finishes or this runs out, whichever comes first
+WARMUP_TIMEOUT_SECONDS = 30
+
+
+def warm_postgres():
+    """ Open the pool's connections up front so requests don't pay for connect + TLS """
+    connections = []
+    try:
+        for _ in range(database.engine.pool.size()):
+            connection = database.engine.connect()
+            connection.execute(sa.text("SELECT 1"))
+            connections.append(connection)
+    finally:
+        # closing returns them to the pool, still open
+        for connection in connections:
+            connection.close()
+
+
+def warm_cosmos():
+    """ Build the Cosmos client and every container client, reading each container once """
+    for name in database.cosmos_container_settings:
+        database.get_cosmos_container_client(getattr(settings, name)).read()
+
+
+def warm_salesforce():
+    """ Fetch the JWT signing key and open a pooled TLS connection to the Salesforce instance """
+    salesforce.get_key_from_azure()
+    salesforce.http.head(settings.sfcc_storefront_base_endpoint, timeout=10)
+    # imports the cipher used to decrypt stored access tokens on every request
+    auth.decrypt(auth.encrypt("warmup"))
+
+
+WARMUP_STEPS = {
+    "postgres": warm_postgres,
+    "cosmos": warm_cosmos,
+    "salesforce": warm_salesforce,
+}
+
+
+async def _timed_step(name: str, step: typing.Callable) -> typing.Tuple[str, float, typing.Optional[str]]:
+    start = time.perf_counter()
+    try:
+        await asyncio.to_thread(step)
+        error = None
+    except Exception as e:
+        error = str(e)
+    return name, round((time.perf_counter() - start) * 1000, 1), error
+
+
+async def warm_up(timeout: float = WARMUP_TIMEOUT_SECONDS) -> dict:
+    """ Run every warm-up step in parallel, call from the app lifespan before yielding
+
+        A failing or slow step is logged and skipped rather than blocking startup,
+        the first request to that dependency then connects as before. Returns
+        {step: milliseconds} with None for steps that failed or timed out """
+    tasks = [asyncio.ensure_future(_timed_step(name, step)) for name, step in WARMUP_STEPS.items()]
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        # the thread keeps running, we just stop waiting for it
+        task.cancel()
+
+    timings = {name: None for name in WARMUP_STEPS}
+    for task in done:
+        name, elapsed_ms, error = task.result()
+        if error is None:
+            timings[name] = elapsed_ms
+        else:
+            logger.warning("Warm-up of {} failed after {} ms: {}".format(name, elapsed_ms, error))
+    logger.info("Warm-up finished: {}".format(timings))
+    return timings